@@ -0,0 +1,182 @@
+"""
+Admission control for Ghostscript runs
+
+At most `max_concurrent` conversions run at once, across the synchronous
+endpoint and the job workers alike. Up to `max_waiting` requests may wait for
+a slot. Anything beyond that is rejected straight away with a Retry-After hint
+derived from recently observed throughput, instead of piling more
+interpreters onto an overloaded box. When a slot frees up, the scheduling
+policy decides which waiting request gets it. A conversion that runs several
+Ghostscript processes at once (page ranges) takes a slot for each of them.
+New work is also refused while the scratch area is close to its disk quota.
+"""
+
+import collections
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from scheduling import SchedulingPolicy, Waiting
+
+THROUGHPUT_WINDOW = 60.0  # seconds of completions used to estimate throughput
+DEFAULT_RETRY_AFTER = 5
+
+
+class Rejected(Exception):
+    """Raised when a conversion can't be admitted; carries a Retry-After hint and a metric label"""
+
+    def __init__(self, message, retry_after, reason='busy'):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """Global conversion semaphore with a bounded wait queue"""
+
+    def __init__(self, max_concurrent, max_waiting, max_wait=None, policy=None, scratch=None):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.policy = policy or SchedulingPolicy('fifo')
+        self.scratch = scratch
+        self._waiters = []
+        # Who starts next is decided once per event, at a single instant, so waiters
+        # woken together agree on it however long each takes to get the lock
+        self._next = None
+        self._decide_at = None  # when a waiter turns urgent and the decision must be redone
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._completions = collections.deque()
+        self._cond = threading.Condition()
+
+    def check(self):
+        """Raise Rejected if a new bounded request would be turned away right now"""
+        self.check_storage()
+        with self._cond:
+            if self.active >= self.max_concurrent and self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise Rejected("Server is busy, try again later", self._retry_after(time.monotonic()))
+
+    def check_storage(self):
+        """Raise Rejected if the scratch area has no room for another conversion's files"""
+        if self.scratch is None or self.scratch.has_room():
+            return
+        with self._cond:
+            self.rejected += 1
+            raise Rejected("Server is out of scratch space, try again later",
+                           self._retry_after(time.monotonic()), reason='scratch_full')
+
+    def throughput(self):
+        """Completed conversions per second over the recent window"""
+        with self._cond:
+            return self._throughput(time.monotonic())
+
+    def _throughput(self, now):
+        while self._completions and self._completions[0] < now - THROUGHPUT_WINDOW:
+            self._completions.popleft()
+        if not self._completions:
+            return 0.0
+        span = max(now - self._completions[0], 1.0)
+        return len(self._completions) / span
+
+    def retry_after(self, backlog=None):
+        """Seconds until `backlog` conversions (default: our wait queue) should have drained"""
+        with self._cond:
+            return self._retry_after(time.monotonic(), backlog)
+
+    def _retry_after(self, now, backlog=None):
+        rate = self._throughput(now)
+        if rate <= 0:
+            return DEFAULT_RETRY_AFTER
+        if backlog is None:
+            backlog = self.waiting
+        return max(1, math.ceil((backlog + 1) / rate))
+
+    def acquire(self, bounded=True, cost=None, slots=1):
+        """
+        Wait for `slots` conversion slots (at most all of them)
+        Bounded callers are rejected when the wait queue is full or `max_wait`
+        passes; callers that are already queued elsewhere wait unconditionally.
+        `cost` is the conversion's estimated wall time, used by the scheduling policy.
+        Returns the number of slots taken, to be handed back to release()
+        """
+        slots = max(1, min(slots, self.max_concurrent))
+        with self._cond:
+            if self.active + slots <= self.max_concurrent and not self.waiting:
+                self.active += slots
+                self.admitted += 1
+                return slots
+            if bounded and self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise Rejected("Server is busy, try again later", self._retry_after(time.monotonic()))
+
+            max_wait = self.max_wait if bounded else None
+            waiter = Waiting(cost, max_wait=max_wait)
+            self._waiters.append(waiter)
+            self.waiting += 1
+            self._decide()
+            try:
+                deadline = waiter.since + max_wait if max_wait else None
+                # The first waiter keeps its place until enough slots are free, so nobody overtakes it
+                while self.active + slots > self.max_concurrent or self._next is not waiter:
+                    now = time.monotonic()
+                    if deadline is not None and now >= deadline:
+                        self.timed_out += 1
+                        self.rejected += 1
+                        raise Rejected("Timed out waiting for a conversion slot", self._retry_after(now))
+                    if self._decide_at is not None and now >= self._decide_at:
+                        self._decide()
+                        continue
+                    timeout = min((t - now for t in (deadline, self._decide_at) if t is not None), default=None)
+                    self._cond.wait(timeout)
+            finally:
+                self._waiters.remove(waiter)
+                self.waiting -= 1
+                # Whoever is next in line may be able to take another free slot
+                self._decide()
+            self.active += slots
+            self.admitted += 1
+            return slots
+
+    def _decide(self):
+        """Choose the waiter that starts next, scoring everyone at the same instant, and wake them all"""
+        now = time.monotonic()
+        self._next = self.policy.first(self._waiters, now)
+        pending = [w.urgent_at for w in self._waiters if w.urgent_at is not None and w.urgent_at > now]
+        self._decide_at = min(pending, default=None)
+        self._cond.notify_all()
+
+    def release(self, slots=1):
+        with self._cond:
+            self.active -= slots
+            self._completions.append(time.monotonic())
+            # Wake everyone: a waiter that has just timed out must not swallow the wakeup
+            self._decide()
+
+    @contextmanager
+    def slot(self, bounded=True, cost=None, slots=1):
+        slots = self.acquire(bounded, cost, slots)
+        try:
+            yield
+        finally:
+            self.release(slots)
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            return {
+                'active': self.active,
+                'max_concurrent': self.max_concurrent,
+                'queue_depth': self.waiting,
+                'max_queue_depth': self.max_waiting,
+                'scheduler': self.policy.mode,
+                'admitted_total': self.admitted,
+                'rejected_total': self.rejected,
+                'timed_out_total': self.timed_out,
+                'throughput_per_second': round(self._throughput(now), 3),
+            }
@@ -1,50 +1,717 @@
+import atexit
+import collections
+import hashlib
+import hmac
+import io
+import json
 import os
-import subprocess
+import queue
+import re
+import shutil
 import tempfile
-from flask import Flask, request, render_template, send_file, jsonify
+import threading
+import time
+import unicodedata
+import zipfile
+from contextlib import contextmanager
+from flask import Flask, Response, request, render_template, send_file, jsonify, url_for
+from urllib.parse import quote
+from werkzeug.http import dump_options_header
+
+from admission import AdmissionController, Rejected
+from cost_model import CostHistory, CostModel, history_record, refit
+from gs_args import DEFAULT_PRESET, GS_BATCH_FLAGS, GS_BINARY, PRESETS, build_gs_cmd, extract_error_line
+from gs_pool import GhostscriptPool
+from gs_runner import LIMIT_CPU, LIMIT_MEMORY, LIMIT_OUTPUT, LIMIT_TIMEOUT, GsLimits, run_gs
+from gsapi_engine import GsapiEngine
+from jobs import JobManager, QueueFull
+from metadata_engine import MetadataEngine
+from metrics import Registry
+from negative_cache import NegativeCache
+from page_split import convert_in_ranges, count_pages, page_ranges
+from pdf_parser import preflight, read_identification
+from result_cache import ResultCache, file_sha256, flags_digest, ghostscript_version
+from scheduling import SchedulingPolicy
+from scratch import ScratchArea
+from single_flight import SingleFlight
+from spool import SpoolingRequest
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Conversion engine: 'subprocess' runs one `gs` per upload, 'pool' reuses long-lived
+# interpreters, 'gsapi' calls libgs in-process inside a pool of warm worker processes,
+# 'metadata' only adds PDF/UA identification to already-tagged documents by incremental update
+app.config['GS_ENGINE'] = os.environ.get('PDFUA_GS_ENGINE', 'subprocess')
+app.config['GS_POOL_SIZE'] = int(os.environ.get('PDFUA_GS_POOL_SIZE', os.cpu_count() or 2))
+app.config['GS_POOL_MAX_JOBS'] = int(os.environ.get('PDFUA_GS_POOL_MAX_JOBS', 100))  # jobs before a worker is recycled
+app.config['GS_POOL_JOB_TIMEOUT'] = float(os.environ.get('PDFUA_GS_POOL_JOB_TIMEOUT', 300))  # seconds
+app.config['GS_POOL_HEALTH_INTERVAL'] = float(os.environ.get('PDFUA_GS_POOL_HEALTH_INTERVAL', 30))  # seconds
+
+# Language written to /Lang by the metadata engine when a document declares none
+app.config['DEFAULT_LANG'] = os.environ.get('PDFUA_DEFAULT_LANG', 'en-US')
+
+# Conversion preset used when a request doesn't pick one: 'standard', 'fast', 'balanced' or 'smallest'
+app.config['GS_PRESET'] = os.environ.get('PDFUA_GS_PRESET', DEFAULT_PRESET)
+
+# cgroup v2 group under which each one-shot `gs` run gets its own accounting sub-group (optional)
+app.config['GS_CGROUP_PARENT'] = os.environ.get('PDFUA_GS_CGROUP_PARENT')
+
+# Hard per-conversion limits (0 disables each one)
+app.config['GS_TIMEOUT'] = float(os.environ.get('PDFUA_GS_TIMEOUT', 300))  # wall-clock seconds
+app.config['GS_CPU_LIMIT'] = float(os.environ.get('PDFUA_GS_CPU_LIMIT', 300))  # CPU seconds
+app.config['GS_MEMORY_LIMIT'] = int(os.environ.get('PDFUA_GS_MEMORY_LIMIT', 2 * 1024 * 1024 * 1024))  # bytes
+app.config['GS_MAX_OUTPUT_BYTES'] = int(os.environ.get('PDFUA_GS_MAX_OUTPUT_BYTES', 256 * 1024 * 1024))
+
+# Admission control: conversions running at once, requests allowed to wait, and how long they may wait
+app.config['MAX_CONCURRENT_CONVERSIONS'] = int(os.environ.get('PDFUA_MAX_CONCURRENT_CONVERSIONS', os.cpu_count() or 2))
+app.config['MAX_QUEUED_CONVERSIONS'] = int(os.environ.get('PDFUA_MAX_QUEUED_CONVERSIONS', 2 * (os.cpu_count() or 2)))
+app.config['MAX_QUEUE_WAIT'] = float(os.environ.get('PDFUA_MAX_QUEUE_WAIT', 60))  # seconds
+
+# Order in which waiting conversions start: 'sejf' runs the cheapest estimated one first,
+# with each second of waiting counting as JOB_AGING_RATE seconds less cost; 'fifo' keeps arrival order
+app.config['JOB_SCHEDULER'] = os.environ.get('PDFUA_JOB_SCHEDULER', 'sejf')
+app.config['JOB_AGING_RATE'] = float(os.environ.get('PDFUA_JOB_AGING_RATE', 0.1))
+
+# Documents with at least SPLIT_MIN_PAGES pages are converted as parallel page ranges (0 disables)
+app.config['SPLIT_MIN_PAGES'] = int(os.environ.get('PDFUA_SPLIT_MIN_PAGES', 0))
+app.config['SPLIT_WORKERS'] = int(os.environ.get('PDFUA_SPLIT_WORKERS', os.cpu_count() or 2))
+app.config['SPLIT_MIN_RANGE_PAGES'] = int(os.environ.get('PDFUA_SPLIT_MIN_RANGE_PAGES', 20))
+
+# Background job API: conversions run on JOB_WORKERS threads behind a bounded queue
+app.config['JOB_WORKERS'] = int(os.environ.get('PDFUA_JOB_WORKERS', os.cpu_count() or 2))
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('PDFUA_JOB_QUEUE_SIZE', 100))
+app.config['JOB_RETENTION'] = float(os.environ.get('PDFUA_JOB_RETENTION', 3600))  # seconds results are kept
+
+# Uploads, outputs and intermediate files of each conversion live in a directory of their own
+# under SCRATCH_DIR. New work is refused once the files there take up SCRATCH_HIGH_WATER of
+# SCRATCH_MAX_BYTES (0 means no quota); directories left by exited processes are reaped
+app.config['SCRATCH_DIR'] = os.environ.get('PDFUA_SCRATCH_DIR', os.path.join(tempfile.gettempdir(), 'pdfua-scratch'))
+app.config['SCRATCH_MAX_BYTES'] = int(os.environ.get('PDFUA_SCRATCH_MAX_BYTES', 4 * 1024 * 1024 * 1024))
+app.config['SCRATCH_HIGH_WATER'] = float(os.environ.get('PDFUA_SCRATCH_HIGH_WATER', 0.9))
+app.config['SCRATCH_MAX_AGE'] = float(os.environ.get('PDFUA_SCRATCH_MAX_AGE', 86400))  # seconds
+
+# Requests of up to SCRATCH_MEMORY_MAX_INPUT bytes get their scratch directory on this tmpfs
+# instead, while the machine keeps SCRATCH_MEMORY_RESERVE bytes of memory available ('' disables it)
+app.config['SCRATCH_MEMORY_DIR'] = os.environ.get(
+    'PDFUA_SCRATCH_MEMORY_DIR', '/dev/shm/pdfua-scratch' if os.path.isdir('/dev/shm') else '')
+app.config['SCRATCH_MEMORY_MAX_INPUT'] = int(os.environ.get('PDFUA_SCRATCH_MEMORY_MAX_INPUT', 2 * 1024 * 1024))
+app.config['SCRATCH_MEMORY_RESERVE'] = int(os.environ.get('PDFUA_SCRATCH_MEMORY_RESERVE', 512 * 1024 * 1024))
+
+# With `stream` (a form field or query parameter, defaulting to STREAM_OUTPUT) /convert sends
+# the output while Ghostscript is still writing it, once STREAM_COMMIT_BYTES of it exist
+app.config['STREAM_OUTPUT'] = os.environ.get('PDFUA_STREAM_OUTPUT', '0') == '1'
+app.config['STREAM_COMMIT_BYTES'] = int(os.environ.get('PDFUA_STREAM_COMMIT_BYTES', 64 * 1024))
+
+# Cache of converted outputs keyed by input hash, flags and Ghostscript version (0 disables)
+app.config['RESULT_CACHE_DIR'] = os.environ.get(
+    'PDFUA_RESULT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'pdfua-cache'))
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('PDFUA_RESULT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+# Identical conversions running at the same time (same input bytes and settings, in any server
+# process) share one Ghostscript run through lock files in this directory ('' disables it);
+# it lives under SCRATCH_DIR so the outputs shared through it count against the scratch quota
+app.config['SINGLE_FLIGHT_DIR'] = os.environ.get(
+    'PDFUA_SINGLE_FLIGHT_DIR', os.path.join(app.config['SCRATCH_DIR'], '_inflight'))
+app.config['SINGLE_FLIGHT_MAX_WAIT'] = float(os.environ.get('PDFUA_SINGLE_FLIGHT_MAX_WAIT', 600))  # seconds
+
+# Failures that would happen again for the same input and settings are answered from this
+# directory for NEGATIVE_CACHE_TTL seconds instead of running Ghostscript again (0 disables it)
+app.config['NEGATIVE_CACHE_DIR'] = os.environ.get(
+    'PDFUA_NEGATIVE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'pdfua-failures'))
+app.config['NEGATIVE_CACHE_TTL'] = float(os.environ.get('PDFUA_NEGATIVE_CACHE_TTL', 3600))
+
+# Bearer token for the /admin endpoints ('' disables them)
+app.config['ADMIN_TOKEN'] = os.environ.get('PDFUA_ADMIN_TOKEN', '')
+
+# Documents whose XMP already declares pdfuaid:part and that pass every FAST_PATH_CHECKS item
+# can skip the re-render: 'off' converts everything, 'passthrough' returns them unchanged,
+# 'metadata' also sends other tagged documents through the metadata engine instead of Ghostscript
+app.config['FAST_PATH'] = os.environ.get('PDFUA_FAST_PATH', 'off')
+app.config['FAST_PATH_CHECKS'] = [check for check in os.environ.get(
+    'PDFUA_FAST_PATH_CHECKS', 'marked,struct_tree,lang,title,display_doc_title').split(',') if check]
 
-def convert_to_pdfua(input_pdf_path, output_pdf_path):
+# History of conversion costs and the model fitted from it by `flask --app app refit-cost-model`
+app.config['COST_MODEL_DIR'] = os.environ.get(
+    'PDFUA_COST_MODEL_DIR', os.path.join(tempfile.gettempdir(), 'pdfua-cost'))
+app.config['COST_HISTORY_MAX_RECORDS'] = int(os.environ.get('PDFUA_COST_HISTORY_MAX_RECORDS', 20000))
+
+# Snapshots shared by all server processes so /metrics aggregates across them
+app.config['METRICS_DIR'] = os.environ.get(
+    'PDFUA_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'pdfua-metrics'))
+
+ZIP_CHUNK_SIZE = 256 * 1024
+STREAM_CHUNK_SIZE = 256 * 1024
+STREAM_POLL_INTERVAL = 0.05  # seconds between looks at a growing output file
+
+LIMIT_MESSAGES = {
+    LIMIT_TIMEOUT: "Conversion exceeded the time limit",
+    LIMIT_CPU: "Conversion exceeded the CPU time limit",
+    LIMIT_MEMORY: "Conversion exceeded the memory limit",
+    LIMIT_OUTPUT: "Converted file exceeds the maximum output size",
+}
+
+# Failures caused by the document itself; wall-clock timeouts also depend on load, and
+# unexpected exceptions and engine crashes on the server, so those are always retried
+NEGATIVE_CACHE_CODES = ('ghostscript_error', 'metadata_error', 'empty_output', LIMIT_CPU, LIMIT_MEMORY,
+                        LIMIT_OUTPUT)
+# Failures a client should retry later: timeouts depend on load, engine crashes on the server
+RETRYABLE_CODES = (LIMIT_TIMEOUT, 'engine_crash')
+
+metrics = Registry(app.config['METRICS_DIR'])
+UPLOAD_SPOOL_SECONDS = metrics.histogram(
+    'pdfua_upload_spool_seconds', 'Time spent receiving and spooling uploads')
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    'pdfua_queue_wait_seconds', 'Time a conversion waited before it started', ['queue'])
+GHOSTSCRIPT_SECONDS = metrics.histogram(
+    'pdfua_ghostscript_seconds', 'Wall time of Ghostscript runs', ['engine', 'preset'])
+RESPONSE_SEND_SECONDS = metrics.histogram(
+    'pdfua_response_send_seconds', 'Time spent sending converted files to the client')
+CONVERSIONS = metrics.counter(
+    'pdfua_conversions_total', 'Finished conversions by outcome (success or error class)', ['outcome'])
+REJECTIONS = metrics.counter(
+    'pdfua_rejections_total', 'Requests turned away before conversion', ['reason'])
+INPUT_BYTES = metrics.counter('pdfua_input_bytes_total', 'Bytes of PDF input converted')
+OUTPUT_BYTES = metrics.counter('pdfua_output_bytes_total', 'Bytes of PDF/UA output produced')
+GHOSTSCRIPT_CPU_SECONDS = metrics.histogram(
+    'pdfua_ghostscript_cpu_seconds', 'CPU time used by Ghostscript per conversion', ['mode'])
+GHOSTSCRIPT_PEAK_RSS_BYTES = metrics.histogram(
+    'pdfua_ghostscript_peak_rss_bytes', 'Peak resident memory of Ghostscript per conversion',
+    buckets=[2 ** n * 1024 * 1024 for n in range(4, 14)])
+GHOSTSCRIPT_BLOCK_IO_BYTES = metrics.counter(
+    'pdfua_ghostscript_block_io_bytes_total', 'Block I/O performed by Ghostscript', ['direction'])
+IN_FLIGHT = metrics.gauge('pdfua_conversions_in_flight', 'Ghostscript conversions currently running')
+CACHE_LOOKUPS = metrics.counter('pdfua_result_cache_lookups_total', 'Result cache lookups', ['result'])
+PREFLIGHT_SECONDS = metrics.histogram('pdfua_preflight_seconds', 'Time spent reading documents before conversion')
+FAST_PATH = metrics.counter('pdfua_fast_path_total', 'Documents by fast-path route', ['route'])
+SINGLE_FLIGHT = metrics.counter(
+    'pdfua_single_flight_total', 'Conversions by single-flight role (leader, follower or alone)', ['role'])
+NEGATIVE_CACHE_HITS = metrics.counter(
+    'pdfua_negative_cache_hits_total', 'Failures answered from the negative cache', ['error_code'])
+NEGATIVE_CACHE_CPU_SECONDS_SAVED = metrics.counter(
+    'pdfua_negative_cache_cpu_seconds_saved_total',
+    'Ghostscript CPU time the original runs of failures answered from the negative cache took')
+STREAMED_RESPONSES = metrics.counter(
+    'pdfua_streamed_responses_total',
+    'Streaming conversions by outcome (streamed, finished before streaming began, or aborted)', ['outcome'])
+SCRATCH_DIRS = metrics.counter(
+    'pdfua_scratch_dirs_total', 'Scratch directories created, by backend (memory or disk)', ['backend'])
+COST_ESTIMATE_ERROR = metrics.histogram(
+    'pdfua_cost_estimate_error_ratio', 'Absolute error of cost estimates relative to the measured cost',
+    ['target'], buckets=[0.05, 0.1, 0.25, 0.5, 1, 2, 4])
+
+_engines = {}
+_init_lock = threading.Lock()
+_job_manager = None
+_admission = None
+_result_cache = None
+_single_flight = None
+_negative_cache = None
+_scratch = None
+_cost_history = None
+_cost_model = None
+_flags_digests = {}
+
+
+def get_engine(name, preset):
+    """Create a long-lived conversion engine on first use"""
+    # Pool interpreters are started with a preset's flags, so each preset gets its own pool
+    key = (name, preset.name) if name == 'pool' else name
+    with _init_lock:
+        if key not in _engines:
+            if name == 'pool':
+                engine = GhostscriptPool(
+                    size=app.config['GS_POOL_SIZE'],
+                    max_jobs_per_worker=app.config['GS_POOL_MAX_JOBS'],
+                    preset=preset,
+                    job_timeout=app.config['GS_POOL_JOB_TIMEOUT'],
+                    health_interval=app.config['GS_POOL_HEALTH_INTERVAL'],
+                    limits=gs_limits()
+                )
+            elif name == 'gsapi':
+                engine = GsapiEngine(
+                    size=app.config['GS_POOL_SIZE'],
+                    max_jobs_per_worker=app.config['GS_POOL_MAX_JOBS'],
+                    limits=gs_limits()
+                )
+            elif name == 'metadata':
+                engine = MetadataEngine(default_lang=app.config['DEFAULT_LANG'])
+            else:
+                raise ValueError(f"Unknown conversion engine: {name}")
+            atexit.register(engine.close)
+            _engines[key] = engine
+        return _engines[key]
+
+
+def gs_limits():
+    """Per-conversion resource limits from the configuration"""
+    return GsLimits(
+        wall_seconds=app.config['GS_TIMEOUT'],
+        cpu_seconds=app.config['GS_CPU_LIMIT'],
+        memory_bytes=app.config['GS_MEMORY_LIMIT'],
+        output_bytes=app.config['GS_MAX_OUTPUT_BYTES']
+    )
+
+
+def get_preset(name=None):
+    """The named conversion preset, or the configured default; None if there is no such preset"""
+    return PRESETS.get(name or app.config['GS_PRESET'])
+
+
+def split_page_count(input_pdf_path, summary=None, engine=None):
+    """
+    Page count of a document long enough to be converted as parallel page ranges
+    `summary` is the document's preflight summary when it has been read already
+    (empty if the document couldn't be preflighted).
+    Returns the page count, or 0 if the document is converted in one piece, which
+    includes documents too short for more than one range of SPLIT_MIN_RANGE_PAGES
+    """
+    engine = engine or app.config['GS_ENGINE']
+    if app.config['SPLIT_MIN_PAGES'] <= 0 or engine == 'metadata':
+        return 0
+    # /Count from a file indexed by scanning may be stale, so ask Ghostscript then
+    if summary is None:
+        summary = preflight_document(input_pdf_path)
+    if summary and summary['pages'] and summary['xref'] != 'scan':
+        page_count = summary['pages']
+    else:
+        page_count = count_pages(input_pdf_path)
+    if not page_count or page_count < app.config['SPLIT_MIN_PAGES']:
+        return 0
+    # A single range would only add a merge pass to a one-piece conversion
+    if len(page_ranges(page_count, app.config['SPLIT_WORKERS'], app.config['SPLIT_MIN_RANGE_PAGES'])) < 2:
+        return 0
+    return page_count
+
+
+def split_slots(page_count):
+    """Ghostscript processes a conversion of `page_count` pages (0 for one piece) runs at once"""
+    if not page_count:
+        return 1
+    return len(page_ranges(page_count, app.config['SPLIT_WORKERS'], app.config['SPLIT_MIN_RANGE_PAGES']))
+
+
+def run_ghostscript(input_pdf_path, output_pdf_path, preset, engine=None, summary=None, split_pages=None):
+    """
+    Run Ghostscript with `engine`, or the configured engine when it is None
+    `summary` is the document's preflight summary when it has been read already
+    (empty if the document couldn't be preflighted). `split_pages` is what
+    split_page_count() returned for the document, if the caller has asked it.
+    Returns a GsRun
+    """
+    engine = engine or app.config['GS_ENGINE']
+    if split_pages is None:
+        split_pages = split_page_count(input_pdf_path, summary, engine)
+    # Long documents are converted as page ranges in parallel and merged
+    if split_pages and engine != 'metadata':
+        gs_result, stats = convert_in_ranges(
+            input_pdf_path, output_pdf_path, split_pages,
+            workers=app.config['SPLIT_WORKERS'],
+            min_pages_per_range=app.config['SPLIT_MIN_RANGE_PAGES'],
+            cgroup_parent=app.config['GS_CGROUP_PARENT'],
+            limits=gs_limits(),
+            preset=preset,
+            scratch_dir=os.path.dirname(output_pdf_path)
+        )
+        app.logger.info("Split conversion of %d pages: %s", split_pages, stats)
+        return gs_result
+
+    if engine != 'subprocess':
+        return get_engine(engine, preset).run(input_pdf_path, output_pdf_path, preset)
+
+    gs_cmd = build_gs_cmd(input_pdf_path, output_pdf_path, preset)
+    return run_gs(gs_cmd, app.config['GS_CGROUP_PARENT'], gs_limits())
+
+
+def record_usage(input_pdf_path, usage):
+    """Log and export the resources one conversion consumed"""
+    if not usage:
+        return
+    app.logger.info(
+        "Ghostscript usage for %s: wall %.3fs, user %.3fs, system %.3fs, peak RSS %d bytes, "
+        "block read %d bytes, block write %d bytes (%s)",
+        os.path.basename(input_pdf_path), usage.get('wall_seconds', 0),
+        usage['user_cpu_seconds'], usage['system_cpu_seconds'], usage['peak_rss_bytes'],
+        usage['block_read_bytes'], usage['block_write_bytes'], usage['source']
+    )
+    GHOSTSCRIPT_CPU_SECONDS.observe(usage['user_cpu_seconds'], mode='user')
+    GHOSTSCRIPT_CPU_SECONDS.observe(usage['system_cpu_seconds'], mode='system')
+    GHOSTSCRIPT_PEAK_RSS_BYTES.observe(usage['peak_rss_bytes'])
+    GHOSTSCRIPT_BLOCK_IO_BYTES.inc(usage['block_read_bytes'], direction='read')
+    GHOSTSCRIPT_BLOCK_IO_BYTES.inc(usage['block_write_bytes'], direction='write')
+
+
+def preflight_document(input_pdf_path):
+    """
+    Structural summary of a document (see pdf_parser.preflight)
+    Returns the summary dict, or an empty dict if the file can't be read
+    """
+    started = time.perf_counter()
+    try:
+        return preflight(input_pdf_path)
+    except Exception as e:
+        app.logger.info("Preflight of %s failed: %s", os.path.basename(input_pdf_path), e)
+        return {}
+    finally:
+        PREFLIGHT_SECONDS.observe(time.perf_counter() - started)
+
+
+def get_cost_history():
+    """Open the conversion cost history on first use"""
+    global _cost_history
+    with _init_lock:
+        if _cost_history is None:
+            _cost_history = CostHistory(os.path.join(app.config['COST_MODEL_DIR'], 'history.jsonl'))
+        return _cost_history
+
+
+def get_cost_model():
+    """The fitted cost model, reloaded whenever a refit has replaced the file"""
+    global _cost_model
+    path = os.path.join(app.config['COST_MODEL_DIR'], 'model.json')
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        mtime = None
+    with _init_lock:
+        if _cost_model is None or _cost_model[0] != mtime:
+            _cost_model = (mtime, CostModel.load(path))
+        return _cost_model[1]
+
+
+def estimate_cost(summary, preset):
+    """Estimated 'wall_seconds' and 'peak_rss_bytes' of converting a document with `preset`"""
+    return get_cost_model().predict(summary, preset.name)
+
+
+def read_document(input_pdf_path, preset):
+    """
+    Preflight an upload once for everything a request needs to know about it
+    Returns (summary, estimate); the summary is empty and the estimate None if the
+    document couldn't be preflighted
+    """
+    summary = preflight_document(input_pdf_path)
+    return summary, estimate_cost(summary, preset) if summary else None
+
+
+def record_cost(summary, preset, engine, usage, estimate):
+    """Add a finished conversion to the cost history and export how far off its estimate was"""
+    # A split run's wall time depends on its range count, which the model has no feature for
+    if not usage.get('wall_seconds') or usage.get('ranges'):
+        return
+    for target in ('wall_seconds', 'peak_rss_bytes'):
+        if usage.get(target):
+            COST_ESTIMATE_ERROR.observe(abs(estimate[target] - usage[target]) / usage[target], target=target)
+    try:
+        get_cost_history().append(history_record(summary, preset.name, engine, usage))
+    except OSError as e:
+        app.logger.warning("Cost history error: %s", e)
+
+
+def fast_path_route(input_pdf_path):
+    """
+    Decide whether a document can skip the Ghostscript re-render
+    Only the trailer, catalog and XMP packet are read.
+    Returns 'passthrough', 'metadata' or 'convert'
+    """
+    if app.config['FAST_PATH'] == 'off':
+        return 'convert'
+    started = time.perf_counter()
+    try:
+        identification = read_identification(input_pdf_path)
+    except Exception as e:
+        # Anything the reader can't make sense of goes through Ghostscript as usual
+        app.logger.info("Fast-path preflight of %s failed: %s", os.path.basename(input_pdf_path), e)
+        return 'convert'
+    finally:
+        PREFLIGHT_SECONDS.observe(time.perf_counter() - started)
+    if identification['pdfua_part'] and not identification['encrypted'] \
+            and all(identification.get(check) for check in app.config['FAST_PATH_CHECKS']):
+        return 'passthrough'
+    if app.config['FAST_PATH'] == 'metadata' and identification['struct_tree'] \
+            and not identification['encrypted']:
+        return 'metadata'
+    return 'convert'
+
+
+def convert_to_pdfua(input_pdf_path, output_pdf_path, report=None, preset=None, summary=None, split_pages=None):
     """
     Convert PDF to PDF/UA using Ghostscript only
     Returns (success: bool, message: str)
+    `preset` names a conversion preset; the configured default is used when it is None.
+    `summary` is the preflight summary and `split_pages` the split_page_count() of the
+    document, if the caller has worked them out already.
+    If `report` is given it receives the resource 'usage', the 'preset' label, the
+    'fast_path' route, the 'preflight' summary and cost 'estimate' when the document
+    could be read, and, on failure, an 'error_code'.
     """
+    if report is None:
+        report = {}
+    success, message, report['error_code'] = _convert_to_pdfua(
+        input_pdf_path, output_pdf_path, report, preset, summary, split_pages)
+    CONVERSIONS.inc(outcome='success' if success else report['error_code'])
+    return success, message
+
+
+def _convert_to_pdfua(input_pdf_path, output_pdf_path, report, preset_name, summary, split_pages):
     try:
-        # Use Ghostscript for PDF/UA conversion
-        gs_cmd = [
-            'gs', '-dPDFA', '-dPDFUA', '-dNOPAUSE', '-dBATCH',
-            '-sColorConversionStrategy=UseDeviceIndependentColor',
-            '-sDEVICE=pdfwrite',
-            '-dPDFACompatibilityPolicy=2',
-            '-dCompatibilityLevel=1.7',
-            '-dDetectDuplicateImages=true',
-            '-dCompressPages=true',
-            '-dCompressFonts=true',
-            f'-sOutputFile={output_pdf_path}',
-            input_pdf_path
-        ]
+        preset = get_preset(preset_name)
+        if preset is None:
+            return False, f"Unknown conversion preset: {preset_name}", 'exception'
+        report['preset'] = preset.label
+        INPUT_BYTES.inc(os.path.getsize(input_pdf_path))
+
+        report['fast_path'] = fast_path_route(input_pdf_path)
+        FAST_PATH.inc(route=report['fast_path'])
+        if report['fast_path'] == 'passthrough':
+            shutil.copyfile(input_pdf_path, output_pdf_path)
+            report['usage'] = {}
+            OUTPUT_BYTES.inc(os.path.getsize(output_pdf_path))
+            return True, "Document already declares PDF/UA and was returned unchanged", None
+
+        engine = 'metadata' if report['fast_path'] == 'metadata' else app.config['GS_ENGINE']
+        if engine == 'metadata':
+            summary = None
+        else:
+            if summary is None:
+                summary = preflight_document(input_pdf_path)
+            if summary:
+                report['preflight'] = summary
+                report['estimate'] = estimate_cost(summary, preset)
+
+        IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            gs_result = run_ghostscript(input_pdf_path, output_pdf_path, preset, engine, summary, split_pages)
+        finally:
+            GHOSTSCRIPT_SECONDS.observe(time.perf_counter() - started, engine=engine, preset=preset.name)
+            IN_FLIGHT.dec()
 
-        gs_result = subprocess.run(gs_cmd, capture_output=True, text=True)
+        record_usage(input_pdf_path, gs_result.usage)
+        report['usage'] = gs_result.usage
 
-        if gs_result.returncode == 0:
+        if gs_result.limit_exceeded:
+            return False, LIMIT_MESSAGES[gs_result.limit_exceeded], gs_result.limit_exceeded
+        if gs_result.crashed:
+            # The engine process died for no reason we can pin on the document
+            return False, f"Conversion engine failed: {extract_error_line(gs_result.stderr)}", 'engine_crash'
+        if gs_result.ok:
             # Check if output file was created and has content
             if os.path.exists(output_pdf_path) and os.path.getsize(output_pdf_path) > 0:
-                return True, "PDF successfully converted with PDF/UA flags"
+                output_size = os.path.getsize(output_pdf_path)
+                max_output = app.config['GS_MAX_OUTPUT_BYTES']
+                if max_output and output_size > max_output:
+                    return False, LIMIT_MESSAGES[LIMIT_OUTPUT], LIMIT_OUTPUT
+                OUTPUT_BYTES.inc(output_size)
+                if summary:
+                    record_cost(summary, preset, engine, gs_result.usage, report['estimate'])
+                return True, "PDF successfully converted with PDF/UA flags", None
             else:
-                return False, "Conversion completed but output file is empty"
+                return False, "Conversion completed but output file is empty", 'empty_output'
         else:
-            error_msg = gs_result.stderr or "Unknown Ghostscript error"
             # Extract the most relevant error line
-            error_lines = [line for line in error_msg.split('\n') if line.strip() and 'error' in line.lower()]
-            if error_lines:
-                error_msg = error_lines[0]
-            return False, f"Conversion failed: {error_msg}"
+            error_output = gs_result.stderr or gs_result.stdout
+            error_code = 'metadata_error' if engine == 'metadata' else 'ghostscript_error'
+            return False, f"Conversion failed: {extract_error_line(error_output)}", error_code
 
     except Exception as e:
-        return False, f"Conversion error: {str(e)}"
+        return False, f"Conversion error: {str(e)}", 'exception'
+
+
+def error_status(error_code):
+    """HTTP status for a failed conversion: other limit violations are the document's fault"""
+    if error_code in RETRYABLE_CODES:
+        return 503
+    return 422 if error_code in LIMIT_MESSAGES else 500
+
+
+def failure_response(message, error_code, cached=False):
+    """JSON response for a failed conversion, telling the client when to retry where that may help"""
+    body = {'error': message, 'code': error_code}
+    if cached:
+        body['cached'] = True
+    status = error_status(error_code)
+    if status != 503:
+        return jsonify(body), status
+    retry_after = get_admission().retry_after()
+    body['retry_after'] = retry_after
+    return jsonify(body), status, {'Retry-After': str(retry_after)}
+
+
+@contextmanager
+def conversion_slot(bounded=True, estimate=None, slots=1):
+    """
+    Hold global conversion slots, recording how long it took to get them
+    `estimate` is the conversion's cost estimate, which decides its place among waiters.
+    `slots` is the number of Ghostscript processes the conversion runs at once.
+    """
+    admission = get_admission()
+    started = time.perf_counter()
+    slots = admission.acquire(bounded, estimate['wall_seconds'] if estimate else None, slots)
+    QUEUE_WAIT_SECONDS.observe(time.perf_counter() - started, queue='admission')
+    try:
+        yield
+    finally:
+        admission.release(slots)
+
+
+def convert_admitted(input_pdf_path, output_pdf_path, report=None, preset=None, input_sha256=None, summary=None,
+                     bounded=False):
+    """
+    Convert once a global conversion slot is free; used by the job workers
+    `input_sha256` and `summary` are the upload's digest and preflight summary as the
+    request read them; without a digest, both are read here.
+    With `bounded`, the wait for a slot is limited as for a /convert request; a rejected
+    conversion fails with error_code 'busy' and the report's 'retry_after' and 'busy_reason'.
+    """
+    # Queued jobs already sit in a bounded queue, so they wait for a slot instead of being rejected
+    report = {} if report is None else report
+    preset_config = get_preset(preset)
+    if preset_config is None:
+        return convert_to_pdfua(input_pdf_path, output_pdf_path, report, preset)
+    if input_sha256 is None:
+        input_sha256 = file_sha256(input_pdf_path)
+        summary = preflight_document(input_pdf_path)
+    try:
+        return convert_once(input_pdf_path, output_pdf_path, report, preset_config, input_sha256, bounded=bounded,
+                            estimate=estimate_cost(summary, preset_config) if summary else None, summary=summary)
+    except Rejected as e:
+        report.update(error_code='busy', retry_after=e.retry_after, busy_reason=e.reason)
+        return False, str(e)
+
+
+def convert_once(input_pdf_path, output_pdf_path, report, preset, input_sha256, bounded=True, estimate=None,
+                 summary=None):
+    """
+    Convert in a global conversion slot, sharing the run with identical concurrent requests
+    A request that finds the same input bytes being converted with the same settings
+    waits for that conversion and takes its outcome; `report` then only gets the
+    'error_code' and 'deduplicated'. A recent deterministic failure of the same
+    conversion is returned without running anything, with 'negative_cache' set.
+    Returns (success: bool, message: str)
+    """
+    key = ResultCache.make_key(input_sha256, get_flags_digest(preset))
+    negative_cache = get_negative_cache()
+    failure_key = negative_cache_key(input_sha256, preset)
+    failure = negative_cache.get(failure_key) if negative_cache else None
+    if failure:
+        NEGATIVE_CACHE_HITS.inc(error_code=failure['error_code'])
+        NEGATIVE_CACHE_CPU_SECONDS_SAVED.inc(failure['cpu_seconds'])
+        report.update(usage={}, error_code=failure['error_code'], negative_cache=True)
+        return False, failure['message']
+
+    group = get_single_flight()
+    flight = group.claim(key) if group else None
+    try:
+        if flight and flight.outcome:
+            SINGLE_FLIGHT.inc(role='follower')
+            if flight.outcome['success']:
+                flight.copy_output(output_pdf_path)
+            report.update(usage={}, error_code=flight.outcome['error_code'], deduplicated=True)
+            return flight.outcome['success'], flight.outcome['message']
+
+        SINGLE_FLIGHT.inc(role='leader' if flight and flight.leader else 'alone')
+        # A split conversion runs a Ghostscript process per page range, and pays a slot for each
+        split_pages = split_page_count(input_pdf_path, summary)
+        with conversion_slot(bounded, estimate, split_slots(split_pages)):
+            success, message = convert_to_pdfua(input_pdf_path, output_pdf_path, report, preset.name, summary,
+                                                split_pages)
+        # Unexpected errors may well not happen again, so let a waiting request retry
+        if flight and report['error_code'] != 'exception':
+            flight.publish(success, message, report['error_code'], output_pdf_path if success else None)
+        if negative_cache and report['error_code'] in NEGATIVE_CACHE_CODES:
+            usage = report.get('usage') or {}
+            cpu_seconds = usage.get('user_cpu_seconds', 0) + usage.get('system_cpu_seconds', 0)
+            try:
+                negative_cache.put(failure_key, report['error_code'], message, round(cpu_seconds, 3),
+                                   input_sha256=input_sha256, preset=report.get('preset'))
+            except OSError as cache_error:
+                app.logger.warning("Negative cache error: %s", cache_error)
+        return success, message
+    finally:
+        if flight:
+            flight.release()
+
+
+def negative_cache_key(input_sha256, preset):
+    """Key of a conversion's failure: its result key plus the limits a failure depends on"""
+    limits = gs_limits()
+    return ResultCache.make_key(
+        input_sha256,
+        f'{get_flags_digest(preset)}:cpu={limits.cpu_seconds}:memory={limits.memory_bytes}:output={limits.output_bytes}'
+    )
+
+
+def record_job_finished(job):
+    QUEUE_WAIT_SECONDS.observe(job.started_at - job.submitted_at, queue='jobs')
+
+
+def busy_response(message, retry_after, reason='busy'):
+    """429 response telling the client when to retry"""
+    REJECTIONS.inc(reason=reason)
+    return jsonify({'error': message, 'retry_after': retry_after}), 429, {'Retry-After': str(retry_after)}
+
+
+def queue_full_response():
+    retry_after = get_admission().retry_after(backlog=get_job_manager().queue_depth())
+    return busy_response('Conversion queue is full, try again later', retry_after, reason='queue_full')
+
+
+def timed_send(response):
+    """Record how long it takes to stream a generated `response` to the client"""
+    started = time.perf_counter()
+    response.call_on_close(lambda: RESPONSE_SEND_SECONDS.observe(time.perf_counter() - started))
+    return response
+
+
+class SentFile(io.FileIO):
+    """
+    A download's open file, calling `on_close` once the server is done sending it
+    A send_file() response goes to the server's file wrapper (and sendfile) as it is,
+    and the server then closes the file, never the response, so close callbacks
+    on the response wouldn't run.
+    """
+
+    def __init__(self, file, on_close=None):
+        super().__init__(file, 'rb')
+        self.on_close = on_close
+
+    def close(self):
+        on_close, self.on_close = self.on_close, None
+        try:
+            super().close()
+        finally:
+            if on_close:
+                on_close()
+
+
+def send_download(file, download_name, cleanup=None):
+    """
+    Attachment response for a finished PDF at path `file` (or an open descriptor)
+    The file is opened before `cleanup` runs, so `cleanup` may delete it or its directory
+    right away; the open handle keeps the bytes readable until they have been sent.
+    """
+    started = time.perf_counter()
+    sent = SentFile(file, lambda: RESPONSE_SEND_SECONDS.observe(time.perf_counter() - started))
+    try:
+        size = os.fstat(sent.fileno()).st_size
+        if cleanup:
+            cleanup()
+        response = send_file(sent, as_attachment=True, download_name=download_name, mimetype='application/pdf')
+    except BaseException:
+        sent.close()
+        raise
+    # send_file() can't tell the size of an open file
+    response.content_length = size
+    return response
+
+
+def spooled_uploads():
+    """The request's file uploads, recording how long receiving and spooling them took"""
+    started = time.perf_counter()
+    files = request.files
+    UPLOAD_SPOOL_SECONDS.observe(time.perf_counter() - started)
+    return files
 
 
 def allowed_file(filename):
@@ -52,6 +719,190 @@ def allowed_file(filename):
     return '.' in filename and filename.lower().endswith('.pdf')
 
 
+def validate_pdf_upload(file):
+    """Return an error message for an unusable upload, or None if it looks like a PDF"""
+    # Check if file is selected
+    if file.filename == '':
+        return 'No file selected'
+
+    # Check if file is PDF
+    if not allowed_file(file.filename):
+        return 'File must be a PDF'
+
+    # The spool checked the header while the upload streamed in
+    if not file.stream.looks_like_pdf:
+        return 'File is not a valid PDF'
+
+    return None
+
+
+def get_uploaded_pdf():
+    """
+    Validate the `pdf_file` upload of the current request
+    Returns (file, error_response) where exactly one is None
+    """
+    files = spooled_uploads()
+
+    # Check if file was uploaded
+    if 'pdf_file' not in files:
+        return None, (jsonify({'error': 'No file uploaded'}), 400)
+
+    file = files['pdf_file']
+    error = validate_pdf_upload(file)
+    if error:
+        return None, (jsonify({'error': error}), 400)
+
+    return file, None
+
+
+def get_requested_preset():
+    """
+    The conversion preset chosen by the `preset` form field or query parameter
+    Returns (preset, error_response) where exactly one is None
+    """
+    name = request.values.get('preset')
+    preset = get_preset(name)
+    if preset is None:
+        name = name or app.config['GS_PRESET']
+        return None, (jsonify({'error': f'Unknown preset: {name}', 'presets': sorted(PRESETS)}), 400)
+    return preset, None
+
+
+def get_admission():
+    """Create the global admission controller on first use"""
+    global _admission
+    scratch = get_scratch()
+    with _init_lock:
+        if _admission is None:
+            _admission = AdmissionController(
+                max_concurrent=app.config['MAX_CONCURRENT_CONVERSIONS'],
+                max_waiting=app.config['MAX_QUEUED_CONVERSIONS'],
+                max_wait=app.config['MAX_QUEUE_WAIT'],
+                policy=scheduling_policy(),
+                scratch=scratch
+            )
+        return _admission
+
+
+def get_scratch():
+    """Create the scratch area on first use, reaping what exited processes left behind"""
+    global _scratch
+    with _init_lock:
+        if _scratch is None:
+            _scratch = ScratchArea(
+                app.config['SCRATCH_DIR'],
+                quota_bytes=app.config['SCRATCH_MAX_BYTES'],
+                high_water=app.config['SCRATCH_HIGH_WATER'],
+                max_age=app.config['SCRATCH_MAX_AGE'],
+                memory_root=app.config['SCRATCH_MEMORY_DIR'] or None,
+                memory_max_input=app.config['SCRATCH_MEMORY_MAX_INPUT'],
+                memory_reserve=app.config['SCRATCH_MEMORY_RESERVE']
+            )
+            atexit.register(_scratch.close)
+        return _scratch
+
+
+class ScratchRequest(SpoolingRequest):
+    """Spools every upload into a scratch directory of its own"""
+
+    def spool_workdir(self, size_hint=None):
+        workdir = get_scratch().create(size_hint)
+        SCRATCH_DIRS.inc(backend=workdir.backend)
+        return workdir
+
+
+app.request_class = ScratchRequest
+
+
+def scheduling_policy():
+    """The configured order in which waiting conversions start"""
+    return SchedulingPolicy(app.config['JOB_SCHEDULER'], app.config['JOB_AGING_RATE'])
+
+
+def get_result_cache():
+    """Create the conversion result cache on first use, or None when disabled"""
+    global _result_cache
+    if app.config['RESULT_CACHE_MAX_BYTES'] <= 0:
+        return None
+    with _init_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(app.config['RESULT_CACHE_DIR'], app.config['RESULT_CACHE_MAX_BYTES'])
+        return _result_cache
+
+
+def get_single_flight():
+    """Create the single-flight lock directory on first use, or None when disabled"""
+    global _single_flight
+    if not app.config['SINGLE_FLIGHT_DIR']:
+        return None
+    with _init_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight(
+                app.config['SINGLE_FLIGHT_DIR'],
+                max_wait=app.config['SINGLE_FLIGHT_MAX_WAIT'],
+                # Never sweep the lock of a conversion that may still be running
+                retention=max(600.0, app.config['GS_TIMEOUT'] + app.config['MAX_QUEUE_WAIT'])
+            )
+        return _single_flight
+
+
+def get_negative_cache():
+    """Create the negative cache on first use, or None when disabled"""
+    global _negative_cache
+    if app.config['NEGATIVE_CACHE_TTL'] <= 0:
+        return None
+    with _init_lock:
+        if _negative_cache is None:
+            _negative_cache = NegativeCache(app.config['NEGATIVE_CACHE_DIR'], app.config['NEGATIVE_CACHE_TTL'])
+        return _negative_cache
+
+
+def get_flags_digest(preset):
+    """Digest of a preset's Ghostscript flags and the Ghostscript version, computed once per process"""
+    if preset.name not in _flags_digests:
+        # The fast path and the metadata engine produce different bytes for the same input
+        routing = [f"engine={app.config['GS_ENGINE']}", f"fast-path={app.config['FAST_PATH']}",
+                   f"lang={app.config['DEFAULT_LANG']}"]
+        flags = [preset.label, *routing, *GS_BATCH_FLAGS, *preset.flags, *preset.postscript_args()]
+        _flags_digests[preset.name] = flags_digest(flags, ghostscript_version(GS_BINARY))
+    return _flags_digests[preset.name]
+
+
+class ZipSink:
+    """Write-only buffer that lets zipfile stream an archive into a response"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def get_job_manager():
+    """Create the background job manager on first use"""
+    global _job_manager
+    with _init_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(
+                convert_admitted,
+                workers=app.config['JOB_WORKERS'],
+                max_queue=app.config['JOB_QUEUE_SIZE'],
+                retention=app.config['JOB_RETENTION'],
+                on_finished=record_job_finished,
+                policy=scheduling_policy()
+            )
+        return _job_manager
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -59,63 +910,433 @@ def index():
 
 @app.route('/convert', methods=['POST'])
 def convert_pdf():
-    # Check if file was uploaded
-    if 'pdf_file' not in request.files:
-        return jsonify({'error': 'No file uploaded'}), 400
-
-    file = request.files['pdf_file']
-
-    # Check if file is selected
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+    # Refuse before reading the upload when there is no room to wait for a slot
+    admission = get_admission()
+    try:
+        admission.check()
+    except Rejected as e:
+        return busy_response(str(e), e.retry_after, e.reason)
 
-    # Check if file is PDF
-    if not allowed_file(file.filename):
-        return jsonify({'error': 'File must be a PDF'}), 400
+    file, error_response = get_uploaded_pdf()
+    if error_response:
+        return error_response
+    preset, error_response = get_requested_preset()
+    if error_response:
+        return error_response
 
-    # Create temporary files
-    input_path = None
-    output_path = None
+    download_name = f"pdfua_{file.filename}"
+    # The upload was spooled into its own scratch directory and hashed while the body was parsed
+    spool = file.stream
+    workdir = spool.workdir
+    input_path = spool.detach()
+    submitted = False
 
     try:
-        # Create temporary input file
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as input_temp:
-            input_path = input_temp.name
-            file.save(input_path)
+        # Serve a previous conversion of the same bytes without running Ghostscript
+        cache = get_result_cache()
+        cache_key = None
+        if cache:
+            cache_key = cache.make_key(spool.sha256, get_flags_digest(preset))
+            cached = cache.open(cache_key)
+            CACHE_LOOKUPS.inc(result='hit' if cached else 'miss')
+            if cached:
+                with cached:
+                    response = send_download(os.dup(cached.fileno()), download_name)
+                response.headers['X-Cache'] = 'HIT'
+                response.headers['X-PDFUA-Preset'] = preset.label
+                return response
 
-        # Create temporary output file
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as output_temp:
-            output_path = output_temp.name
+        if stream_requested():
+            # The job owns the scratch directory from here on
+            submitted = True
+            return stream_conversion(workdir, input_path, file.filename, preset, cache_key, spool.sha256)
 
-        # Convert to PDF/UA
-        success, message = convert_to_pdfua(input_path, output_path)
+        # Convert to PDF/UA, or wait for an identical conversion that is already running
+        output_path = workdir.file('output.pdf')
+        report = {}
+        summary, estimate = read_document(input_path, preset)
+        success, message = convert_once(input_path, output_path, report, preset, spool.sha256,
+                                        estimate=estimate, summary=summary)
 
         if success:
-            # Return the converted file for download
-            download_name = f"pdfua_{file.filename}"
-            return send_file(
-                output_path,
-                as_attachment=True,
-                download_name=download_name,
-                mimetype='application/pdf'
-            )
+            if cache_key and not report.get('deduplicated'):
+                try:
+                    cache.put(cache_key, output_path)
+                except OSError as cache_error:
+                    app.logger.warning("Result cache error: %s", cache_error)
+
+            # Return the converted file for download; only the open handle outlives the scratch directory
+            response = send_download(output_path, download_name, cleanup=workdir.cleanup)
+            if cache_key:
+                response.headers['X-Cache'] = 'MISS'
+            response.headers['X-PDFUA-Preset'] = preset.label
+            return response
         else:
-            return jsonify({'error': message}), 500
+            return failure_response(message, report['error_code'], report.get('negative_cache'))
 
+    except Rejected as e:
+        return busy_response(str(e), e.retry_after, e.reason)
     except Exception as e:
         return jsonify({'error': f'Processing error: {str(e)}'}), 500
     finally:
         # Clean up temporary files
+        if not submitted:
+            workdir.cleanup()
+
+
+def stream_requested():
+    """Whether the `stream` form field or query parameter (or the configured default) asks for streaming"""
+    value = request.values.get('stream')
+    if value is None:
+        return app.config['STREAM_OUTPUT']
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def attachment_disposition(download_name):
+    """Content-Disposition header value for a download, built the way send_file() builds it"""
+    try:
+        download_name.encode('ascii')
+        options = {'filename': download_name}
+    except UnicodeEncodeError:
+        options = {
+            'filename': unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii'),
+            'filename*': f"UTF-8''{quote(download_name, safe='!#$&+-.^_`|~')}",
+        }
+    return dump_options_header('attachment', options)
+
+
+class StreamAborted(Exception):
+    """Raised from a streaming response body to break it off after a late failure"""
+
+
+def stream_conversion(workdir, input_path, filename, preset, cache_key, input_sha256):
+    """
+    Convert as a job and send the output while Ghostscript is still appending to it
+    The job starts right away and waits for a slot like a /convert request, so it gets
+    the same 429 when MAX_QUEUE_WAIT passes first. Nothing is sent until STREAM_COMMIT_BYTES of output exist, so a conversion that fails
+    or finishes before that gets the same response as without streaming. Once streaming
+    has begun the status is 200 and chunked; a later failure breaks the response off
+    before its final chunk, and the job status named in X-PDFUA-Status-URL tells why.
+    """
+    manager = get_job_manager()
+    done = threading.Event()
+    summary, estimate = read_document(input_path, preset)
+    job = manager.start(input_path, workdir.file('output.pdf'), filename, on_done=lambda job: done.set(),
+                        options={'preset': preset.name}, estimate=estimate, workdir=workdir,
+                        context={'input_sha256': input_sha256, 'summary': summary, 'bounded': True})
+
+    commit_bytes = app.config['STREAM_COMMIT_BYTES']
+    while not done.wait(STREAM_POLL_INTERVAL):
+        try:
+            if os.path.getsize(job.output_path) >= commit_bytes:
+                break
+        except FileNotFoundError:
+            pass
+
+    headers = {'X-PDFUA-Preset': preset.label}
+    if cache_key:
+        headers['X-Cache'] = 'MISS'
+    if done.is_set():
+        if job.report.get('error_code') == 'busy':
+            manager.discard(job)
+            return busy_response(job.message, job.report['retry_after'], job.report['busy_reason'])
+        STREAMED_RESPONSES.inc(outcome='finished')
+        if job.state != 'succeeded':
+            manager.discard(job)
+            return failure_response(job.message, job.report.get('error_code'), job.report.get('negative_cache'))
+        cache_job_output(job, cache_key)
+        response = send_download(job.output_path, f"pdfua_{filename}", cleanup=lambda: manager.discard(job))
+        response.headers.update(headers)
+        return response
+
+    headers.update({
+        'Content-Disposition': attachment_disposition(f"pdfua_{filename}"),
+        'X-PDFUA-Job-Id': job.id,
+        'X-PDFUA-Status-URL': url_for('job_status', job_id=job.id),
+    })
+    return timed_send(Response(stream_job_output(job, done, cache_key), mimetype='application/pdf',
+                               headers=headers))
+
+
+def stream_job_output(job, done, cache_key):
+    """Yield a running job's output as it is written; see stream_conversion"""
+    manager = get_job_manager()
+    digest = hashlib.sha256()
+    sent = 0
+    finished = False
+    try:
+        with open(job.output_path, 'rb') as output:
+            while True:
+                chunk = output.read(STREAM_CHUNK_SIZE)
+                if chunk:
+                    digest.update(chunk)
+                    sent += len(chunk)
+                    yield chunk
+                elif finished:
+                    break
+                else:
+                    finished = done.wait(STREAM_POLL_INTERVAL)
+
+        if job.state == 'succeeded' and (os.path.getsize(job.output_path) != sent
+                                         or file_sha256(job.output_path) != digest.hexdigest()):
+            # Only an output written strictly front to back can be sent before it's finished
+            job.report['stream_error'] = "Output was rewritten after part of it had been sent"
+        if job.state != 'succeeded' or 'stream_error' in job.report:
+            STREAMED_RESPONSES.inc(outcome='aborted')
+            raise StreamAborted(job.report.get('stream_error') or job.message)
+        STREAMED_RESPONSES.inc(outcome='streamed')
+        cache_job_output(job, cache_key)
+    finally:
+        # The status stays available for clients whose stream was broken off
+        manager.discard(job, keep_status=True)
+
+
+def cache_job_output(job, cache_key):
+    """Put a finished job's output in the result cache unless it came from another conversion"""
+    if cache_key and not job.report.get('deduplicated'):
         try:
-            if input_path and os.path.exists(input_path):
-                os.unlink(input_path)
-            if output_path and os.path.exists(output_path):
-                # Only delete output file if we're returning an error
-                if not success:
-                    os.unlink(output_path)
-                # If success, the file will be deleted after being sent by send_file
-        except Exception as cleanup_error:
-            print(f"Cleanup error: {cleanup_error}")
+            get_result_cache().put(cache_key, job.output_path)
+        except OSError as cache_error:
+            app.logger.warning("Result cache error: %s", cache_error)
+
+
+@app.route('/convert/batch', methods=['POST'])
+def convert_batch():
+    try:
+        get_admission().check_storage()
+    except Rejected as e:
+        return busy_response(str(e), e.retry_after, e.reason)
+
+    files = spooled_uploads().getlist('pdf_file')
+    if not files:
+        return jsonify({'error': 'No file uploaded'}), 400
+    preset, error_response = get_requested_preset()
+    if error_response:
+        return error_response
+
+    manager = get_job_manager()
+    finished = queue.Queue()
+    manifest = []
+    waiting = collections.deque()  # uploads not handed to the job manager yet
+    pending = set()
+    archive_names = set()
+
+    for file in files:
+        entry = {'filename': file.filename, 'status': 'failed', 'archive_name': None, 'error': None,
+                 'error_code': None}
+        manifest.append(entry)
+
+        error = validate_pdf_upload(file)
+        if error:
+            entry['error'] = error
+            continue
+
+        # Keep archive member names unique when the same filename is uploaded twice
+        stem, ext = os.path.splitext(f"pdfua_{os.path.basename(file.filename)}")
+        name, n = f"{stem}{ext}", 1
+        while name in archive_names:
+            n += 1
+            name = f"{stem}-{n}{ext}"
+        archive_names.add(name)
+        entry['archive_name'] = name
+        waiting.append((entry, file.stream.workdir, file.stream.sha256, file.stream.detach()))
+
+    def submit_waiting():
+        """Queue uploads until the batch has as many jobs in flight as there are job workers"""
+        while waiting and len(pending) < manager.workers:
+            entry, workdir, input_sha256, input_path = waiting.popleft()
+            summary, estimate = read_document(input_path, preset)
+            try:
+                job = manager.submit(input_path, workdir.file('output.pdf'), entry['filename'],
+                                     on_done=lambda job, entry=entry: finished.put((job, entry)),
+                                     options={'preset': preset.name}, estimate=estimate, workdir=workdir,
+                                     context={'input_sha256': input_sha256, 'summary': summary})
+            except QueueFull:
+                workdir.cleanup()
+                entry.update(error='Conversion queue is full, try again later', error_code='busy',
+                             archive_name=None)
+                continue
+            pending.add(job)
+
+    def discard_remaining():
+        # Client went away early, or never started reading: nobody will collect the rest
+        for job in pending:
+            manager.discard(job)
+        for _, workdir, _, _ in waiting:
+            workdir.cleanup()
+        pending.clear()
+        waiting.clear()
+
+    submit_waiting()
+
+    def generate():
+        sink = ZipSink()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+            # Members are written in completion order. The next upload is only queued once a
+            # result has been collected, so a batch never has more outputs on disk than workers
+            while pending:
+                job, entry = finished.get()
+                if job.state == 'succeeded':
+                    entry['status'] = 'succeeded'
+                    with open(job.output_path, 'rb') as src, archive.open(entry['archive_name'], 'w') as dest:
+                        for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b''):
+                            dest.write(chunk)
+                            yield sink.drain()
+                else:
+                    entry['error'] = job.message
+                    entry['error_code'] = job.report.get('error_code')
+                    entry['archive_name'] = None
+                # Only now: a client that leaves while this member is written still has it discarded
+                manager.discard(job)
+                pending.discard(job)
+                submit_waiting()
+                yield sink.drain()
+
+            archive.writestr('manifest.json', json.dumps({'preset': preset.label, 'files': manifest}, indent=2))
+        yield sink.drain()
+
+    response = timed_send(Response(
+        generate(),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename="pdfua_batch.zip"'}
+    ))
+    response.call_on_close(discard_remaining)
+    return response
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    try:
+        get_admission().check_storage()
+    except Rejected as e:
+        return busy_response(str(e), e.retry_after, e.reason)
+
+    file, error_response = get_uploaded_pdf()
+    if error_response:
+        return error_response
+    preset, error_response = get_requested_preset()
+    if error_response:
+        return error_response
+
+    workdir = file.stream.workdir
+    input_sha256 = file.stream.sha256
+    input_path = file.stream.detach()
+    summary, estimate = read_document(input_path, preset)
+    try:
+        job = get_job_manager().submit(input_path, workdir.file('output.pdf'), file.filename,
+                                       options={'preset': preset.name}, estimate=estimate, workdir=workdir,
+                                       context={'input_sha256': input_sha256, 'summary': summary})
+    except QueueFull:
+        workdir.cleanup()
+        return queue_full_response()
+
+    status = job.to_dict()
+    status['queue_position'] = get_job_manager().queue_position(job)
+    status['eta_seconds'] = get_job_manager().eta(job)
+    status['status_url'] = url_for('job_status', job_id=job.id)
+    status['result_url'] = url_for('job_result', job_id=job.id)
+    return jsonify(status), 202, {'Location': status['status_url']}
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    status = job.to_dict()
+    status['queue_position'] = get_job_manager().queue_position(job)
+    status['eta_seconds'] = get_job_manager().eta(job)
+    if job.report.get('stream_error'):
+        status['stream_error'] = job.report['stream_error']
+    if job.state == 'succeeded' and not job.collected:
+        status['result_url'] = url_for('job_result', job_id=job.id)
+    return jsonify(status)
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    if job.state == 'failed':
+        return failure_response(job.message, job.report.get('error_code'))
+    if job.state != 'succeeded':
+        return jsonify({'error': f'Job is {job.state}', 'state': job.state}), 409
+    if job.collected:
+        return jsonify({'error': 'Job result was streamed to the client and is no longer kept'}), 410
+
+    return send_download(job.output_path, f"pdfua_{job.filename}")
+
+
+@app.route('/estimate', methods=['POST'])
+def estimate_conversion():
+    file, error_response = get_uploaded_pdf()
+    if error_response:
+        return error_response
+    preset, error_response = get_requested_preset()
+    if error_response:
+        return error_response
+
+    workdir = file.stream.workdir
+    try:
+        summary = preflight_document(file.stream.detach())
+    finally:
+        workdir.cleanup()
+    if not summary:
+        return jsonify({'error': "Document structure could not be read"}), 422
+    return jsonify({'preset': preset.label, 'estimate': estimate_cost(summary, preset), 'preflight': summary})
+
+
+@app.route('/status', methods=['GET'])
+def service_status():
+    manager = get_job_manager()
+    return jsonify({
+        'admission': get_admission().stats(),
+        'scratch': get_scratch().stats(),
+        'jobs': {
+            'queue_depth': manager.queue_depth(),
+            'max_queue_depth': manager.max_queue,
+            'rejected_total': manager.rejected,
+        },
+    })
+
+
+def admin_authorized():
+    """Whether the request carries the configured admin token"""
+    token = app.config['ADMIN_TOKEN']
+    supplied = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(supplied.encode(), f'Bearer {token}'.encode())
+
+
+@app.route('/admin/negative-cache', methods=['DELETE'])
+def purge_negative_cache():
+    """Forget cached failures: all of them, or those of one input with ?sha256="""
+    if not admin_authorized():
+        return jsonify({'error': 'Admin token required'}), 403
+    negative_cache = get_negative_cache()
+    if negative_cache is None:
+        return jsonify({'purged': 0})
+    sha256 = request.args.get('sha256')
+    if sha256 is not None:
+        sha256 = sha256.strip().lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', sha256):
+            return jsonify({'error': 'sha256 must be 64 hexadecimal digits'}), 400
+    return jsonify({'purged': negative_cache.purge(sha256)})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.cli.command('refit-cost-model')
+def refit_cost_model():
+    """Refit the conversion cost model from the recorded history and print its prediction error"""
+    report = refit(get_cost_history(), os.path.join(app.config['COST_MODEL_DIR'], 'model.json'),
+                   max_records=app.config['COST_HISTORY_MAX_RECORDS'])
+    print(json.dumps(report, indent=2))
 
 
 @app.errorhandler(413)
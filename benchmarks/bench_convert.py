@@ -0,0 +1,295 @@
+"""
+Benchmark convert_to_pdfua over a fixed corpus
+
+The corpus is a directory with one sub-directory per document class, e.g.
+
+    benchmarks/corpus/text-only/*.pdf
+    benchmarks/corpus/image-heavy/*.pdf
+    benchmarks/corpus/scanned/*.pdf
+    benchmarks/corpus/many-fonts/*.pdf
+    benchmarks/corpus/transparency/*.pdf
+    benchmarks/corpus/large-page-count/*.pdf
+
+which is what `python -m benchmarks.synthetic_pdf --corpus benchmarks/corpus`
+generates.
+
+Every document is converted `--repeat` times after `--warmup` untimed runs.
+Wall time, CPU time, peak RSS and the output/input size ratio are summarised
+as percentiles per document and per class, and written as JSON. The corpus
+files' hashes are recorded too, so a comparison against `--baseline`
+refuses to compare runs over different inputs unless `--force` is given.
+The conversions record their cost in a history of their own, so benchmark
+runs never end up in the server's cost model.
+
+With `--split`, every document long enough for more than one page range is
+also converted both in one pass and split into ranges, and the ratio of the
+two p50 wall times is reported as the split's speedup.
+
+    python -m benchmarks.bench_convert --output bench.json
+    python -m benchmarks.bench_convert --baseline bench.json --threshold 0.1
+    python -m benchmarks.bench_convert --classes large-page-count --split
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+PERCENTILES = (50, 90, 99)
+METRICS = ('wall_seconds', 'cpu_seconds', 'peak_rss_bytes', 'size_ratio')
+
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a non-empty list"""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values):
+    if not values:
+        return None
+    summary = {f'p{pct}': percentile(values, pct) for pct in PERCENTILES}
+    summary.update({'mean': statistics.fmean(values), 'min': min(values), 'max': max(values)})
+    return summary
+
+
+def load_corpus(corpus_dir):
+    """Map document class -> sorted list of PDF paths"""
+    corpus = {}
+    for doc_class in sorted(os.listdir(corpus_dir)):
+        class_dir = os.path.join(corpus_dir, doc_class)
+        if not os.path.isdir(class_dir):
+            continue
+        paths = sorted(os.path.join(class_dir, name) for name in os.listdir(class_dir)
+                       if name.lower().endswith('.pdf'))
+        if paths:
+            corpus[doc_class] = paths
+    return corpus
+
+
+def sha256_of(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def measure(convert, input_path, scratch_dir, preset):
+    """Convert once and return one sample of every metric; a failed conversion aborts the run"""
+    output_path = os.path.join(scratch_dir, 'out.pdf')
+    report = {}
+    started = time.perf_counter()
+    success, message = convert(input_path, output_path, report, preset)
+    wall_seconds = time.perf_counter() - started
+    if not success:
+        raise RuntimeError(f"{input_path}: {message}")
+    usage = report.get('usage') or {}
+    sample = {
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': usage.get('user_cpu_seconds', 0) + usage.get('system_cpu_seconds', 0),
+        'peak_rss_bytes': usage.get('peak_rss_bytes', 0),
+        'size_ratio': os.path.getsize(output_path) / os.path.getsize(input_path),
+    }
+    os.unlink(output_path)
+    return sample
+
+
+def run_benchmark(corpus, convert, repeat, warmup, preset=None):
+    scratch_dir = tempfile.mkdtemp(prefix='pdfua-bench-')
+    try:
+        documents = {}
+        classes = {}
+        for doc_class, paths in corpus.items():
+            class_samples = {metric: [] for metric in METRICS}
+            for path in paths:
+                for _ in range(warmup):
+                    measure(convert, path, scratch_dir, preset)
+                samples = [measure(convert, path, scratch_dir, preset) for _ in range(repeat)]
+                name = os.path.relpath(path, os.path.dirname(os.path.dirname(path)))
+                documents[name] = {
+                    'class': doc_class,
+                    'sha256': sha256_of(path),
+                    'input_bytes': os.path.getsize(path),
+                    **{metric: summarize([s[metric] for s in samples]) for metric in METRICS},
+                }
+                for metric in METRICS:
+                    class_samples[metric].extend(s[metric] for s in samples)
+                print(f"{name}: p50 wall {documents[name]['wall_seconds']['p50']:.3f}s", file=sys.stderr)
+            classes[doc_class] = {metric: summarize(values) for metric, values in class_samples.items()}
+        return documents, classes
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def split_comparison(app_module, corpus, repeat, warmup, preset=None):
+    """
+    Convert every document that can be split both in one pass and in page ranges
+    Returns {document: dict} with the page count, the number of ranges, p50 wall and CPU
+    time of both ways, and 'speedup', the one-pass p50 wall time over the split one
+    """
+    config = app_module.app.config
+    saved = config['SPLIT_MIN_PAGES']
+    scratch_dir = tempfile.mkdtemp(prefix='pdfua-bench-')
+    comparison = {}
+    try:
+        for doc_class, paths in corpus.items():
+            for path in paths:
+                config['SPLIT_MIN_PAGES'] = 1
+                page_count = app_module.split_page_count(path)
+                if not page_count:
+                    continue
+                runs = {}
+                # SPLIT_MIN_PAGES 0 turns splitting off, 1 splits whatever makes more than one range
+                for mode, min_pages in (('single', 0), ('split', 1)):
+                    config['SPLIT_MIN_PAGES'] = min_pages
+                    for _ in range(warmup):
+                        measure(app_module.convert_to_pdfua, path, scratch_dir, preset)
+                    samples = [measure(app_module.convert_to_pdfua, path, scratch_dir, preset)
+                               for _ in range(repeat)]
+                    runs[mode] = {metric: summarize([s[metric] for s in samples])['p50']
+                                  for metric in ('wall_seconds', 'cpu_seconds')}
+                name = os.path.relpath(path, os.path.dirname(os.path.dirname(path)))
+                split_wall = runs['split']['wall_seconds']
+                comparison[name] = {
+                    'class': doc_class,
+                    'pages': page_count,
+                    'ranges': app_module.split_slots(page_count),
+                    **runs,
+                    'speedup': round(runs['single']['wall_seconds'] / split_wall, 2) if split_wall else None,
+                }
+                print(f"{name}: {comparison[name]['ranges']} ranges, speedup {comparison[name]['speedup']}x",
+                      file=sys.stderr)
+        return comparison
+    finally:
+        config['SPLIT_MIN_PAGES'] = saved
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def environment(app_module, preset):
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'engine': app_module.app.config['GS_ENGINE'],
+        'ghostscript': app_module.ghostscript_version(app_module.GS_BINARY),
+        'preset': preset.label,
+        'flags_digest': app_module.get_flags_digest(preset),
+    }
+
+
+def compare(current, baseline, threshold, force=False):
+    """
+    Compare each class's p50 of every metric against a baseline result
+    Returns (report lines, regressed: bool); a different corpus counts as a regression unless `force`
+    """
+    lines = []
+    regressed = False
+    baseline_hashes = {name: doc['sha256'] for name, doc in baseline['documents'].items()}
+    current_hashes = {name: doc['sha256'] for name, doc in current['documents'].items()}
+    if baseline_hashes != current_hashes:
+        if not force:
+            return ["error: corpus differs from the baseline; pass --force to compare anyway"], True
+        lines.append("warning: corpus differs from the baseline; comparing classes anyway")
+    baseline_preset = baseline['environment'].get('preset')
+    if baseline_preset != current['environment']['preset']:
+        lines.append(f"comparing preset {current['environment']['preset']} against {baseline_preset}")
+    for doc_class, summary in sorted(current['classes'].items()):
+        base = baseline['classes'].get(doc_class)
+        if not base:
+            lines.append(f"{doc_class}: no baseline")
+            continue
+        for metric in METRICS:
+            old, new = base[metric]['p50'], summary[metric]['p50']
+            change = (new - old) / old if old else 0.0
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressed = True
+            elif change < -threshold:
+                flag = '  improvement'
+            lines.append(f"{doc_class:>20} {metric:>14} p50 {old:12.4g} -> {new:12.4g} ({change:+.1%}){flag}")
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help="corpus directory (one sub-directory per class)")
+    parser.add_argument('--classes', nargs='*', help="only benchmark these document classes")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per document")
+    parser.add_argument('--warmup', type=int, default=1, help="untimed runs per document")
+    parser.add_argument('--engine', choices=['subprocess', 'pool', 'gsapi'], help="conversion engine to benchmark")
+    parser.add_argument('--preset', help="conversion preset to benchmark (default: the server default)")
+    parser.add_argument('--output', help="write results as JSON to this file (default: stdout)")
+    parser.add_argument('--baseline', help="compare against a previous JSON result")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="relative p50 increase reported as a regression")
+    parser.add_argument('--force', action='store_true', help="compare against a baseline over a different corpus")
+    parser.add_argument('--split', action='store_true',
+                        help="also compare splitting into page ranges with one pass for documents that can be split")
+    args = parser.parse_args(argv)
+
+    import app as app_module
+    cost_model_dir = tempfile.mkdtemp(prefix='pdfua-bench-cost-')
+    app_module.app.config['COST_MODEL_DIR'] = cost_model_dir
+    if args.engine:
+        app_module.app.config['GS_ENGINE'] = args.engine
+
+    preset = app_module.get_preset(args.preset)
+    if preset is None:
+        parser.error(f"unknown preset {args.preset!r}; choose from {', '.join(sorted(app_module.PRESETS))}")
+
+    corpus = load_corpus(args.corpus)
+    if args.classes:
+        corpus = {name: paths for name, paths in corpus.items() if name in args.classes}
+    if not corpus:
+        parser.error(f"no PDFs found under {args.corpus}")
+
+    try:
+        documents, classes = run_benchmark(corpus, app_module.convert_to_pdfua, args.repeat, args.warmup,
+                                           preset.name)
+        split = split_comparison(app_module, corpus, args.repeat, args.warmup, preset.name) if args.split else None
+    finally:
+        shutil.rmtree(cost_model_dir, ignore_errors=True)
+    result = {
+        'environment': environment(app_module, preset),
+        'settings': {'repeat': args.repeat, 'warmup': args.warmup},
+        'classes': classes,
+        'documents': documents,
+    }
+    if split is not None:
+        result['split'] = split
+        result['settings'].update(split_workers=app_module.app.config['SPLIT_WORKERS'],
+                                  split_min_range_pages=app_module.app.config['SPLIT_MIN_RANGE_PAGES'])
+
+    data = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressed = compare(result, baseline, args.threshold, args.force)
+        print('\n'.join(lines), file=sys.stderr)
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
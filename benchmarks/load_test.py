@@ -0,0 +1,463 @@
+"""
+Closed-loop HTTP load generator for a running pdfua-service
+
+Worker threads send a weighted mix of requests (`/convert`, the job API,
+`/convert/batch`, `/status`) built from the benchmark corpus. With
+`--concurrency` each worker sends its next request as soon as the previous
+one finishes; with `--rate` the workers additionally wait for their slot in
+a fixed schedule, and latencies are measured from the scheduled start so a
+slow server can't hide queueing delay. `--sweep` runs one step per
+concurrency level to find the knee of the throughput curve.
+
+Every upload gets a unique comment appended after its last %%EOF, so the
+server's result cache, single-flight sharing and failure cache never see the
+same bytes twice and each request pays for a real conversion. `--repeat`
+sends the corpus files unchanged instead, to measure the caches. Either way
+the `X-Cache` header of each `/convert` response is recorded and the hit
+rate is reported next to the latencies.
+
+While the load runs, `/status` and `/metrics` are sampled to record the
+server's admission and job queue depths and Ghostscript CPU use over time.
+Latencies are reported per scenario and per document class, and `--baseline`
+compares them with an earlier run, e.g. one against a server using the
+other scheduler.
+
+    python -m benchmarks.load_test --url http://localhost:5000 --concurrency 8 --duration 60
+    python -m benchmarks.load_test --sweep 1,2,4,8,16 --duration 30 --output load.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from benchmarks.bench_convert import DEFAULT_CORPUS, load_corpus, summarize
+
+DEFAULT_MIX = 'convert=1'
+JOB_POLL_INTERVAL = 0.2
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise ValueError(f"unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def with_nonce(data):
+    """A copy of a document that no server-side cache has seen: a comment after its last %%EOF"""
+    return data + f'\n%pdfua-load-test {uuid.uuid4().hex}\n'.encode('ascii')
+
+
+def multipart(files, fields=None):
+    """Encode `files` [(filename, data)] as multipart/form-data `pdf_file` parts, plus form `fields`"""
+    boundary = uuid.uuid4().hex
+    body = bytearray()
+    for name, value in (fields or {}).items():
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                 f'{value}\r\n').encode()
+    for filename, data in files:
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="pdf_file"; '
+                 f'filename="{filename}"\r\nContent-Type: application/pdf\r\n\r\n').encode()
+        body += data + b'\r\n'
+    body += f'--{boundary}--\r\n'.encode()
+    return bytes(body), f'multipart/form-data; boundary={boundary}'
+
+
+class Client:
+    """One keep-alive connection per worker thread"""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.netloc
+        self.https = parts.scheme == 'https'
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        """Returns (status, body bytes, headers); reconnects once on a dropped connection"""
+        for attempt in range(2):
+            if self.conn is None:
+                cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+                self.conn = cls(self.host, timeout=self.timeout)
+            try:
+                self.conn.request(method, self.prefix + path, body=body, headers=headers or {})
+                response = self.conn.getresponse()
+                data = response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.close()
+                return response.status, data, response
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+# Scenarios return (status, document class or None when several documents were sent,
+# X-Cache header or None); `prepare` turns a corpus file's bytes into the upload
+
+def run_convert(client, documents, rng, fields, prepare):
+    doc_class, filename, data = rng.choice(documents)
+    body, content_type = multipart([(filename, prepare(data))], fields)
+    status, _, response = client.request('POST', '/convert', body, {'Content-Type': content_type})
+    return status, doc_class, response.getheader('X-Cache')
+
+
+def run_job(client, documents, rng, fields, prepare):
+    doc_class, filename, data = rng.choice(documents)
+    return _run_job(client, filename, prepare(data), fields), doc_class, None
+
+
+def _run_job(client, filename, data, fields):
+    body, content_type = multipart([(filename, data)], fields)
+    status, payload, _ = client.request('POST', '/jobs', body, {'Content-Type': content_type})
+    if status != 202:
+        return status
+    job_id = json.loads(payload)['job_id']
+    while True:
+        time.sleep(JOB_POLL_INTERVAL)
+        status, payload, _ = client.request('GET', f'/jobs/{job_id}')
+        if status != 200:
+            return status
+        state = json.loads(payload)['state']
+        if state == 'failed':
+            return 'job_failed'
+        if state == 'succeeded':
+            status, _, _ = client.request('GET', f'/jobs/{job_id}/result')
+            return status
+
+
+def run_batch(client, documents, rng, fields, prepare, size=4):
+    sample = rng.sample(documents, min(size, len(documents)))
+    body, content_type = multipart([(filename, prepare(data)) for _, filename, data in sample], fields)
+    status, _, _ = client.request('POST', '/convert/batch', body, {'Content-Type': content_type})
+    return status, None, None
+
+
+def run_status(client, documents, rng, fields, prepare):
+    status, _, _ = client.request('GET', '/status')
+    return status, None, None
+
+
+SCENARIOS = {'convert': run_convert, 'jobs': run_job, 'batch': run_batch, 'status': run_status}
+
+
+class Recorder:
+    """Thread-safe store of per-request outcomes"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (finished_at, scenario, status, latency, schedule_delay, document class, X-Cache)
+        self.results = []
+
+    def add(self, *result):
+        with self.lock:
+            self.results.append(result)
+
+    def since(self, start):
+        with self.lock:
+            return [r for r in self.results if r[0] >= start]
+
+
+def _server_sample(client):
+    """Queue depths from /status and cumulative Ghostscript CPU seconds from /metrics"""
+    sample = {}
+    try:
+        status, payload, _ = client.request('GET', '/status')
+        if status == 200:
+            data = json.loads(payload)
+            sample['active'] = data['admission']['active']
+            sample['admission_queue'] = data['admission']['queue_depth']
+            sample['job_queue'] = data['jobs']['queue_depth']
+        status, payload, _ = client.request('GET', '/metrics')
+        if status == 200:
+            sample['gs_cpu_seconds'] = sum(
+                float(line.rsplit(' ', 1)[1]) for line in payload.decode().splitlines()
+                if line.startswith('pdfua_ghostscript_cpu_seconds_sum')
+            )
+    except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+        sample['error'] = str(e)
+    return sample
+
+
+def _process_cpu_seconds(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        # utime, stime and the reaped children's cutime, cstime
+        return sum(int(value) for value in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _is_error(status):
+    return not (isinstance(status, int) and 200 <= status < 300)
+
+
+def _cache_stats(results):
+    """Result cache hits and misses among the responses that reported one"""
+    hits = sum(1 for r in results if r[6] == 'HIT')
+    misses = sum(1 for r in results if r[6] == 'MISS')
+    return {'hits': hits, 'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None}
+
+
+def run_step(args, documents, mix, concurrency, rate, seed):
+    """Drive the server for `args.duration` seconds; returns the step summary"""
+    recorder = Recorder()
+    stop = threading.Event()
+    schedule_lock = threading.Lock()
+    schedule = {'next': None}
+    scenarios, weights = zip(*mix.items())
+    fields = {'preset': args.preset} if args.preset else {}
+    prepare = (lambda data: data) if args.repeat else with_nonce
+
+    def next_slot():
+        """Scheduled start of the next request in rate mode"""
+        with schedule_lock:
+            now = time.perf_counter()
+            slot = schedule['next'] if schedule['next'] is not None else now
+            schedule['next'] = slot + 1.0 / rate
+            return slot
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        client = Client(args.url, args.timeout)
+        try:
+            while not stop.is_set():
+                scheduled = None
+                if rate:
+                    scheduled = next_slot()
+                    delay = scheduled - time.perf_counter()
+                    if delay > 0 and stop.wait(delay):
+                        break
+                scenario = rng.choices(scenarios, weights)[0]
+                started = time.perf_counter()
+                try:
+                    status, doc_class, cache = SCENARIOS[scenario](client, documents, rng, fields, prepare)
+                except (OSError, http.client.HTTPException) as e:
+                    client.close()
+                    status, doc_class, cache = type(e).__name__, None, None
+                finished = time.perf_counter()
+                begin = scheduled if scheduled is not None else started
+                recorder.add(finished, scenario, status, finished - begin, started - begin, doc_class, cache)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    step_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    timeline = []
+    monitor = Client(args.url, args.timeout)
+    previous = _server_sample(monitor)
+    previous_cpu = _process_cpu_seconds(args.server_pid) if args.server_pid else None
+    interval_start = step_start
+    deadline = step_start + args.duration
+    while time.perf_counter() < deadline:
+        time.sleep(min(args.interval, max(0.0, deadline - time.perf_counter())))
+        now = time.perf_counter()
+        sample = _server_sample(monitor)
+        results = [r for r in recorder.since(interval_start) if r[0] < now]
+        latencies = [r[3] for r in results]
+        point = {
+            't': round(now - step_start, 3),
+            'requests': len(results),
+            'throughput': round(len(results) / (now - interval_start), 3),
+            'errors': sum(1 for r in results if _is_error(r[2])),
+            'latency_p50': summarize(latencies)['p50'] if latencies else None,
+            'active': sample.get('active'),
+            'admission_queue': sample.get('admission_queue'),
+            'job_queue': sample.get('job_queue'),
+        }
+        if 'gs_cpu_seconds' in sample and 'gs_cpu_seconds' in previous:
+            point['gs_cpu_cores'] = round((sample['gs_cpu_seconds'] - previous['gs_cpu_seconds'])
+                                          / (now - interval_start), 3)
+        if args.server_pid:
+            cpu = _process_cpu_seconds(args.server_pid)
+            if cpu is not None and previous_cpu is not None:
+                point['server_cpu_cores'] = round((cpu - previous_cpu) / (now - interval_start), 3)
+            previous_cpu = cpu
+        timeline.append(point)
+        print(f"  t={point['t']:7.1f}s  {point['throughput']:7.2f} req/s  errors {point['errors']:4d}  "
+              f"active {point['active']}  queued {point['admission_queue']}/{point['job_queue']}",
+              file=sys.stderr)
+        previous = sample if 'gs_cpu_seconds' in sample else previous
+        interval_start = now
+
+    stop.set()
+    for thread in threads:
+        thread.join(args.timeout)
+    monitor.close()
+
+    results = [r for r in recorder.since(step_start) if r[0] <= deadline]
+    elapsed = min(time.perf_counter(), deadline) - step_start
+    statuses = {}
+    for r in results:
+        statuses[str(r[2])] = statuses.get(str(r[2]), 0) + 1
+    ok = [r for r in results if not _is_error(r[2])]
+    errors = len(results) - len(ok)
+    by_scenario = {}
+    for scenario in mix:
+        latencies = [r[3] for r in ok if r[1] == scenario]
+        by_scenario[scenario] = {'requests': sum(1 for r in results if r[1] == scenario),
+                                 'latency_seconds': summarize(latencies)}
+    by_class = {}
+    for doc_class in sorted({r[5] for r in results if r[5]}):
+        latencies = [r[3] for r in ok if r[5] == doc_class]
+        by_class[doc_class] = {'requests': sum(1 for r in results if r[5] == doc_class),
+                               'latency_seconds': summarize(latencies)}
+    return {
+        'concurrency': concurrency,
+        'target_rate': rate,
+        'duration_seconds': round(elapsed, 3),
+        'requests': len(results),
+        'throughput': round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        'error_rate': round(errors / len(results), 4) if results else 0.0,
+        'statuses': statuses,
+        'cache': _cache_stats(results),
+        'latency_seconds': summarize([r[3] for r in ok]),
+        'schedule_delay_seconds': summarize([r[4] for r in results]) if rate else None,
+        'scenarios': by_scenario,
+        'classes': by_class,
+        'timeline': timeline,
+    }
+
+
+def load_documents(corpus_dir, classes=None):
+    documents = []
+    for doc_class, paths in load_corpus(corpus_dir).items():
+        if classes and doc_class not in classes:
+            continue
+        for path in paths:
+            with open(path, 'rb') as f:
+                documents.append((doc_class, os.path.basename(path), f.read()))
+    return documents
+
+
+def server_settings(url, timeout):
+    """Scheduler and limits the server reports in /status, so runs can be told apart later"""
+    client = Client(url, timeout)
+    try:
+        status, payload, _ = client.request('GET', '/status')
+        admission = json.loads(payload)['admission'] if status == 200 else {}
+    except (OSError, http.client.HTTPException, ValueError, KeyError):
+        admission = {}
+    finally:
+        client.close()
+    return {key: admission.get(key) for key in ('scheduler', 'max_concurrent', 'max_queue_depth')}
+
+
+def compare(current, baseline):
+    """Report lines comparing p50/p99 latency of each step with the baseline step at the same concurrency"""
+    lines = [f"scheduler {baseline['settings'].get('server', {}).get('scheduler')} -> "
+             f"{current['settings'].get('server', {}).get('scheduler')}"]
+    baseline_steps = {step['concurrency']: step for step in baseline['steps']}
+    for step in current['steps']:
+        base = baseline_steps.get(step['concurrency'])
+        if not base:
+            lines.append(f"concurrency {step['concurrency']}: no baseline")
+            continue
+        old_hits, new_hits = base.get('cache', {}).get('hit_rate'), step['cache']['hit_rate']
+        if old_hits or new_hits:
+            # Cache hits skip the conversion, so latencies are only comparable at similar hit rates
+            lines.append(f"{step['concurrency']:>5} {'cache hit rate':>20}  {old_hits} -> {new_hits}")
+        groups = [('all', base['latency_seconds'], step['latency_seconds'])]
+        for key in ('scenarios', 'classes'):
+            for name, entry in sorted(step.get(key, {}).items()):
+                if name in base.get(key, {}):
+                    groups.append((name, base[key][name]['latency_seconds'], entry['latency_seconds']))
+        for name, old, new in groups:
+            if not old or not new:
+                continue
+            changes = []
+            for pct in ('p50', 'p99'):
+                change = (new[pct] - old[pct]) / old[pct] if old[pct] else 0.0
+                changes.append(f"{pct} {old[pct]:8.3f} -> {new[pct]:8.3f} ({change:+.1%})")
+            lines.append(f"{step['concurrency']:>5} {name:>20}  " + '  '.join(changes))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="base URL of the service")
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help="corpus directory (one sub-directory per class)")
+    parser.add_argument('--classes', nargs='*', help="only send documents of these classes")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="weighted scenarios, e.g. convert=8,jobs=1,batch=1,status=1")
+    parser.add_argument('--preset', help="conversion preset requested with every upload")
+    parser.add_argument('--repeat', action='store_true',
+                        help="send corpus files unchanged, so server caches can answer repeats")
+    parser.add_argument('--concurrency', type=int, default=4, help="worker threads (requests in flight)")
+    parser.add_argument('--rate', type=float, help="target requests per second across all workers")
+    parser.add_argument('--sweep', help="comma-separated concurrency levels, one step each")
+    parser.add_argument('--duration', type=float, default=60, help="seconds per step")
+    parser.add_argument('--interval', type=float, default=5, help="seconds between timeline samples")
+    parser.add_argument('--timeout', type=float, default=600, help="per-request socket timeout")
+    parser.add_argument('--server-pid', type=int, help="also sample this local server process's CPU use")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write results as JSON to this file (default: stdout)")
+    parser.add_argument('--baseline', help="compare latencies against a previous JSON result")
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    documents = load_documents(args.corpus, args.classes)
+    if not documents and set(mix) != {'status'}:
+        parser.error(f"no PDFs found under {args.corpus}")
+
+    levels = [int(level) for level in args.sweep.split(',')] if args.sweep else [args.concurrency]
+    server = server_settings(args.url, args.timeout)
+    steps = []
+    for level in levels:
+        print(f"concurrency {level}" + (f", target {args.rate} req/s" if args.rate else ''), file=sys.stderr)
+        steps.append(run_step(args, documents, mix, level, args.rate, args.seed))
+
+    print(f"{'conc':>5} {'req/s':>8} {'errors':>7} {'p50':>8} {'p90':>8} {'p99':>8} {'cache hits':>10}",
+          file=sys.stderr)
+    for step in steps:
+        latency = step['latency_seconds'] or {'p50': 0, 'p90': 0, 'p99': 0}
+        hit_rate = step['cache']['hit_rate']
+        print(f"{step['concurrency']:>5} {step['throughput']:>8.2f} {step['error_rate']:>7.1%} "
+              f"{latency['p50']:>8.3f} {latency['p90']:>8.3f} {latency['p99']:>8.3f} "
+              f"{'-' if hit_rate is None else format(hit_rate, '.1%'):>10}", file=sys.stderr)
+
+    result = {
+        'settings': {'url': args.url, 'mix': mix, 'preset': args.preset, 'rate': args.rate,
+                     'duration': args.duration, 'repeat': args.repeat,
+                     'documents': len(documents), 'seed': args.seed, 'server': server},
+        'steps': steps,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            for line in compare(result, json.load(f)):
+                print(line, file=sys.stderr)
+    data = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
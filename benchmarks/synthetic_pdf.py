@@ -0,0 +1,284 @@
+"""
+Deterministic synthetic PDFs for benchmarks and load tests
+
+Documents are built from a seed and a handful of cost parameters: page count,
+embedded (Type 3) fonts, images per page and their resolution, transparency
+groups, annotations and an optional minimum file size. The same seed and
+parameters always produce byte-identical files, so benchmark runs over a
+generated corpus are comparable without shipping real documents.
+
+    python -m benchmarks.synthetic_pdf --corpus benchmarks/corpus --seed 1
+    python -m benchmarks.synthetic_pdf --pages 50 --fonts 8 --images 2 -o doc.pdf
+"""
+
+import argparse
+import math
+import os
+import random
+import string
+import sys
+import zlib
+
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792  # US Letter in points
+LOW_NOISE = bytes(value & 0x03 for value in range(256))
+
+# Parameters of each benchmark document class; see bench_convert.py
+CLASS_PROFILES = {
+    'text-only': {'pages': 10, 'annotations': 2},
+    'image-heavy': {'pages': 5, 'images': 4, 'image_dpi': 200},
+    'scanned': {'pages': 4, 'scanned': True, 'image_dpi': 150},
+    'many-fonts': {'pages': 10, 'fonts': 40},
+    'transparency': {'pages': 5, 'images': 1, 'transparency': 6},
+    'large-page-count': {'pages': 400, 'fonts': 2},
+}
+
+
+class PdfWriter:
+    """Just enough of a PDF serializer: numbered objects and a classic xref table"""
+
+    def __init__(self):
+        self.objects = []
+        self.root = None
+        self.file_id = '00' * 16
+
+    def reserve(self):
+        self.objects.append(None)
+        return len(self.objects)
+
+    def set(self, number, body):
+        self.objects[number - 1] = body if isinstance(body, bytes) else body.encode('latin-1')
+
+    def add(self, body):
+        number = self.reserve()
+        self.set(number, body)
+        return number
+
+    def add_stream(self, dictionary, data, compress=True):
+        if compress:
+            data = zlib.compress(data, 6)
+            dictionary += ' /Filter /FlateDecode'
+        return self.add(f'<< {dictionary} /Length {len(data)} >>\nstream\n'.encode('latin-1') + data
+                        + b'\nendstream')
+
+    def write(self, path):
+        out = bytearray(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, body in enumerate(self.objects, 1):
+            offsets.append(len(out))
+            out += f'{number} 0 obj\n'.encode() + body + b'\nendobj\n'
+        xref = len(out)
+        out += f'xref\n0 {len(self.objects) + 1}\n0000000000 65535 f \n'.encode()
+        for offset in offsets:
+            out += f'{offset:010d} 00000 n \n'.encode()
+        out += (f'trailer\n<< /Size {len(self.objects) + 1} /Root {self.root} 0 R '
+                f'/ID [<{self.file_id}> <{self.file_id}>] >>\nstartxref\n{xref}\n%%EOF\n').encode()
+        with open(path, 'wb') as f:
+            f.write(out)
+        return len(out)
+
+
+def _words(rng, count):
+    return ' '.join(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(count))
+
+
+def _type3_font(writer, rng, index):
+    """A Type 3 font with randomly shaped glyphs for the space and a-z"""
+    char_procs = []
+    glyph_names = ['space', *string.ascii_lowercase]
+    for name in glyph_names:
+        if name == 'space':
+            proc = b'500 0 d0'
+        else:
+            points = ' '.join(f'{rng.randint(0, 500)} {rng.randint(0, 700)} l' for _ in range(rng.randint(3, 8)))
+            proc = f'550 0 0 0 500 700 d1 {rng.randint(0, 500)} 0 m {points} h f'.encode()
+        char_procs.append(f'/{name} {writer.add_stream("", proc)} 0 R')
+    # Codes 32..122; only the space and lower-case letters are used
+    widths = ['500'] + ['0'] * 64 + ['550'] * 26
+    differences = '32 /space 97 ' + ' '.join(f'/{name}' for name in string.ascii_lowercase)
+    return writer.add(
+        f'<< /Type /Font /Subtype /Type3 /Name /T3F{index} /FontBBox [0 0 550 700] '
+        f'/FontMatrix [0.001 0 0 0.001 0 0] /CharProcs << {" ".join(char_procs)} >> '
+        f'/Encoding << /Type /Encoding /Differences [{differences}] >> '
+        f'/FirstChar 32 /LastChar 122 /Widths [{" ".join(widths)}] /Resources << >> >>'
+    )
+
+
+def _image(writer, rng, width, height, gray=False):
+    """A photo-like image: gradients with low-amplitude noise, so it compresses realistically"""
+    components = 1 if gray else 3
+    row_bytes = width * components
+    step = rng.randint(1, 7)
+    pattern = bytes((x * step + rng.randint(0, 3)) & 0xff for x in range(row_bytes)) * 2
+    shift = rng.randint(1, 5) * components
+    rows = b''.join(pattern[(y * shift) % row_bytes:][:row_bytes] for y in range(height))
+    noise = rng.randbytes(len(rows)).translate(LOW_NOISE)
+    data = (int.from_bytes(rows, 'big') ^ int.from_bytes(noise, 'big')).to_bytes(len(rows), 'big')
+    color_space = '/DeviceGray' if gray else '/DeviceRGB'
+    return writer.add_stream(
+        f'/Type /XObject /Subtype /Image /Width {width} /Height {height} '
+        f'/ColorSpace {color_space} /BitsPerComponent 8', data
+    )
+
+
+def _padding_image(writer, rng, nbytes):
+    """An incompressible grey image of about `nbytes`, drawn at a single point"""
+    side = math.isqrt(max(nbytes, 1) - 1) + 1
+    return writer.add_stream(
+        f'/Type /XObject /Subtype /Image /Width {side} /Height {side} '
+        f'/ColorSpace /DeviceGray /BitsPerComponent 8', rng.randbytes(side * side), compress=False
+    )
+
+
+def _transparency_group(writer, rng, gstate):
+    shapes = []
+    for _ in range(3):
+        r, g, b = (rng.random() for _ in range(3))
+        x, y = rng.randint(0, 100), rng.randint(0, 100)
+        shapes.append(f'{r:.3f} {g:.3f} {b:.3f} rg {x} {y} {rng.randint(60, 140)} {rng.randint(60, 140)} re f')
+    content = f'q /GSa gs {" ".join(shapes)} Q'.encode()
+    return writer.add_stream(
+        f'/Type /XObject /Subtype /Form /BBox [0 0 240 240] '
+        f'/Group << /S /Transparency /CS /DeviceRGB /I true /K false >> '
+        f'/Resources << /ExtGState << /GSa {gstate} 0 R >> >>', content
+    )
+
+
+def _annotation(writer, rng, index):
+    x, y = rng.randint(36, PAGE_WIDTH - 136), rng.randint(36, PAGE_HEIGHT - 56)
+    rect = f'[{x} {y} {x + 100} {y + 20}]'
+    kind = index % 3
+    if kind == 0:
+        return writer.add(f'<< /Type /Annot /Subtype /Link /Rect {rect} /Border [0 0 0] '
+                          f'/A << /S /URI /URI (https://example.com/{index}) >> >>')
+    if kind == 1:
+        return writer.add(f'<< /Type /Annot /Subtype /Text /Rect {rect} /Contents ({_words(rng, 6)}) >>')
+    return writer.add(f'<< /Type /Annot /Subtype /Square /Rect {rect} /C [1 0 0] /Contents (note {index}) >>')
+
+
+def generate(path, seed=0, pages=1, fonts=0, images=0, image_dpi=150, transparency=0,
+             annotations=0, scanned=False, min_bytes=0):
+    """
+    Write a synthetic PDF to `path`
+    `images`, `transparency` and `annotations` are per page; `fonts` embedded
+    Type 3 fonts are used in turn (the standard Helvetica when 0). Scanned
+    documents are one full-page grey image per page and no text. `min_bytes`
+    pads the file with an incompressible image on the last page.
+    Returns the size of the written file
+    """
+    params = dict(seed=seed, pages=pages, fonts=fonts, images=images, image_dpi=image_dpi,
+                  transparency=transparency, annotations=annotations, scanned=scanned)
+    size = _build(**params).write(path)
+    if size < min_bytes:
+        # Same seed, same objects; the second pass only adds the padding image
+        size = _build(padding=min_bytes - size, **params).write(path)
+    return size
+
+
+def _build(seed, pages, fonts, images, image_dpi, transparency, annotations, scanned, padding=0):
+    rng = random.Random(seed)
+    writer = PdfWriter()
+    catalog = writer.reserve()
+    page_tree = writer.reserve()
+
+    if fonts:
+        font_refs = [_type3_font(writer, rng, i) for i in range(fonts)]
+    else:
+        font_refs = [writer.add('<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')]
+    gstate = writer.add('<< /Type /ExtGState /ca 0.5 /CA 0.5 /BM /Multiply >>') if transparency else None
+
+    page_refs = []
+    for page_number in range(pages):
+        xobjects = {}
+        content = []
+        if scanned:
+            width, height = PAGE_WIDTH * image_dpi // 72, PAGE_HEIGHT * image_dpi // 72
+            xobjects['Scan'] = _image(writer, rng, width, height, gray=True)
+            content.append(f'q {PAGE_WIDTH} 0 0 {PAGE_HEIGHT} 0 0 cm /Scan Do Q')
+        else:
+            lines = []
+            for line in range(48):
+                font = (page_number * 48 + line) % len(font_refs)
+                lines.append(f'/F{font} 10 Tf ({_words(rng, 9)}) Tj T*')
+            content.append(f'BT 14 TL 54 740 Td {" ".join(lines)} ET')
+
+        for i in range(images):
+            # Images are 2.5 x 2 inches, so image_dpi maps directly to pixel dimensions
+            name = f'Im{i}'
+            xobjects[name] = _image(writer, rng, 5 * image_dpi // 2, 2 * image_dpi)
+            x, y = rng.randint(0, PAGE_WIDTH - 180), rng.randint(0, PAGE_HEIGHT - 144)
+            content.append(f'q 180 0 0 144 {x} {y} cm /{name} Do Q')
+        for i in range(transparency):
+            name = f'Tg{i}'
+            xobjects[name] = _transparency_group(writer, rng, gstate)
+            x, y = rng.randint(0, PAGE_WIDTH - 240), rng.randint(0, PAGE_HEIGHT - 240)
+            content.append(f'q 1 0 0 1 {x} {y} cm /{name} Do Q')
+        if padding and page_number == pages - 1:
+            xobjects['Pad'] = _padding_image(writer, random.Random(seed), padding)
+            content.append('q 1 0 0 1 0 0 cm /Pad Do Q')
+
+        contents = writer.add_stream('', '\n'.join(content).encode())
+        annots = [_annotation(writer, rng, page_number * annotations + i) for i in range(annotations)]
+        page = writer.reserve()
+        page_refs.append(page)
+        fonts_dict = ' '.join(f'/F{i} {ref} 0 R' for i, ref in enumerate(font_refs))
+        xobject_dict = ' '.join(f'/{name} {ref} 0 R' for name, ref in xobjects.items())
+        annots_entry = f' /Annots [{" ".join(f"{ref} 0 R" for ref in annots)}]' if annots else ''
+        writer.set(page, f'<< /Type /Page /Parent {page_tree} 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+                         f'/Resources << /Font << {fonts_dict} >> /XObject << {xobject_dict} >> >> '
+                         f'/Contents {contents} 0 R{annots_entry} >>')
+
+    writer.set(page_tree, f'<< /Type /Pages /Count {pages} '
+                          f'/Kids [{" ".join(f"{ref} 0 R" for ref in page_refs)}] >>')
+    writer.set(catalog, f'<< /Type /Catalog /Pages {page_tree} 0 R >>')
+    writer.root = catalog
+    writer.file_id = rng.randbytes(16).hex()
+    return writer
+
+
+def write_corpus(directory, seed=0, per_class=3, classes=None):
+    """Generate `per_class` documents of every class profile under `directory/<class>/`"""
+    written = []
+    for class_index, (doc_class, profile) in enumerate(sorted(CLASS_PROFILES.items())):
+        if classes and doc_class not in classes:
+            continue
+        class_dir = os.path.join(directory, doc_class)
+        os.makedirs(class_dir, exist_ok=True)
+        for i in range(per_class):
+            path = os.path.join(class_dir, f'{doc_class}-{i:02d}.pdf')
+            size = generate(path, seed=seed * 1000 + class_index * 100 + i, **profile)
+            written.append((path, size))
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', help="generate the benchmark corpus into this directory")
+    parser.add_argument('--per-class', type=int, default=3, help="documents per class with --corpus")
+    parser.add_argument('--classes', nargs='*', choices=sorted(CLASS_PROFILES), help="classes to generate")
+    parser.add_argument('-o', '--output', help="write a single document to this file")
+    parser.add_argument('--pages', type=int, default=1)
+    parser.add_argument('--fonts', type=int, default=0, help="embedded Type 3 fonts")
+    parser.add_argument('--images', type=int, default=0, help="images per page")
+    parser.add_argument('--image-dpi', type=int, default=150)
+    parser.add_argument('--transparency', type=int, default=0, help="transparency groups per page")
+    parser.add_argument('--annotations', type=int, default=0, help="annotations per page")
+    parser.add_argument('--scanned', action='store_true', help="one full-page grey image per page, no text")
+    parser.add_argument('--min-bytes', type=int, default=0, help="pad the file to at least this size")
+    args = parser.parse_args(argv)
+
+    if args.corpus:
+        for path, size in write_corpus(args.corpus, args.seed, args.per_class, args.classes):
+            print(f"{path}: {size} bytes")
+    elif args.output:
+        size = generate(args.output, seed=args.seed, pages=args.pages, fonts=args.fonts, images=args.images,
+                        image_dpi=args.image_dpi, transparency=args.transparency,
+                        annotations=args.annotations, scanned=args.scanned, min_bytes=args.min_bytes)
+        print(f"{args.output}: {size} bytes")
+    else:
+        parser.error("either --corpus or --output is required")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+Conversion cost estimates from preflight features
+
+Every Ghostscript conversion appends its preflight features and the wall time
+and peak memory it actually took to a JSON-lines history. A linear model per
+preset (with a pooled model for presets that have too little history) is
+refitted from that history offline, and predicts the cost of a new document
+from its preflight summary before any Ghostscript run. Until a model has been
+fitted, rough built-in coefficients are used.
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+FEATURES = ('pages', 'image_megapixels', 'fonts', 'transparency', 'megabytes')
+TARGETS = ('wall_seconds', 'peak_rss_bytes')
+
+MIN_RECORDS = 20  # per preset, below which only the pooled model is fitted
+RIDGE = 1e-3  # keeps the fit stable when a feature never varies in the history
+POOLED = '*'
+
+# Used until enough history has been recorded: intercept first, then FEATURES
+PRIOR = {
+    'wall_seconds': [0.3, 0.05, 0.04, 0.01, 0.5, 0.05],
+    'peak_rss_bytes': [64e6, 0.2e6, 6e6, 1e6, 32e6, 2e6],
+}
+
+
+def feature_vector(summary):
+    """Model inputs for a preflight summary (see pdf_parser.preflight), intercept first"""
+    return [
+        1.0,
+        float(summary.get('pages') or 0),
+        (summary.get('image_pixels') or 0) / 1e6,
+        float(summary.get('fonts') or 0),
+        1.0 if summary.get('transparency') else 0.0,
+        (summary.get('bytes') or 0) / (1024 * 1024),
+    ]
+
+
+def history_record(summary, preset, engine, usage):
+    """A history line for one finished conversion"""
+    return {
+        'time': round(time.time(), 3),
+        'preset': preset,
+        'engine': engine,
+        'features': {key: summary.get(key) for key in
+                     ('pages', 'image_pixels', 'fonts', 'transparency', 'bytes', 'images', 'objects')},
+        'wall_seconds': usage.get('wall_seconds'),
+        'peak_rss_bytes': usage.get('peak_rss_bytes'),
+    }
+
+
+def _solve(matrix, vector):
+    """Solve a small dense linear system by Gaussian elimination with partial pivoting"""
+    size = len(vector)
+    rows = [list(row) + [value] for row, value in zip(matrix, vector)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda r: abs(rows[r][column]))
+        if abs(rows[pivot][column]) < 1e-12:
+            raise ValueError("Singular system")
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for r in range(size):
+            if r != column:
+                factor = rows[r][column] / rows[column][column]
+                rows[r] = [a - factor * b for a, b in zip(rows[r], rows[column])]
+    return [rows[i][size] / rows[i][i] for i in range(size)]
+
+
+def _least_squares(samples):
+    """Ridge-regularised least squares over (features, target) samples"""
+    size = len(samples[0][0])
+    gram = [[0.0] * size for _ in range(size)]
+    moment = [0.0] * size
+    for x, y in samples:
+        for i in range(size):
+            moment[i] += x[i] * y
+            for j in range(size):
+                gram[i][j] += x[i] * x[j]
+    # The intercept isn't penalised
+    for i in range(1, size):
+        gram[i][i] += RIDGE * len(samples)
+    return _solve(gram, moment)
+
+
+class CostModel:
+    """Per-preset linear cost models; `coefficients` maps preset (or POOLED) to target to coefficients"""
+
+    def __init__(self, coefficients=None, fitted_at=None, report=None):
+        self.coefficients = coefficients or {}
+        self.fitted_at = fitted_at
+        self.report = report
+
+    def predict(self, summary, preset=None):
+        """
+        Estimated cost of converting a document with `preset`
+        Returns a dict of TARGETS plus 'model': the preset it came from, POOLED or 'prior'
+        """
+        x = feature_vector(summary)
+        source = preset if preset in self.coefficients else POOLED if POOLED in self.coefficients else 'prior'
+        coefficients = PRIOR if source == 'prior' else self.coefficients[source]
+        estimate = {'model': source}
+        for target in TARGETS:
+            value = sum(c * v for c, v in zip(coefficients[target], x))
+            # A linear fit can go negative for tiny documents
+            estimate[target] = max(value, coefficients[target][0] * 0.1, 0.0)
+        estimate['wall_seconds'] = round(estimate['wall_seconds'], 3)
+        estimate['peak_rss_bytes'] = int(estimate['peak_rss_bytes'])
+        return estimate
+
+    def to_dict(self):
+        return {'features': FEATURES, 'coefficients': self.coefficients,
+                'fitted_at': self.fitted_at, 'report': self.report}
+
+    @classmethod
+    def load(cls, path):
+        """A model saved with save(), or an unfitted one if there is none"""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return cls()
+        if list(data.get('features', ())) != list(FEATURES):
+            # Saved by a version with different inputs; refit before using it
+            return cls()
+        return cls(data['coefficients'], data.get('fitted_at'), data.get('report'))
+
+    def save(self, path):
+        """Write the model atomically so running servers never read half a file"""
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+def _samples(records, target):
+    return [(feature_vector(record['features']), record[target]) for record in records
+            if record.get(target)]
+
+
+def fit(records, min_records=MIN_RECORDS):
+    """
+    Fit a CostModel to history records
+    Presets with at least `min_records` records get their own coefficients.
+    """
+    coefficients = {}
+    groups = {POOLED: records}
+    for record in records:
+        groups.setdefault(record.get('preset'), []).append(record)
+    for name, group in groups.items():
+        if name is None or len(group) < min_records:
+            continue
+        fitted = {}
+        for target in TARGETS:
+            samples = _samples(group, target)
+            if len(samples) < min_records:
+                break
+            try:
+                fitted[target] = _least_squares(samples)
+            except ValueError:
+                break
+        else:
+            coefficients[name] = fitted
+    return CostModel(coefficients, fitted_at=time.time())
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def evaluate(model, records):
+    """
+    Prediction error of `model` on `records`
+    Returns per target: record count, mean absolute error and the median and
+    p90 absolute percentage error
+    """
+    report = {}
+    for target in TARGETS:
+        errors = []
+        ratios = []
+        for record in records:
+            actual = record.get(target)
+            if not actual:
+                continue
+            predicted = model.predict(record['features'], record.get('preset'))[target]
+            errors.append(abs(predicted - actual))
+            ratios.append(abs(predicted - actual) / actual * 100)
+        if not errors:
+            report[target] = {'records': 0}
+            continue
+        report[target] = {
+            'records': len(errors),
+            'mean_absolute_error': round(sum(errors) / len(errors), 3),
+            'median_percent_error': round(_percentile(ratios, 50), 1),
+            'p90_percent_error': round(_percentile(ratios, 90), 1),
+        }
+    return report
+
+
+class CostHistory:
+    """Append-only JSON-lines history of finished conversions, shared by all server processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _file_lock(self, operation):
+        """Hold `operation` (LOCK_SH or LOCK_EX) on the history's lock file"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)
+
+    def append(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        # Appends share the lock with each other, but wait while trim() swaps the file
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            # One write() on an O_APPEND descriptor, so lines from other processes don't interleave
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def read(self):
+        """Every readable record, oldest first"""
+        records = []
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue  # a line cut short by a crash
+        except FileNotFoundError:
+            return []
+        return records
+
+    def trim(self, max_records):
+        """
+        Drop all but the newest `max_records` records
+        The history is re-read under the lock, so nothing appended meanwhile is lost.
+        Returns the number of records dropped
+        """
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            records = self.read()
+            if len(records) <= max_records:
+                return 0
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                for record in records[-max_records:]:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            os.replace(temp_path, self.path)
+            return len(records) - max_records
+
+
+def refit(history, model_path, max_records=None, holdout_every=5):
+    """
+    Refit the model from `history` and save it to `model_path`
+    Every `holdout_every`-th record is held out to measure prediction error;
+    the saved model is then fitted to all records. Returns the report.
+    """
+    recorded = history.read()
+    records = [record for record in recorded[-max_records if max_records else 0:]
+               if isinstance(record.get('features'), dict)]
+    train = [record for i, record in enumerate(records) if i % holdout_every]
+    test = records[::holdout_every]
+    candidate = fit(train)
+    report = {
+        'records': len(records),
+        'train_records': len(train),
+        'holdout_records': len(test),
+        'holdout_error': evaluate(candidate, test),
+        'prior_holdout_error': evaluate(CostModel(), test),
+        'training_error': evaluate(candidate, train),
+    }
+    model = fit(records)
+    report['models'] = sorted(model.coefficients)
+    model.report = report
+    model.save(model_path)
+    if max_records:
+        history.trim(max_records)
+    return report
@@ -0,0 +1,136 @@
+"""
+Ghostscript command line shared by the conversion engines
+"""
+
+GS_BINARY = 'gs'
+
+# Interpreter switches for a one-shot `gs` run
+GS_BATCH_FLAGS = ['-dNOPAUSE', '-dBATCH']
+
+# Device and PDF/UA switches applied to every conversion, whatever the preset
+PDFUA_FLAGS = [
+    '-dPDFA', '-dPDFUA',
+    '-sColorConversionStrategy=UseDeviceIndependentColor',
+    '-sDEVICE=pdfwrite',
+    '-dPDFACompatibilityPolicy=2',
+    '-dCompatibilityLevel=1.7',
+]
+
+
+def _downsample(kind, resolution, threshold, method='/Bicubic'):
+    return [
+        f'-dDownsample{kind}Images=true',
+        f'-d{kind}ImageDownsampleType={method}',
+        f'-d{kind}ImageResolution={resolution}',
+        f'-d{kind}ImageDownsampleThreshold={threshold}',
+    ]
+
+
+class Preset:
+    """
+    A named, versioned bundle of pdfwrite settings
+    Bump `version` whenever the settings change, so results cached under the
+    old settings are no longer served.
+    """
+
+    def __init__(self, name, version, flags, jpeg_qfactor=None):
+        self.name = name
+        self.version = version
+        self.flags = [*PDFUA_FLAGS, *flags]
+        self.jpeg_qfactor = jpeg_qfactor
+
+    @property
+    def label(self):
+        return f'{self.name}-v{self.version}'
+
+    def postscript_args(self):
+        """`-c ... -f` arguments for settings that have no command-line switch"""
+        if self.jpeg_qfactor is None:
+            return []
+        image_dict = (f'<< /QFactor {self.jpeg_qfactor} /Blend 1 '
+                      f'/HSamples [2 1 1 2] /VSamples [2 1 1 2] >>')
+        return ['-c', f'<< /ColorImageDict {image_dict} /GrayImageDict {image_dict} >> setdistillerparams',
+                '-f']
+
+
+PRESETS = {preset.name: preset for preset in [
+    # The original conversion settings: images keep their resolution and encoding parameters
+    Preset('standard', 1, [
+        '-dDetectDuplicateImages=true',
+        '-dCompressPages=true',
+        '-dCompressFonts=true',
+    ]),
+    # Interactive traffic: no duplicate-image detection, no resampling, JPEGs copied as they are
+    Preset('fast', 1, [
+        '-dDetectDuplicateImages=false',
+        '-dCompressPages=true',
+        '-dCompressFonts=true',
+        '-dDownsampleColorImages=false',
+        '-dDownsampleGrayImages=false',
+        '-dDownsampleMonoImages=false',
+        '-dPassThroughJPEGImages=true',
+    ]),
+    # Only images well above print resolution are resampled
+    Preset('balanced', 1, [
+        '-dDetectDuplicateImages=true',
+        '-dCompressPages=true',
+        '-dCompressFonts=true',
+        *_downsample('Color', 300, 1.5),
+        *_downsample('Gray', 300, 1.5),
+        *_downsample('Mono', 600, 1.5, '/Subsample'),
+        '-dPassThroughJPEGImages=true',
+    ], jpeg_qfactor=0.4),
+    # Archival traffic: screen resolution, every image re-encoded at lower JPEG quality
+    Preset('smallest', 1, [
+        '-dDetectDuplicateImages=true',
+        '-dCompressPages=true',
+        '-dCompressFonts=true',
+        '-dSubsetFonts=true',
+        *_downsample('Color', 150, 1.0),
+        *_downsample('Gray', 150, 1.0),
+        *_downsample('Mono', 300, 1.0, '/Subsample'),
+        '-dPassThroughJPEGImages=false',
+    ], jpeg_qfactor=0.76),
+]}
+
+DEFAULT_PRESET = 'standard'
+
+# Merging converted page ranges only concatenates them and writes the PDF/UA metadata:
+# their images are final, so nothing is resampled and whatever isn't passed through
+# as it is gets a lossless filter
+MERGE_FLAGS = [
+    *PDFUA_FLAGS,
+    '-dDetectDuplicateImages=true',
+    '-dCompressPages=true',
+    '-dCompressFonts=true',
+    '-dDownsampleColorImages=false',
+    '-dDownsampleGrayImages=false',
+    '-dDownsampleMonoImages=false',
+    '-dPassThroughJPEGImages=true',
+    '-dPassThroughJPXImages=true',
+    '-dAutoFilterColorImages=false',
+    '-dColorImageFilter=/FlateEncode',
+    '-dAutoFilterGrayImages=false',
+    '-dGrayImageFilter=/FlateEncode',
+]
+
+
+def build_gs_cmd(input_pdf_path, output_pdf_path, preset=None, extra_flags=()):
+    """Build the argv for a one-shot Ghostscript conversion"""
+    if preset is None:
+        preset = PRESETS[DEFAULT_PRESET]
+    return [
+        GS_BINARY, *GS_BATCH_FLAGS, *preset.flags, *extra_flags,
+        f'-sOutputFile={output_pdf_path}',
+        *preset.postscript_args(),
+        input_pdf_path
+    ]
+
+
+def extract_error_line(error_msg):
+    """Pick the most relevant line out of Ghostscript's error output"""
+    error_msg = error_msg or "Unknown Ghostscript error"
+    error_lines = [line for line in error_msg.split('\n') if line.strip() and 'error' in line.lower()]
+    if error_lines:
+        return error_lines[0]
+    return error_msg
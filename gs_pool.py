@@ -0,0 +1,322 @@
+"""
+Pool of long-lived Ghostscript interpreters
+
+Each worker is a `gs` process reading PostScript from stdin. A job is sent as
+a small program that points the pdfwrite device at a new OutputFile (which
+closes and reopens the device), runs the input PDF, and then points the
+device back at /dev/null so the finished document is flushed. A sentinel
+line printed on stdout tells us the job is done and whether it failed.
+
+An interpreter runs whatever PostScript its input contains, so it may only
+read one file name and write another, both in a private directory of its
+own. Before each job those names are pointed at that job's input and output
+with symlinks, and they are removed again afterwards, so a document can't
+reach any other file of the service or of other jobs.
+"""
+
+import collections
+import itertools
+import logging
+import os
+import queue
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+from gs_args import DEFAULT_PRESET, GS_BINARY, PRESETS
+from gs_runner import GsLimits, GsRun, detect_limit, proc_usage_delta, read_proc_usage, reset_peak_rss
+
+logger = logging.getLogger(__name__)
+
+SENTINEL = '%%PDFUA'
+
+
+def ps_string(value):
+    """Quote a value as a PostScript string literal"""
+    escaped = value.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return f'({escaped})'
+
+
+class WorkerError(Exception):
+    """
+    Raised when a worker stops answering on its control channel
+    `returncode` is the interpreter's exit status if it is known to have exited.
+    """
+
+    def __init__(self, message, timed_out=False, returncode=None):
+        super().__init__(message)
+        self.timed_out = timed_out
+        self.returncode = returncode
+
+
+class GhostscriptWorker:
+    """A single persistent `gs` process driven over stdin/stdout"""
+
+    def __init__(self, preset, gs_binary=GS_BINARY, startup_timeout=10.0, limits=None):
+        self.jail = tempfile.mkdtemp(prefix='pdfua-gs-')
+        self.jail_input = os.path.join(self.jail, 'input.pdf')
+        self.jail_output = os.path.join(self.jail, 'output.pdf')
+        cmd = [
+            gs_binary, '-q', '-dNOPAUSE', '-dNOPROMPT', '-dSAFER',
+            f'--permit-file-read={self.jail_input}', f'--permit-file-write={self.jail_output}',
+            '--permit-file-write=/dev/null',
+            *preset.flags,
+            '-sOutputFile=/dev/null',
+            *preset.postscript_args(),
+            '-'
+        ]
+        # Only the memory and output size limits make sense for a long-lived interpreter;
+        # wall-clock time is enforced per job and CPU time would accumulate across jobs
+        self.limits = GsLimits()
+        preexec_fn = None
+        if limits:
+            self.limits = GsLimits(memory_bytes=limits.memory_bytes, output_bytes=limits.output_bytes)
+            preexec_fn = self.limits.apply_rlimits
+        try:
+            self.proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                text=True, encoding='latin-1', bufsize=1, start_new_session=True, preexec_fn=preexec_fn
+            )
+        except BaseException:
+            shutil.rmtree(self.jail, ignore_errors=True)
+            raise
+        self.jobs_done = 0
+        self.started_at = time.monotonic()
+        self._seq = itertools.count(1)
+        self._lines = queue.Queue()
+        self._stderr = collections.deque(maxlen=200)
+        threading.Thread(target=self._pump_stdout, daemon=True).start()
+        threading.Thread(target=self._pump_stderr, daemon=True).start()
+        # Don't hand out a worker until the interpreter has finished starting up
+        try:
+            self.ping(startup_timeout)
+        except WorkerError:
+            self.kill()
+            raise
+
+    def _pump_stdout(self):
+        for line in self.proc.stdout:
+            self._lines.put(line.rstrip('\n'))
+        self._lines.put(None)
+
+    def _pump_stderr(self):
+        for line in self.proc.stderr:
+            self._stderr.append(line.rstrip('\n'))
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def _send(self, program):
+        try:
+            self.proc.stdin.write(program)
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as e:
+            raise self._exited(f"Ghostscript worker is not accepting jobs: {e}")
+
+    def _exited(self, message):
+        """WorkerError for an interpreter that has gone away, with its exit status"""
+        try:
+            returncode = self.proc.wait(5)
+        except subprocess.TimeoutExpired:
+            returncode = None
+        return WorkerError(f"{message} (exit status {returncode})", returncode=returncode)
+
+    def _wait_for(self, token, timeout):
+        """Collect stdout until the sentinel for `token`, returning (status, output lines)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        prefix = f'{SENTINEL} {token} '
+        output = []
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                line = self._lines.get(timeout=remaining)
+            except queue.Empty:
+                raise WorkerError("Ghostscript worker timed out", timed_out=True)
+            if line is None:
+                raise self._exited("Ghostscript worker exited unexpectedly")
+            if line.startswith(prefix):
+                return line[len(prefix):], output
+            output.append(line)
+
+    def ping(self, timeout):
+        """Health check: the interpreter must echo a sentinel back in time"""
+        token = next(self._seq)
+        self._send(f'({SENTINEL} {token} pong\\n) print flush\n')
+        status, _ = self._wait_for(token, timeout)
+        if status != 'pong':
+            raise WorkerError(f"Unexpected health check reply: {status}")
+
+    def run(self, input_pdf_path, output_pdf_path, timeout=None):
+        """
+        Convert one document on this worker
+        Returns a GsRun
+        """
+        token = next(self._seq)
+        self._stderr.clear()
+        self._grant(input_pdf_path, output_pdf_path)
+        try:
+            return self._run(token, timeout)
+        finally:
+            self._grant()
+
+    def _grant(self, input_pdf_path=None, output_pdf_path=None):
+        """Point the interpreter's only readable and writable names at a job's files, or at nothing"""
+        for link, target in ((self.jail_input, input_pdf_path), (self.jail_output, output_pdf_path)):
+            try:
+                os.unlink(link)
+            except FileNotFoundError:
+                pass
+            if target:
+                os.symlink(os.path.abspath(target), link)
+
+    def _run(self, token, timeout):
+        # The interpreter outlives the job, so account for it by diffing procfs counters
+        reset_peak_rss(self.proc.pid)
+        before = read_proc_usage(self.proc.pid)
+        started = time.perf_counter()
+        program = (
+            'mark {\n'
+            f'  << /OutputFile {ps_string(self.jail_output)} >> setpagedevice\n'
+            f'  {ps_string(self.jail_input)} run\n'
+            '} stopped\n'
+            # Closing the output file is what makes pdfwrite write the trailer
+            '{ << /OutputFile (/dev/null) >> setpagedevice } stopped pop\n'
+            f'{{ ({SENTINEL} {token} error ) print $error /errorname get =only (\\n) print }}\n'
+            f'{{ ({SENTINEL} {token} ok\\n) print }} ifelse\n'
+            'cleartomark flush\n'
+        )
+        self._send(program)
+        status, output = self._wait_for(token, timeout)
+        self.jobs_done += 1
+        usage = proc_usage_delta(before, read_proc_usage(self.proc.pid))
+        usage['wall_seconds'] = time.perf_counter() - started
+        stdout = '\n'.join(output)
+        if status == 'ok':
+            return GsRun(0, stdout, '\n'.join(self._stderr), usage)
+        stderr = '\n'.join(self._stderr) or f"Ghostscript error: {status}"
+        # A VMerror under RLIMIT_AS is reported like any other PostScript error
+        return GsRun(1, stdout, stderr, usage, detect_limit(1, False, usage, f'{stderr}\n{status}', self.limits))
+
+    def stderr_tail(self):
+        """The last lines the interpreter wrote to stderr"""
+        return list(self._stderr)
+
+    def kill(self):
+        if self.alive():
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.proc.wait()
+        shutil.rmtree(self.jail, ignore_errors=True)
+
+    def close(self, timeout=5.0):
+        if self.alive():
+            try:
+                self._send('quit\n')
+                self.proc.wait(timeout)
+            except (WorkerError, subprocess.TimeoutExpired):
+                self.kill()
+        shutil.rmtree(self.jail, ignore_errors=True)
+
+
+class GhostscriptPool:
+    """
+    Fixed-size pool of Ghostscript workers
+    Workers are started on demand, recycled after `max_jobs_per_worker` jobs
+    and health-checked while idle every `health_interval` seconds.
+    """
+
+    def __init__(self, size, max_jobs_per_worker=100, preset=None,
+                 job_timeout=None, health_interval=30.0, health_timeout=5.0, limits=None):
+        self.size = size
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.preset = PRESETS[DEFAULT_PRESET] if preset is None else preset
+        self.job_timeout = job_timeout
+        self.health_timeout = health_timeout
+        self.limits = limits
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.Queue()
+        self._closed = threading.Event()
+        if health_interval:
+            threading.Thread(target=self._health_loop, args=(health_interval,), daemon=True).start()
+
+    def _spawn(self):
+        return GhostscriptWorker(self.preset, limits=self.limits)
+
+    def _checkout(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    worker = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._spawn()
+                if worker.alive():
+                    return worker
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkin(self, worker, healthy):
+        try:
+            if not healthy:
+                worker.kill()
+            elif worker.jobs_done < self.max_jobs_per_worker and not self._closed.is_set():
+                self._idle.put(worker)
+            else:
+                # Recycle the interpreter before leaks and font caches build up
+                worker.close()
+        finally:
+            self._slots.release()
+
+    def run(self, input_pdf_path, output_pdf_path, preset=None):
+        """
+        Convert a document on the next free worker
+        Workers are started with the pool's preset, so `preset`, if given, must be that one.
+        Returns a GsRun
+        """
+        if preset is not None and preset.name != self.preset.name:
+            raise ValueError(f"Pool runs preset {self.preset.name}, not {preset.name}")
+        worker = self._checkout()
+        healthy = False
+        try:
+            result = worker.run(input_pdf_path, output_pdf_path, self.job_timeout)
+            healthy = True
+            return result
+        except WorkerError as e:
+            # Judge a dead interpreter by its wait status, the way run_gs judges a one-shot gs:
+            # SIGXFSZ is the output cap and a VMerror just before dying is the memory limit
+            returncode = -signal.SIGKILL if e.timed_out else e.returncode or 1
+            stderr = '\n'.join([*worker.stderr_tail(), str(e)])
+            limit = detect_limit(returncode, e.timed_out, {}, stderr, worker.limits)
+            return GsRun(returncode, '', stderr, {}, limit, crashed=limit is None)
+        finally:
+            self._checkin(worker, healthy)
+
+    def _health_loop(self, interval):
+        while not self._closed.wait(interval):
+            checked = []
+            while True:
+                try:
+                    checked.append(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+            for worker in checked:
+                try:
+                    worker.ping(self.health_timeout)
+                    self._idle.put(worker)
+                except WorkerError as e:
+                    logger.warning("Ghostscript worker failed health check: %s", e)
+                    worker.kill()
+
+    def close(self):
+        self._closed.set()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
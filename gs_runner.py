@@ -0,0 +1,323 @@
+"""
+Running Ghostscript with per-conversion resource accounting
+
+One-shot `gs` children are reaped with os.wait4 so their rusage (CPU time,
+peak RSS, block I/O) is kept instead of thrown away. When a cgroup v2 parent
+is configured and writable, each run gets its own sub-group and its cpu.stat,
+memory.peak and io.stat are read instead, which also covers anything the
+interpreter forks. Long-lived interpreters are accounted by diffing procfs
+counters around each job.
+
+Runs can be bounded by wall-clock time, RLIMIT_CPU, RLIMIT_AS, RLIMIT_FSIZE (the
+largest file the interpreter may write) and the cgroup's memory.max. A run
+stopped by a limit is reported with a distinct error code.
+"""
+
+import logging
+import math
+import os
+import resource
+import signal
+import subprocess
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 512  # rusage counts block I/O in 512-byte units
+
+USAGE_FIELDS = ('user_cpu_seconds', 'system_cpu_seconds', 'peak_rss_bytes',
+                'block_read_bytes', 'block_write_bytes')
+
+
+def _rusage_to_usage(rusage):
+    return {
+        'user_cpu_seconds': rusage.ru_utime,
+        'system_cpu_seconds': rusage.ru_stime,
+        'peak_rss_bytes': rusage.ru_maxrss * 1024,  # Linux reports kilobytes
+        'block_read_bytes': rusage.ru_inblock * BLOCK_SIZE,
+        'block_write_bytes': rusage.ru_oublock * BLOCK_SIZE,
+        'source': 'rusage',
+    }
+
+
+def combine_usage(usages):
+    """Usage of several runs taken together: summed counters, largest peak RSS"""
+    usages = [usage for usage in usages if usage]
+    if not usages:
+        return {}
+    combined = {field: 0 for field in USAGE_FIELDS}
+    for usage in usages:
+        for field in USAGE_FIELDS:
+            if field == 'peak_rss_bytes':
+                combined[field] = max(combined[field], usage.get(field, 0))
+            else:
+                combined[field] += usage.get(field, 0)
+    combined['wall_seconds'] = max(usage.get('wall_seconds', 0) for usage in usages)
+    combined['source'] = usages[0].get('source')
+    return combined
+
+
+class CgroupScope:
+    """A throwaway cgroup v2 sub-group for a single Ghostscript run"""
+
+    def __init__(self, parent):
+        self.path = os.path.join(parent, f'pdfua-{uuid.uuid4().hex[:12]}')
+        os.mkdir(self.path)
+
+    @staticmethod
+    def available(parent):
+        return bool(parent) and os.path.exists(os.path.join(parent, 'cgroup.procs')) \
+            and os.access(parent, os.W_OK)
+
+    def attach_self(self):
+        """Move the calling process into the group; used as a preexec_fn"""
+        with open(os.path.join(self.path, 'cgroup.procs'), 'w') as f:
+            f.write(str(os.getpid()))
+
+    def _read_keyed(self, name):
+        values = {}
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        values[parts[0]] = int(parts[1])
+        except (OSError, ValueError):
+            pass
+        return values
+
+    def set_limits(self, limits):
+        """Apply the memory limit to the whole group, swap included"""
+        if not limits.memory_bytes:
+            return
+        for name in ('memory.max', 'memory.swap.max'):
+            try:
+                with open(os.path.join(self.path, name), 'w') as f:
+                    f.write(str(limits.memory_bytes if name == 'memory.max' else 0))
+            except OSError:
+                pass
+
+    def memory_events(self):
+        return self._read_keyed('memory.events')
+
+    def usage(self):
+        cpu = self._read_keyed('cpu.stat')
+        usage = {
+            'user_cpu_seconds': cpu.get('user_usec', 0) / 1e6,
+            'system_cpu_seconds': cpu.get('system_usec', 0) / 1e6,
+            'peak_rss_bytes': 0,
+            'block_read_bytes': 0,
+            'block_write_bytes': 0,
+            'source': 'cgroup',
+        }
+        try:
+            with open(os.path.join(self.path, 'memory.peak')) as f:
+                usage['peak_rss_bytes'] = int(f.read().strip())
+        except (OSError, ValueError):
+            pass
+        try:
+            with open(os.path.join(self.path, 'io.stat')) as f:
+                for line in f:
+                    for field in line.split()[1:]:
+                        key, _, value = field.partition('=')
+                        if key == 'rbytes':
+                            usage['block_read_bytes'] += int(value)
+                        elif key == 'wbytes':
+                            usage['block_write_bytes'] += int(value)
+        except (OSError, ValueError):
+            pass
+        return usage
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError as e:
+            logger.warning("Cgroup cleanup error: %s", e)
+
+
+# Error codes for runs stopped by a limit
+LIMIT_TIMEOUT = 'timeout'
+LIMIT_CPU = 'cpu_limit'
+LIMIT_MEMORY = 'memory_limit'
+LIMIT_OUTPUT = 'output_too_large'
+
+# Ghostscript's reports when an allocation fails under RLIMIT_AS
+MEMORY_ERROR_MARKERS = ('VMerror', 'out of memory')
+
+
+class GsLimits:
+    """Per-run resource limits; None or 0 means unlimited"""
+
+    def __init__(self, wall_seconds=None, cpu_seconds=None, memory_bytes=None, output_bytes=None):
+        self.wall_seconds = wall_seconds or None
+        self.cpu_seconds = cpu_seconds or None
+        self.memory_bytes = memory_bytes or None
+        self.output_bytes = output_bytes or None
+
+    def apply_rlimits(self):
+        """Set rlimits on the calling process; runs in the child before exec"""
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+        if self.cpu_seconds:
+            # The soft limit sends SIGXCPU; the hard limit is a SIGKILL backstop
+            cpu = math.ceil(self.cpu_seconds)
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 5))
+        if self.memory_bytes:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory_bytes, self.memory_bytes))
+        if self.output_bytes:
+            resource.setrlimit(resource.RLIMIT_FSIZE, (self.output_bytes, self.output_bytes))
+
+
+class GsRun:
+    """Outcome of one Ghostscript run, whichever engine performed it"""
+
+    def __init__(self, returncode, stdout, stderr, usage, limit_exceeded=None, crashed=False):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.usage = usage
+        self.limit_exceeded = limit_exceeded
+        # Ghostscript died from a signal, or an engine process died under the job, without
+        # hitting a limit; that may be down to the machine rather than the document
+        self.crashed = crashed
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.limit_exceeded
+
+
+def detect_limit(returncode, timed_out, usage, output, limits, cgroup_events=None):
+    """
+    Which limit, if any, ended a run, judging by its wait status and output
+    Returns one of the LIMIT_* codes or None
+    """
+    cgroup_events = cgroup_events or {}
+    if timed_out:
+        return LIMIT_TIMEOUT
+    if returncode == -signal.SIGXFSZ:
+        return LIMIT_OUTPUT
+    if returncode == -signal.SIGXCPU or (
+            returncode == -signal.SIGKILL and limits.cpu_seconds
+            and usage['user_cpu_seconds'] + usage['system_cpu_seconds'] >= limits.cpu_seconds):
+        return LIMIT_CPU
+    if returncode != 0 and cgroup_events.get('oom_kill'):
+        return LIMIT_MEMORY
+    if returncode != 0 and limits.memory_bytes and any(marker in output for marker in MEMORY_ERROR_MARKERS):
+        return LIMIT_MEMORY
+    return None
+
+
+def _kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_gs(cmd, cgroup_parent=None, limits=None):
+    """
+    Run a one-shot Ghostscript command under `limits` and collect its resource usage
+    The child gets its own process group, which is killed as a whole on timeout.
+    Returns a GsRun
+    """
+    limits = limits or GsLimits()
+    cgroup = CgroupScope(cgroup_parent) if CgroupScope.available(cgroup_parent) else None
+    if cgroup:
+        cgroup.set_limits(limits)
+
+    def preexec():
+        limits.apply_rlimits()
+        if cgroup:
+            cgroup.attach_self()
+
+    started = time.perf_counter()
+    try:
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+            start_new_session=True, preexec_fn=preexec
+        )
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            _kill_group(proc.pid)
+
+        timer = threading.Timer(limits.wall_seconds, on_timeout) if limits.wall_seconds else None
+        if timer:
+            timer.daemon = True
+            timer.start()
+
+        output = {}
+        readers = [
+            threading.Thread(target=lambda name=name, pipe=pipe: output.__setitem__(name, pipe.read()),
+                             daemon=True)
+            for name, pipe in (('stdout', proc.stdout), ('stderr', proc.stderr))
+        ]
+        for reader in readers:
+            reader.start()
+        # Reap the child ourselves; Popen.wait() would discard its rusage
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if timer:
+            timer.cancel()
+        # Don't leave anything the interpreter started behind
+        _kill_group(proc.pid)
+        for reader in readers:
+            reader.join(5)
+        proc.stdout.close()
+        proc.stderr.close()
+
+        usage = cgroup.usage() if cgroup else _rusage_to_usage(rusage)
+        usage['wall_seconds'] = time.perf_counter() - started
+        stdout, stderr = output.get('stdout', ''), output.get('stderr', '')
+        limit = detect_limit(proc.returncode, timed_out.is_set(), usage, stdout + stderr, limits,
+                             cgroup.memory_events() if cgroup else {})
+        return GsRun(proc.returncode, stdout, stderr, usage, limit, crashed=proc.returncode < 0 and not limit)
+    finally:
+        if cgroup:
+            cgroup.remove()
+
+
+def read_proc_usage(pid='self'):
+    """Cumulative CPU and I/O counters of a live process from procfs"""
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    usage = {'user_cpu_seconds': 0.0, 'system_cpu_seconds': 0.0, 'peak_rss_bytes': 0,
+             'block_read_bytes': 0, 'block_write_bytes': 0, 'source': 'procfs'}
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # Fields after the parenthesised command name; utime and stime are 14 and 15
+            fields = f.read().rsplit(')', 1)[1].split()
+            usage['user_cpu_seconds'] = int(fields[11]) / clock_ticks
+            usage['system_cpu_seconds'] = int(fields[12]) / clock_ticks
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    usage['peak_rss_bytes'] = int(line.split()[1]) * 1024
+        with open(f'/proc/{pid}/io') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == 'read_bytes':
+                    usage['block_read_bytes'] = int(value)
+                elif key == 'write_bytes':
+                    usage['block_write_bytes'] = int(value)
+    except (OSError, ValueError, IndexError):
+        pass
+    return usage
+
+
+def reset_peak_rss(pid='self'):
+    """Reset VmHWM so the next reading covers a single job (Linux 4.0+)"""
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def proc_usage_delta(before, after):
+    """Usage between two read_proc_usage() samples; peak RSS is the later reading"""
+    usage = {field: after[field] - before[field] for field in USAGE_FIELDS if field != 'peak_rss_bytes'}
+    usage['peak_rss_bytes'] = after['peak_rss_bytes']
+    usage['source'] = 'procfs'
+    return usage
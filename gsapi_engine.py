@@ -0,0 +1,213 @@
+"""
+In-process Ghostscript engine using the libgs C API (gsapi)
+
+Conversions run inside a pool of warm worker processes. Each worker loads
+libgs once, so a job costs one gsapi instance rather than a process spawn,
+argv/pipe setup and dynamic linking. Timings are split into the time spent
+inside the interpreter and the overhead of getting the job to a worker.
+
+Workers run under the memory and output size rlimits, and a job that
+outlives the timeout has its worker killed. A killed or crashed worker
+breaks the whole executor, so it is replaced with a fresh one and the jobs
+that were on it fail as crashed.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from gs_args import PRESETS, build_gs_cmd
+from gs_runner import (LIMIT_OUTPUT, LIMIT_TIMEOUT, GsLimits, GsRun, detect_limit, proc_usage_delta,
+                       read_proc_usage, reset_peak_rss)
+
+logger = logging.getLogger(__name__)
+
+GS_ARG_ENCODING_UTF8 = 1
+GS_ERROR_QUIT = -101  # returned by gsapi_init_with_args after a normal `quit`
+
+_STDIO_CALLBACK = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int)
+
+# Per-worker state, set by the pool initializer
+_libgs = None
+
+
+def find_libgs():
+    """Locate the Ghostscript shared library, honouring PDFUA_LIBGS"""
+    candidates = [os.environ.get('PDFUA_LIBGS'), ctypes.util.find_library('gs'),
+                  'libgs.so.10', 'libgs.so.9', 'libgs.so']
+    for name in candidates:
+        if not name:
+            continue
+        try:
+            ctypes.CDLL(name)
+            return name
+        except OSError:
+            continue
+    raise OSError("Ghostscript shared library (libgs) not found")
+
+
+def _load(libgs_path):
+    lib = ctypes.CDLL(libgs_path)
+    lib.gsapi_new_instance.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.c_void_p]
+    lib.gsapi_new_instance.restype = ctypes.c_int
+    lib.gsapi_set_arg_encoding.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.gsapi_set_arg_encoding.restype = ctypes.c_int
+    lib.gsapi_set_stdio.argtypes = [ctypes.c_void_p, _STDIO_CALLBACK, _STDIO_CALLBACK, _STDIO_CALLBACK]
+    lib.gsapi_set_stdio.restype = ctypes.c_int
+    lib.gsapi_init_with_args.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_char_p)]
+    lib.gsapi_init_with_args.restype = ctypes.c_int
+    lib.gsapi_exit.argtypes = [ctypes.c_void_p]
+    lib.gsapi_exit.restype = ctypes.c_int
+    lib.gsapi_delete_instance.argtypes = [ctypes.c_void_p]
+    lib.gsapi_delete_instance.restype = None
+    return lib
+
+
+def _init_worker(libgs_path, limits, pids):
+    global _libgs
+    # Lets the engine find this process if a job on it has to be killed
+    pids.put(os.getpid())
+    # As for pooled interpreters, CPU time would accumulate across jobs, so it isn't limited here
+    limits.apply_rlimits()
+    _libgs = _load(libgs_path)
+
+
+def _warm_up(_):
+    return os.getpid()
+
+
+def _run_in_worker(input_pdf_path, output_pdf_path, preset_name):
+    """
+    Run one conversion through gsapi inside a pool worker
+    Returns (success: bool, error_output: str, interpreter_seconds: float, usage: dict)
+    """
+    captured = []
+
+    def _stdin(handle, buf, length):
+        return 0
+
+    def _stdout(handle, buf, length):
+        return length
+
+    def _stderr(handle, buf, length):
+        captured.append(ctypes.string_at(buf, length).decode('utf-8', 'replace'))
+        return length
+
+    # Keep references to the callbacks alive for the lifetime of the instance
+    callbacks = (_STDIO_CALLBACK(_stdin), _STDIO_CALLBACK(_stdout), _STDIO_CALLBACK(_stderr))
+
+    argv = [arg.encode('utf-8') for arg in build_gs_cmd(input_pdf_path, output_pdf_path, PRESETS[preset_name])]
+    c_argv = (ctypes.c_char_p * len(argv))(*argv)
+
+    instance = ctypes.c_void_p()
+    code = _libgs.gsapi_new_instance(ctypes.byref(instance), None)
+    if code < 0:
+        return False, f"gsapi_new_instance failed with code {code}", 0.0, {}
+
+    reset_peak_rss()
+    before = read_proc_usage()
+    started = time.perf_counter()
+    try:
+        _libgs.gsapi_set_arg_encoding(instance, GS_ARG_ENCODING_UTF8)
+        _libgs.gsapi_set_stdio(instance, *callbacks)
+        code = _libgs.gsapi_init_with_args(instance, len(argv), c_argv)
+        exit_code = _libgs.gsapi_exit(instance)
+    finally:
+        _libgs.gsapi_delete_instance(instance)
+    interpreter_seconds = time.perf_counter() - started
+    usage = proc_usage_delta(before, read_proc_usage())
+    usage['wall_seconds'] = interpreter_seconds
+
+    ok = code in (0, GS_ERROR_QUIT) and exit_code in (0, GS_ERROR_QUIT)
+    return ok, ''.join(captured), interpreter_seconds, usage
+
+
+class GsapiEngine:
+    """Process pool of warm workers running Ghostscript through libgs"""
+
+    def __init__(self, size, max_jobs_per_worker=None, libgs_path=None, limits=None):
+        self.libgs_path = libgs_path or find_libgs()
+        self.size = size
+        self.max_jobs_per_worker = max_jobs_per_worker
+        limits = limits or GsLimits()
+        self.timeout = limits.wall_seconds
+        self.limits = GsLimits(memory_bytes=limits.memory_bytes, output_bytes=limits.output_bytes)
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._context = multiprocessing.get_context('spawn')
+        self._worker_pids = {}  # executor -> queue its workers report their pids on
+        started = time.perf_counter()
+        self._executor = self._new_executor()
+        # Pay the worker spawn and library load up front rather than on the first uploads
+        pids = set(self._executor.map(_warm_up, range(size)))
+        logger.info("gsapi engine warmed %d worker(s) in %.3fs", len(pids), time.perf_counter() - started)
+
+    def _new_executor(self):
+        pids = self._context.SimpleQueue()
+        executor = ProcessPoolExecutor(
+            max_workers=self.size,
+            mp_context=self._context,
+            initializer=_init_worker,
+            initargs=(self.libgs_path, self.limits, pids),
+            max_tasks_per_child=self.max_jobs_per_worker
+        )
+        self._worker_pids[executor] = pids
+        return executor
+
+    def _replace(self, executor):
+        """Kill the workers of a broken or stuck executor and start a new one, once per executor"""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = self._new_executor()
+            self.restarts += 1
+            pids = self._worker_pids.pop(executor)
+        reported = set()
+        while not pids.empty():
+            reported.add(pids.get())
+        # There is no public way to stop a running task, so kill the workers. Pids of
+        # workers that have since been recycled are skipped: only live children match
+        for process in multiprocessing.active_children():
+            if process.pid in reported:
+                process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+        pids.close()
+
+    def run(self, input_pdf_path, output_pdf_path, preset):
+        """
+        Convert a document on a warm worker
+        Returns a GsRun
+        """
+        executor = self._executor
+        submitted = time.perf_counter()
+        try:
+            ok, error_output, interpreter_seconds, usage = executor.submit(
+                _run_in_worker, input_pdf_path, output_pdf_path, preset.name
+            ).result(timeout=self.timeout)
+        except TimeoutError:
+            self._replace(executor)
+            return GsRun(-signal.SIGKILL, '', "gsapi worker timed out", {}, LIMIT_TIMEOUT)
+        except BrokenProcessPool as e:
+            self._replace(executor)
+            return GsRun(-signal.SIGKILL, '', f"gsapi worker died: {e}", {}, crashed=True)
+        total = time.perf_counter() - submitted
+        logger.info("gsapi conversion: interpreter %.3fs, dispatch overhead %.3fs",
+                    interpreter_seconds, total - interpreter_seconds)
+        if ok:
+            return GsRun(0, '', error_output, usage)
+        limit = detect_limit(1, False, usage, error_output, self.limits)
+        # Python ignores SIGXFSZ, so hitting RLIMIT_FSIZE shows up as a write error instead
+        if not limit and self.limits.output_bytes and os.path.exists(output_pdf_path) \
+                and os.path.getsize(output_pdf_path) >= self.limits.output_bytes:
+            limit = LIMIT_OUTPUT
+        return GsRun(1, '', error_output, usage, limit)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,256 @@
+"""
+Background conversion jobs
+
+Uploads submitted through the job API are queued and converted by a fixed
+number of worker threads, so the web tier only holds a request open for the
+upload itself. Which queued job a free worker picks up is up to the
+scheduling policy (see scheduling.py). A caller that bounds the wait for
+a conversion itself can start a job on a thread of its own instead of
+queueing it. Finished jobs are kept for `retention` seconds so clients can
+poll for the state and download the result.
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+import uuid
+
+from scheduling import SchedulingPolicy, Waiting
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when the pending queue has no room for another job"""
+
+
+class Job:
+    """State and timings of a single conversion job"""
+
+    def __init__(self, input_path, output_path, filename, on_done=None, options=None, estimate=None, workdir=None,
+                 context=None):
+        self.id = uuid.uuid4().hex
+        self.input_path = input_path
+        self.output_path = output_path
+        self.workdir = workdir
+        self.filename = filename
+        self.state = 'queued'
+        self.message = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.on_done = on_done
+        self.options = options or {}
+        self.context = context or {}
+        self.estimate = estimate
+        self.ticket = Waiting(estimate['wall_seconds'] if estimate else None, self)
+        self.discarded = False
+        self.collected = False
+        self.report = {}
+
+    @property
+    def finished(self):
+        return self.state in ('succeeded', 'failed')
+
+    def to_dict(self):
+        timings = {
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'queue_seconds': None,
+            'run_seconds': None,
+        }
+        if self.started_at is not None:
+            timings['queue_seconds'] = round(self.started_at - self.submitted_at, 3)
+        if self.finished_at is not None:
+            timings['run_seconds'] = round(self.finished_at - self.started_at, 3)
+        return {
+            'job_id': self.id,
+            'state': self.state,
+            'filename': self.filename,
+            'options': self.options,
+            'estimate': self.estimate,
+            'message': self.message,
+            'timings': timings,
+            'error_code': self.report.get('error_code'),
+            'usage': self.report.get('usage'),
+        }
+
+
+class JobManager:
+    """Bounded queue of jobs served by a fixed pool of worker threads"""
+
+    def __init__(self, convert, workers=2, max_queue=100, retention=3600, on_finished=None, policy=None):
+        self.convert = convert
+        self.policy = policy or SchedulingPolicy('fifo')
+        self.on_finished = on_finished
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retention = retention
+        self.rejected = 0
+        self._jobs = {}
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, input_path, output_path, filename, on_done=None, options=None, estimate=None, workdir=None,
+               context=None):
+        """
+        Queue a conversion, raising QueueFull when the queue is at capacity
+        `options` are passed to the convert function as keyword arguments, and so is
+        `context`, which is what the caller already knows about the input and isn't
+        reported with the job.
+        `estimate` is the expected cost, a dict with 'wall_seconds', if known.
+        `workdir` is the scratch directory holding the job's files, removed with them.
+        `on_done(job)` is called from the worker thread once the job has finished.
+        """
+        job = Job(input_path, output_path, filename, on_done, options, estimate, workdir, context)
+        with self._cond:
+            self._expire()
+            if len(self._pending) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull()
+            self._start_workers()
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._cond.notify()
+        return job
+
+    def start(self, input_path, output_path, filename, on_done=None, options=None, estimate=None, workdir=None,
+              context=None):
+        """
+        Run a conversion right away on a thread of its own, bypassing the queue
+        Takes the same arguments as submit(). The job never waits in the queue, so
+        `on_finished` isn't called for it.
+        """
+        job = Job(input_path, output_path, filename, on_done, options, estimate, workdir, context)
+        with self._cond:
+            self._expire()
+            self._jobs[job.id] = job
+            job.state = 'running'
+            job.started_at = time.time()
+        threading.Thread(target=self._run, args=(job, (job.on_done,)), daemon=True).start()
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def discard(self, job, keep_status=False):
+        """
+        Forget a job whose result nobody will collect, deleting its files
+        With `keep_status` the job can still be looked up until it expires, marked as `collected`.
+        """
+        with self._cond:
+            if keep_status:
+                job.collected = True
+            else:
+                self._jobs.pop(job.id, None)
+            if job in self._pending:
+                self._pending.remove(job)
+                _remove_files(job)
+            elif job.finished:
+                _remove_files(job)
+            else:
+                # Still running; the worker deletes the output when it finishes
+                job.discarded = True
+
+    def _ordered_pending(self):
+        return [ticket.item for ticket in self.policy.order([job.ticket for job in self._pending])]
+
+    def queue_position(self, job):
+        """1-based position in the order pending jobs will start, or None once the job has started"""
+        with self._cond:
+            try:
+                return self._ordered_pending().index(job) + 1
+            except ValueError:
+                return None
+
+    def eta(self, job):
+        """
+        Estimated seconds until `job` finishes, or None without an estimate for it
+        Work ahead of it is assumed to spread evenly over the workers; jobs without
+        an estimate of their own don't count.
+        """
+        with self._cond:
+            if job.finished or not job.estimate:
+                return None
+            now = time.time()
+            if job.state == 'running':
+                return round(max(0.0, job.estimate['wall_seconds'] - (now - job.started_at)), 3)
+            ahead = sum(max(0.0, other.estimate['wall_seconds'] - (now - other.started_at))
+                        for other in self._jobs.values() if other.state == 'running' and other.estimate)
+            for other in self._ordered_pending():
+                if other is job:
+                    break
+                if other.estimate:
+                    ahead += other.estimate['wall_seconds']
+            return round(ahead / self.workers + job.estimate['wall_seconds'], 3)
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job = self.policy.first([pending.ticket for pending in self._pending]).item
+                self._pending.remove(job)
+                job.state = 'running'
+                job.started_at = time.time()
+            self._run(job, (self.on_finished, job.on_done))
+
+    def _run(self, job, callbacks):
+        try:
+            success, message = self.convert(job.input_path, job.output_path, job.report,
+                                            **job.options, **job.context)
+        except Exception as e:
+            success, message = False, f"Conversion error: {str(e)}"
+        finally:
+            _unlink(job.input_path)
+        with self._cond:
+            job.state = 'succeeded' if success else 'failed'
+            job.message = message
+            job.finished_at = time.time()
+            if not success or job.discarded:
+                _remove_files(job)
+        for callback in callbacks:
+            if callback:
+                try:
+                    callback(job)
+                except Exception:
+                    logger.exception("Job callback error")
+
+    def _expire(self):
+        """Forget finished jobs past their retention and delete their results"""
+        cutoff = time.time() - self.retention
+        expired = [job for job in self._jobs.values() if job.finished and job.finished_at < cutoff]
+        for job in expired:
+            del self._jobs[job.id]
+            _remove_files(job)
+
+
+def _remove_files(job):
+    _unlink(job.input_path)
+    _unlink(job.output_path)
+    if job.workdir:
+        job.workdir.cleanup()
+
+
+def _unlink(path):
+    try:
+        if path and os.path.exists(path):
+            os.unlink(path)
+    except OSError as e:
+        logger.warning("Cleanup error: %s", e)
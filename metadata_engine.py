@@ -0,0 +1,259 @@
+"""
+Metadata-only conversion by PDF incremental update
+
+For documents that are already tagged, PDF/UA identification can be added
+without re-rendering anything: the original bytes are copied unchanged and
+an incremental update is appended with a new catalog revision (/MarkInfo,
+/ViewerPreferences /DisplayDocTitle and /Lang filled in where missing) and
+an XMP packet that declares pdfuaid:part. Existing structure trees survive,
+and the cost grows with the size of the metadata rather than the document.
+"""
+
+import re
+import resource
+import shutil
+import time
+from xml.sax.saxutils import escape
+
+from gs_runner import BLOCK_SIZE, GsRun
+from pdf_parser import XMP_NAMESPACES, Name, PdfDocument, PdfError, Ref, Stream, XrefStream, xmp_values
+
+PDFUA_PART = 1
+
+XMP_TEMPLATE = '''<?xpacket begin="﻿" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+{descriptions}
+</rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>'''
+
+NAME_SAFE_RE = re.compile(rb'[^\x21-\x7e]|[#()<>\[\]{}/%]')
+
+
+def serialize(value):
+    """PDF syntax for a value produced by pdf_parser"""
+    if value is None:
+        return b'null'
+    if value is True:
+        return b'true'
+    if value is False:
+        return b'false'
+    if isinstance(value, Name):
+        return b'/' + NAME_SAFE_RE.sub(lambda m: b'#%02X' % m.group()[0], value.encode('latin-1'))
+    if isinstance(value, Ref):
+        return b'%d %d R' % (value.num, value.gen)
+    if isinstance(value, int):
+        return str(value).encode()
+    if isinstance(value, float):
+        return (f'{value:.6f}'.rstrip('0').rstrip('.') or '0').encode()
+    if isinstance(value, (bytes, bytearray)):
+        return b'<' + bytes(value).hex().encode() + b'>'
+    if isinstance(value, str):
+        return serialize(_pdf_text(value))
+    if isinstance(value, list):
+        return b'[' + b' '.join(serialize(item) for item in value) + b']'
+    if isinstance(value, dict):
+        return b'<<' + b''.join(serialize(Name(key)) + b' ' + serialize(item) + b'\n'
+                                for key, item in value.items()) + b'>>'
+    raise PdfError(f"Can't serialize {type(value).__name__}")
+
+
+def _pdf_text(text):
+    """A text string as PDF bytes: PDFDocEncoding if it's plain Latin-1, UTF-16BE otherwise"""
+    try:
+        return text.encode('latin-1')
+    except UnicodeEncodeError:
+        return b'\xfe\xff' + text.encode('utf-16-be')
+
+
+def _decode_text(value):
+    if not isinstance(value, bytes):
+        return None
+    if value.startswith(b'\xfe\xff'):
+        return value[2:].decode('utf-16-be', 'replace')
+    if value.startswith(b'\xef\xbb\xbf'):
+        return value[3:].decode('utf-8', 'replace')
+    return value.decode('latin-1')
+
+
+def _description(namespace, body):
+    return (f'<rdf:Description rdf:about="" xmlns:{namespace}="{XMP_NAMESPACES[namespace]}">'
+            f'{body}</rdf:Description>')
+
+
+def updated_xmp(xmp, title):
+    """
+    An XMP packet declaring PDF/UA, based on the existing one when there is one
+    `title` is added as dc:title when the packet has none.
+    """
+    values = xmp_values(xmp) if xmp else {'pdfua_part': None, 'title': False}
+    additions = []
+    if not values['pdfua_part']:
+        additions.append(_description('pdfuaid', f'<pdfuaid:part>{PDFUA_PART}</pdfuaid:part>'))
+    if not values['title'] and title:
+        additions.append(_description(
+            'dc', f'<dc:title><rdf:Alt><rdf:li xml:lang="x-default">{escape(title)}</rdf:li></rdf:Alt></dc:title>'))
+    if xmp and not additions:
+        return xmp
+    if xmp:
+        text = xmp.decode('utf-8', 'replace')
+        end = text.rfind('</rdf:RDF>')
+        if end >= 0:
+            return (text[:end] + '\n'.join(additions) + '\n' + text[end:]).encode('utf-8')
+    return XMP_TEMPLATE.format(descriptions='\n'.join(additions)).encode('utf-8')
+
+
+class _Update:
+    """New object revisions appended after the original bytes"""
+
+    def __init__(self, document):
+        self.document = document
+        self.next_number = document.trailer['Size']
+        self.objects = {}  # number -> (generation, serialized body)
+
+    def add(self, body):
+        number = self.next_number
+        self.next_number += 1
+        self.objects[number] = (0, body)
+        return Ref(number, 0)
+
+    def replace(self, ref, body):
+        self.objects[ref.num] = (ref.gen, body)
+
+    def write(self, out, base_offset, prev_offset):
+        """Append the objects and an xref section of the kind the file already uses"""
+        offsets = {}  # number -> (offset, generation)
+        chunks = [b'\n']
+        position = base_offset + 1
+        for number in sorted(self.objects):
+            gen, body = self.objects[number]
+            offsets[number] = (position, gen)
+            chunk = b'%d %d obj\n' % (number, gen) + body + b'\nendobj\n'
+            chunks.append(chunk)
+            position += len(chunk)
+
+        trailer = {key: value for key, value in self.document.trailer.items()
+                   if key in ('Root', 'Info', 'ID')}
+        trailer['Size'] = self.next_number
+        trailer['Prev'] = prev_offset
+        xref_offset = position
+        if isinstance(self.document.sections[0], XrefStream):
+            # The section describes itself, so it needs an object number too
+            own = self.next_number
+            offsets[own] = (xref_offset, 0)
+            trailer['Size'] = own + 1
+            numbers = sorted(offsets)
+            data = b''.join(b'\x01' + offsets[n][0].to_bytes(4, 'big') + offsets[n][1].to_bytes(2, 'big')
+                            for n in numbers)
+            trailer.update({'Type': Name('XRef'), 'W': [1, 4, 2], 'Index': _index(numbers), 'Length': len(data)})
+            chunks.append(b'%d 0 obj\n' % own + serialize(trailer) + b'\nstream\n' + data
+                          + b'\nendstream\nendobj\n')
+        else:
+            lines = [b'xref\n']
+            for first, count in zip(*[iter(_index(sorted(offsets)))] * 2):
+                lines.append(b'%d %d\n' % (first, count))
+                lines.extend(b'%010d %05d n \n' % offsets[n] for n in range(first, first + count))
+            chunks.append(b''.join(lines) + b'trailer\n' + serialize(trailer) + b'\n')
+        chunks.append(b'startxref\n%d\n%%%%EOF\n' % xref_offset)
+        out.write(b''.join(chunks))
+
+
+def _index(numbers):
+    """/Index array of consecutive runs in sorted object numbers"""
+    index = []
+    for number in numbers:
+        if index and index[-2] + index[-1] == number:
+            index[-1] += 1
+        else:
+            index += [number, 1]
+    return index
+
+
+def add_ua_identification(input_pdf_path, output_pdf_path, default_lang='en-US'):
+    """
+    Write `input_pdf_path` plus an incremental update that identifies it as PDF/UA
+    Raises PdfError for documents this can't be done for (encrypted or untagged).
+    Returns the list of changes made
+    """
+    with PdfDocument(input_pdf_path) as doc:
+        if doc.encrypted:
+            raise PdfError("Encrypted documents can't be updated in place")
+        root = doc.trailer.get('Root')
+        if not isinstance(root, Ref):
+            raise PdfError("Document catalog is not an indirect object")
+        catalog = dict(doc.catalog)
+        if catalog.get('StructTreeRoot') is None:
+            raise PdfError("Document has no structure tree; it needs a full conversion")
+
+        update = _Update(doc)
+        changes = []
+        mark_info = doc.resolve(catalog.get('MarkInfo'))
+        if not isinstance(mark_info, dict) or doc.resolve(mark_info.get('Marked')) is not True:
+            catalog['MarkInfo'] = dict(mark_info or {}, Marked=True)
+            changes.append('MarkInfo')
+        viewer_preferences = doc.resolve(catalog.get('ViewerPreferences'))
+        if not isinstance(viewer_preferences, dict) or \
+                doc.resolve(viewer_preferences.get('DisplayDocTitle')) is not True:
+            catalog['ViewerPreferences'] = dict(viewer_preferences or {}, DisplayDocTitle=True)
+            changes.append('DisplayDocTitle')
+        if not doc.resolve(catalog.get('Lang')) and default_lang:
+            catalog['Lang'] = _pdf_text(default_lang)
+            changes.append('Lang')
+
+        metadata = doc.resolve(catalog.get('Metadata'))
+        xmp = metadata.data() if isinstance(metadata, Stream) else None
+        info = doc.resolve(doc.trailer.get('Info'))
+        title = _decode_text(doc.resolve(info.get('Title'))) if isinstance(info, dict) else None
+        new_xmp = updated_xmp(xmp, title)
+        if new_xmp != xmp:
+            # PDF/A wants the metadata stream unfiltered
+            catalog['Metadata'] = update.add(
+                serialize({'Type': Name('Metadata'), 'Subtype': Name('XML'), 'Length': len(new_xmp)})
+                + b'\nstream\n' + new_xmp + b'\nendstream')
+            changes.append('XMP')
+
+        if changes:
+            update.replace(root, serialize(catalog))
+        prev_offset = doc.startxref
+        size = len(doc.buf)
+
+    shutil.copyfile(input_pdf_path, output_pdf_path)
+    if changes:
+        with open(output_pdf_path, 'ab') as out:
+            update.write(out, size, prev_offset)
+    return changes
+
+
+class MetadataEngine:
+    """Conversion engine that only adds PDF/UA identification; see add_ua_identification"""
+
+    def __init__(self, default_lang='en-US'):
+        self.default_lang = default_lang
+
+    def run(self, input_pdf_path, output_pdf_path, preset=None):
+        """
+        Update a tagged document in place of a Ghostscript run; `preset` doesn't apply
+        Returns a GsRun
+        """
+        started = time.perf_counter()
+        before = resource.getrusage(resource.RUSAGE_THREAD)
+        try:
+            changes = add_ua_identification(input_pdf_path, output_pdf_path, self.default_lang)
+            returncode, stdout, stderr = 0, f"Updated: {', '.join(changes) or 'nothing'}", ''
+        except (PdfError, OSError, KeyError, ValueError, TypeError) as e:
+            returncode, stdout, stderr = 1, '', f"Error: metadata update failed: {e}"
+        after = resource.getrusage(resource.RUSAGE_THREAD)
+        usage = {
+            'user_cpu_seconds': after.ru_utime - before.ru_utime,
+            'system_cpu_seconds': after.ru_stime - before.ru_stime,
+            'peak_rss_bytes': 0,
+            'block_read_bytes': (after.ru_inblock - before.ru_inblock) * BLOCK_SIZE,
+            'block_write_bytes': (after.ru_oublock - before.ru_oublock) * BLOCK_SIZE,
+            'wall_seconds': time.perf_counter() - started,
+            'source': 'thread',
+        }
+        return GsRun(returncode, stdout, stderr, usage)
+
+    def close(self):
+        pass
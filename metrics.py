@@ -0,0 +1,252 @@
+"""
+Minimal Prometheus-style metrics with a file-backed multi-process registry
+
+Each server process keeps its samples in memory and periodically writes a
+snapshot to `<directory>/<pid>-<start>.json`. Rendering reads every snapshot
+in the directory and merges them: counters and histograms are summed over all
+processes, including ones that have exited, while gauges are summed over live
+processes only. Clear the directory when the service is redeployed.
+"""
+
+import atexit
+import glob
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, math.inf)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.samples = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return json.dumps([str(labels[name]) for name in self.labelnames])
+
+    def snapshot(self):
+        return {'type': self.type, 'help': self.documentation, 'labelnames': list(self.labelnames),
+                'samples': dict(self.samples)}
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+            self.registry.touch()
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+            self.registry.touch()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.samples[key] = value
+            self.registry.touch()
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        if buckets[-1] != math.inf:
+            buckets = (*buckets, math.inf)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                sample = self.samples[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample['buckets'][i] += 1
+                    break
+            sample['sum'] += value
+            sample['count'] += 1
+            self.registry.touch()
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['samples'] = {key: dict(sample, buckets=list(sample['buckets']))
+                               for key, sample in self.samples.items()}
+        snapshot['bucket_bounds'] = [_format_value(bound) for bound in self.buckets]
+        return snapshot
+
+
+class Registry:
+    """Collection of metrics shared by all server processes through `directory`"""
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.dirty = False
+        self._metrics = {}
+        self._pid = None
+        self._path = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def touch(self):
+        """Mark samples as changed; called with `lock` held"""
+        self.dirty = True
+        # A forked worker gets its own snapshot file and flusher thread
+        if self.directory and self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._path = os.path.join(self.directory, f'{self._pid}-{time.time_ns()}.json')
+            threading.Thread(target=self._flush_loop, daemon=True).start()
+            atexit.register(self.flush)
+
+    def _snapshot(self):
+        with self.lock:
+            self.dirty = False
+            return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def flush(self):
+        """Write this process's samples where other processes can read them"""
+        if not self.directory or self._pid != os.getpid():
+            return
+        path = self._path
+        data = json.dumps(self._snapshot())
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self.dirty:
+                try:
+                    self.flush()
+                except OSError as e:
+                    logger.warning("Metrics flush error: %s", e)
+
+    def collect(self):
+        """Merge the snapshots of all processes"""
+        if not self.directory:
+            return self._snapshot()
+        self.flush()
+        merged = {}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _pid_alive(int(os.path.basename(path).split('-', 1)[0]))
+            for name, metric in snapshot.items():
+                if metric['type'] == 'gauge' and not alive:
+                    continue
+                target = merged.setdefault(name, dict(metric, samples={}))
+                for key, sample in metric['samples'].items():
+                    if metric['type'] == 'histogram':
+                        current = target['samples'].get(key)
+                        if current is None:
+                            target['samples'][key] = dict(sample, buckets=list(sample['buckets']))
+                        else:
+                            current['buckets'] = [a + b for a, b in zip(current['buckets'], sample['buckets'])]
+                            current['sum'] += sample['sum']
+                            current['count'] += sample['count']
+                    else:
+                        target['samples'][key] = target['samples'].get(key, 0) + sample
+        # Metrics this process knows about but nobody has touched yet
+        for name, metric in self._metrics.items():
+            merged.setdefault(name, metric.snapshot())
+        return merged
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for name, metric in sorted(self.collect().items()):
+            labelnames = metric['labelnames']
+            lines.append(f'# HELP {name} {metric["help"]}')
+            lines.append(f'# TYPE {name} {metric["type"]}')
+            for key, sample in sorted(metric['samples'].items()):
+                values = json.loads(key)
+                if metric['type'] == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric['bucket_bounds'], sample['buckets']):
+                        cumulative += count
+                        labels = _format_labels(labelnames, values, ('le', bound))
+                        lines.append(f'{name}_bucket{labels} {cumulative}')
+                    labels = _format_labels(labelnames, values)
+                    lines.append(f'{name}_sum{labels} {_format_value(sample["sum"])}')
+                    lines.append(f'{name}_count{labels} {sample["count"]}')
+                else:
+                    lines.append(f'{name}{_format_labels(labelnames, values)} {_format_value(sample)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,123 @@
+"""
+Cache of conversions that failed
+
+Some documents make Ghostscript fail every time, and upstream retry loops
+resubmit them anyway. Failures are remembered by the same key as results
+(input hash plus flags digest) for `ttl` seconds, so a retry gets the same
+error straight back instead of paying for another failed run. Entries are
+small JSON files shared by all server processes; expired ones are deleted
+when they are next read or by a periodic sweep.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = 300.0  # seconds between sweeps for expired entries
+
+
+class NegativeCache:
+    """TTL-bounded on-disk store of failed conversion outcomes"""
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key):
+        """The cached failure for `key` (a dict with 'error_code', 'message', 'cpu_seconds'), or None"""
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('expires_at', 0) <= time.time():
+            self._unlink(self._path(key))
+            return None
+        return entry
+
+    def put(self, key, error_code, message, cpu_seconds, input_sha256=None, preset=None):
+        """Remember a failure, replacing any previous entry atomically"""
+        now = time.time()
+        entry = {
+            'error_code': error_code,
+            'message': message,
+            'cpu_seconds': cpu_seconds,
+            'sha256': input_sha256,
+            'preset': preset,
+            'failed_at': now,
+            'expires_at': now + self.ttl,
+        }
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.sweep()
+
+    def purge(self, input_sha256=None):
+        """
+        Delete every entry, or only those for one input's SHA-256
+        Returns the number of entries deleted
+        """
+        deleted = 0
+        for entry in self._entries():
+            if input_sha256 is not None:
+                try:
+                    with open(entry.path) as f:
+                        if json.load(f).get('sha256') != input_sha256:
+                            continue
+                except (OSError, ValueError):
+                    continue
+            if self._unlink(entry.path):
+                deleted += 1
+        return deleted
+
+    def sweep(self, force=False):
+        """Delete expired entries, at most once per SWEEP_INTERVAL unless forced"""
+        with self._lock:
+            now = time.time()
+            if not force and now - self._last_sweep < SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+        for entry in self._entries():
+            try:
+                # Entries are never rewritten in place, so mtime + ttl is when they expire
+                if entry.stat().st_mtime + self.ttl <= now:
+                    self._unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {'entries': len(self._entries()), 'ttl_seconds': self.ttl}
+
+    def _entries(self):
+        try:
+            return [entry for entry in os.scandir(self.directory) if entry.name.endswith('.json')]
+        except OSError as e:
+            logger.warning("Negative cache error: %s", e)
+            return []
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.warning("Negative cache error: %s", e)
+            return False
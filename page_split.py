@@ -0,0 +1,110 @@
+"""
+Split/convert/merge conversion of large documents
+
+A single Ghostscript run uses one core. For long documents we convert page
+ranges (-dFirstPage/-dLastPage) in parallel `gs` processes and then merge the
+converted parts with one more pdfwrite pass, so the merged file gets its
+Info dictionary, XMP metadata and OutputIntent written exactly like a
+single-pass conversion. The merge uses MERGE_FLAGS rather than the preset:
+the parts' images were already resampled and encoded by the preset, and
+doing that a second time would only lose quality. Each part keeps the outline
+entries pointing at its own pages, and the merge pass concatenates them.
+"""
+
+import math
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gs_args import DEFAULT_PRESET, GS_BATCH_FLAGS, GS_BINARY, MERGE_FLAGS, PRESETS, build_gs_cmd
+from gs_pool import ps_string
+from gs_runner import LIMIT_TIMEOUT, GsLimits, GsRun, combine_usage, run_gs
+
+
+def count_pages(input_pdf_path, gs_binary=GS_BINARY):
+    """Page count reported by Ghostscript, or None if it can't be determined"""
+    cmd = [
+        gs_binary, '-q', '-dNODISPLAY', '-dSAFER',
+        f'--permit-file-read={input_pdf_path}',
+        '-c', f'{ps_string(input_pdf_path)} (r) file runpdfbegin pdfpagecount = quit'
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        return int(result.stdout.strip().splitlines()[-1])
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+        return None
+
+
+def page_ranges(page_count, parts, min_pages_per_range=1):
+    """Split pages 1..page_count into at most `parts` contiguous (first, last) ranges"""
+    parts = max(1, min(parts, page_count // max(1, min_pages_per_range)))
+    size = math.ceil(page_count / parts)
+    return [(first, min(first + size - 1, page_count)) for first in range(1, page_count + 1, size)]
+
+
+def convert_in_ranges(input_pdf_path, output_pdf_path, page_count, workers, min_pages_per_range=1,
+                      cgroup_parent=None, limits=None, preset=None, scratch_dir=None):
+    """
+    Convert page ranges in parallel and merge them into one PDF/UA file
+    The parts and the merge share the wall-clock limit of `limits` as one deadline;
+    its other limits apply to each process. The parts are written to a temporary
+    directory inside `scratch_dir`.
+    Returns (result: GsRun, stats: dict)
+    """
+    if preset is None:
+        preset = PRESETS[DEFAULT_PRESET]
+    limits = limits or GsLimits()
+    started = time.perf_counter()
+    deadline = started + limits.wall_seconds if limits.wall_seconds else None
+
+    def _run(cmd):
+        run_limits = limits
+        if deadline is not None:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return GsRun(-signal.SIGKILL, '', "Time limit reached before the run could start",
+                             {'wall_seconds': 0.0}, LIMIT_TIMEOUT)
+            run_limits = GsLimits(remaining, limits.cpu_seconds, limits.memory_bytes, limits.output_bytes)
+        return run_gs(cmd, cgroup_parent, run_limits)
+
+    ranges = page_ranges(page_count, workers, min_pages_per_range)
+    parts_dir = tempfile.mkdtemp(prefix='pdfua-parts-', dir=scratch_dir)
+    try:
+        part_paths = [os.path.join(parts_dir, f'part-{i:04d}.pdf') for i in range(len(ranges))]
+        part_cmds = [
+            build_gs_cmd(input_pdf_path, part_path, preset,
+                         extra_flags=[f'-dFirstPage={first}', f'-dLastPage={last}'])
+            for part_path, (first, last) in zip(part_paths, ranges)
+        ]
+        with ThreadPoolExecutor(max_workers=len(part_cmds)) as executor:
+            results = list(executor.map(_run, part_cmds))
+        converted = time.perf_counter()
+
+        stats = {
+            'ranges': len(ranges),
+            'part_seconds': [round(result.usage['wall_seconds'], 3) for result in results],
+        }
+        for result in results:
+            if not result.ok:
+                result.usage = combine_usage([r.usage for r in results])
+                return result, stats
+
+        merge_cmd = [GS_BINARY, *GS_BATCH_FLAGS, *MERGE_FLAGS, f'-sOutputFile={output_pdf_path}', *part_paths]
+        merge = _run(merge_cmd)
+
+        wall_seconds = time.perf_counter() - started
+        stats.update({
+            'convert_seconds': round(converted - started, 3),
+            'merge_seconds': round(merge.usage['wall_seconds'], 3),
+            'wall_seconds': round(wall_seconds, 3),
+        })
+        merge.usage = combine_usage([r.usage for r in results] + [merge.usage])
+        merge.usage['wall_seconds'] = wall_seconds
+        merge.usage['ranges'] = len(ranges)
+        return merge, stats
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
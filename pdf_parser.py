@@ -0,0 +1,788 @@
+"""
+Minimal memory-mapped PDF reader
+
+Just enough of the file format to answer questions about a document without
+a Ghostscript run: the xref chain (classic tables and xref streams, newest
+section first) is located from `startxref` and consulted only for the objects
+that are actually requested. Objects are parsed straight out of the mapping,
+compressed object streams are decoded on demand, and nothing is decrypted.
+Files whose xref is unusable can be indexed by a bounded scan for object
+headers instead (see `repair`).
+"""
+
+import bisect
+import mmap
+import re
+import xml.etree.ElementTree as ET
+import zlib
+
+WHITESPACE = b'\x00\t\n\x0c\r '
+
+NUMBER_RE = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)')
+REF_RE = re.compile(rb'\s+(\d+)\s+R(?=[\s()<>\[\]{}/%]|$)')
+OBJ_HEADER_RE = re.compile(rb'(\d+)\s+(\d+)\s+obj\b')
+NAME_ESCAPE_RE = re.compile(rb'#([0-9A-Fa-f]{2})')
+TOKEN_END_RE = re.compile(rb'[\x00\t\n\x0c\r ()<>\[\]{}/%]')
+XREF_SUBSECTION_RE = re.compile(rb'(\d+)\s+(\d+)[ \t]*\r?\n?')
+XREF_ENTRY_RE = re.compile(rb'(\d{10})\s(\d{5})\s([nf])')
+HEADER_RE = re.compile(rb'%PDF-(\d\.\d)')
+OBJ_KEYWORD_RE = re.compile(rb'obj\b')
+OBJ_HEADER_TAIL_RE = re.compile(rb'(?:^|[\x00\t\n\x0c\r ])(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+$')
+# Keys that make an object interesting to preflight; matching objects are then parsed properly
+PREFLIGHT_MARKER_RE = re.compile(
+    rb'/(?:Subtype\s*/Image|Type\s*/Font|S\s*/Transparency|SMask|ca|CA)(?=[\x00\t\n\x0c\r ()<>\[\]{}/%])')
+
+STARTXREF_WINDOW = 2048  # bytes at the end of the file searched for `startxref`
+MAX_XREF_SECTIONS = 256  # guards against /Prev loops
+MAX_SCAN_OBJECTS = 500000  # object headers indexed by the repair scan
+MAX_PREFLIGHT_OBJECTS = 50000  # object dictionaries parsed by preflight()
+
+XMP_NAMESPACES = {
+    'pdfuaid': 'http://www.aiim.org/pdfua/ns/id/',
+    'pdfaid': 'http://www.aiim.org/pdfa/ns/id/',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+}
+
+
+class PdfError(Exception):
+    """Raised for anything this reader can't make sense of"""
+
+
+class Name(str):
+    """A PDF name object, without the leading slash"""
+
+
+class Ref:
+    """An indirect reference"""
+
+    __slots__ = ('num', 'gen')
+
+    def __init__(self, num, gen):
+        self.num = num
+        self.gen = gen
+
+    def __eq__(self, other):
+        return isinstance(other, Ref) and (self.num, self.gen) == (other.num, other.gen)
+
+    def __hash__(self):
+        return hash((self.num, self.gen))
+
+    def __repr__(self):
+        return f'Ref({self.num}, {self.gen})'
+
+
+class Stream:
+    """A stream object: its dictionary and where its raw bytes live"""
+
+    def __init__(self, document, dictionary, start, length):
+        self.document = document
+        self.dict = dictionary
+        self.start = start
+        self.length = length
+
+    def raw(self):
+        return self.document.buf[self.start:self.start + self.length]
+
+    def data(self, max_size=None):
+        """Decoded stream data; only FlateDecode (with PNG predictors) is understood"""
+        data = self.raw()
+        filters = self.document.resolve(self.dict.get('Filter'))
+        params = self.document.resolve(self.dict.get('DecodeParms'))
+        if not isinstance(filters, list):
+            filters = [filters] if filters else []
+            params = [params]
+        elif not isinstance(params, list):
+            params = [params] * len(filters)
+        for name, param in zip(filters, params):
+            if name not in ('FlateDecode', 'Fl'):
+                raise PdfError(f"Unsupported stream filter: {name}")
+            data = _inflate(data, max_size)
+            param = self.document.resolve(param) or {}
+            if param.get('Predictor', 1) >= 10:
+                data = _png_unpredict(data, param.get('Columns', 1) * param.get('Colors', 1)
+                                      * param.get('BitsPerComponent', 8) // 8)
+            elif param.get('Predictor', 1) != 1:
+                raise PdfError(f"Unsupported predictor: {param['Predictor']}")
+        return data
+
+
+def _inflate(data, max_size=None):
+    """Inflate `data`, stopping after `max_size` bytes of output"""
+    try:
+        return zlib.decompressobj().decompress(data, max_size or 0)
+    except zlib.error as e:
+        raise PdfError(f"Corrupt FlateDecode stream: {e}")
+
+
+def _png_unpredict(data, columns):
+    row_size = columns + 1
+    previous = bytearray(columns)
+    out = bytearray()
+    for start in range(0, len(data) - row_size + 1, row_size):
+        kind = data[start]
+        row = bytearray(data[start + 1:start + row_size])
+        if kind == 1:
+            for i in range(1, len(row)):
+                row[i] = (row[i] + row[i - 1]) & 0xff
+        elif kind == 2:
+            for i in range(len(row)):
+                row[i] = (row[i] + previous[i]) & 0xff
+        elif kind == 3:
+            for i in range(len(row)):
+                left = row[i - 1] if i else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+        elif kind == 4:
+            for i in range(len(row)):
+                a = row[i - 1] if i else 0
+                b = previous[i]
+                c = previous[i - 1] if i else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                row[i] = (row[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xff
+        out += row
+        previous = row
+    return bytes(out)
+
+
+def _skip_whitespace(buf, pos):
+    """Skip whitespace and comments"""
+    end = len(buf)
+    while pos < end:
+        c = buf[pos]
+        if c in WHITESPACE:
+            pos += 1
+        elif c == 0x25:  # %
+            while pos < end and buf[pos] not in b'\r\n':
+                pos += 1
+        else:
+            break
+    return pos
+
+
+def _parse_literal_string(buf, pos):
+    """Parse `(...)` starting after the opening parenthesis"""
+    out = bytearray()
+    depth = 1
+    end = len(buf)
+    while pos < end:
+        c = buf[pos]
+        pos += 1
+        if c == 0x5c:  # backslash
+            if pos >= end:
+                break
+            e = buf[pos]
+            pos += 1
+            if e in b'01234567':
+                digits = bytes([e])
+                while len(digits) < 3 and pos < end and buf[pos] in b'01234567':
+                    digits += bytes([buf[pos]])
+                    pos += 1
+                out.append(int(digits, 8) & 0xff)
+            elif e == 0x0d:  # line continuation
+                if pos < end and buf[pos] == 0x0a:
+                    pos += 1
+            elif e != 0x0a:
+                out.append({0x6e: 0x0a, 0x72: 0x0d, 0x74: 0x09, 0x62: 0x08, 0x66: 0x0c}.get(e, e))
+        elif c == 0x28:
+            depth += 1
+            out.append(c)
+        elif c == 0x29:
+            depth -= 1
+            if not depth:
+                return bytes(out), pos
+            out.append(c)
+        else:
+            out.append(c)
+    raise PdfError("Unterminated string")
+
+
+def parse_object(buf, pos, depth=0):
+    """Parse one direct object at `pos`; returns (object, position after it)"""
+    if depth > 64:
+        raise PdfError("Objects nested too deeply")
+    pos = _skip_whitespace(buf, pos)
+    if pos >= len(buf):
+        raise PdfError("Unexpected end of data")
+    c = buf[pos]
+    if c == 0x2f:  # /
+        match = TOKEN_END_RE.search(buf, pos + 1)
+        end = match.start() if match else len(buf)
+        raw = NAME_ESCAPE_RE.sub(lambda m: bytes([int(m.group(1), 16)]), buf[pos + 1:end])
+        return Name(raw.decode('latin-1')), end
+    if c == 0x3c:  # <
+        if buf[pos + 1:pos + 2] == b'<':
+            result = {}
+            pos += 2
+            while True:
+                pos = _skip_whitespace(buf, pos)
+                if buf[pos:pos + 2] == b'>>':
+                    return result, pos + 2
+                key, pos = parse_object(buf, pos, depth + 1)
+                if not isinstance(key, Name):
+                    raise PdfError(f"Dictionary key is not a name at offset {pos}")
+                value, pos = parse_object(buf, pos, depth + 1)
+                result[key] = value
+        end = buf.find(b'>', pos)
+        if end < 0:
+            raise PdfError("Unterminated hex string")
+        digits = bytes(ch for ch in buf[pos + 1:end] if ch not in WHITESPACE)
+        if len(digits) % 2:
+            digits += b'0'
+        return bytes.fromhex(digits.decode('ascii')), end + 1
+    if c == 0x28:  # (
+        return _parse_literal_string(buf, pos + 1)
+    if c == 0x5b:  # [
+        result = []
+        pos += 1
+        while True:
+            pos = _skip_whitespace(buf, pos)
+            if buf[pos:pos + 1] == b']':
+                return result, pos + 1
+            value, pos = parse_object(buf, pos, depth + 1)
+            result.append(value)
+    match = NUMBER_RE.match(buf, pos)
+    if match:
+        token = match.group()
+        if b'.' in token:
+            return float(token), match.end()
+        number = int(token)
+        ref = REF_RE.match(buf, match.end())
+        if ref and number >= 0:
+            return Ref(number, int(ref.group(1))), ref.end()
+        return number, match.end()
+    match = TOKEN_END_RE.search(buf, pos)
+    end = match.start() if match else len(buf)
+    keyword = buf[pos:end]
+    if keyword == b'true':
+        return True, end
+    if keyword == b'false':
+        return False, end
+    if keyword == b'null':
+        return None, end
+    raise PdfError(f"Unexpected token {bytes(keyword[:20])!r} at offset {pos}")
+
+
+class XrefTable:
+    """A classic xref section; entries are fixed-width, so lookups index into it directly"""
+
+    def __init__(self, buf, pos):
+        self.buf = buf
+        self.subsections = []  # (first object number, count, offset of first entry)
+        pos = _skip_whitespace(buf, pos + 4)
+        while True:
+            match = XREF_SUBSECTION_RE.match(buf, pos)
+            if not match:
+                break
+            first, count = int(match.group(1)), int(match.group(2))
+            start = match.end()
+            # Entries are 20 bytes; tolerate writers that use a bare \n
+            entry_size = 20 if buf[start + 18:start + 20] in (b' \n', b'\r\n', b' \r') else 19
+            self.subsections.append((first, count, start, entry_size))
+            pos = _skip_whitespace(buf, start + count * entry_size)
+        if not buf[pos:pos + 7] == b'trailer':
+            raise PdfError(f"xref table without trailer at offset {pos}")
+        self.trailer, _ = parse_object(buf, pos + 7)
+
+    def lookup(self, num):
+        for first, count, start, entry_size in self.subsections:
+            if first <= num < first + count:
+                entry = self.buf[start + (num - first) * entry_size:start + (num - first + 1) * entry_size]
+                parts = entry.split()
+                if len(parts) < 3:
+                    raise PdfError(f"Malformed xref entry for object {num}")
+                if parts[2] == b'n':
+                    return ('offset', int(parts[0]), int(parts[1]))
+                return ('free',)
+        return None
+
+    def object_numbers(self):
+        for first, count, _, _ in self.subsections:
+            yield from range(first, first + count)
+
+    def entries(self):
+        """Every (number, entry) in the section, without a lookup per object"""
+        for first, count, start, entry_size in self.subsections:
+            region = self.buf[start:start + count * entry_size]
+            for num, (offset, gen, kind) in enumerate(XREF_ENTRY_RE.findall(region), first):
+                yield num, ('offset', int(offset), int(gen)) if kind == b'n' else ('free',)
+
+
+class XrefStream:
+    """An xref stream section, decoded once and indexed lazily"""
+
+    def __init__(self, document, stream):
+        self.trailer = stream.dict
+        self.widths = [document.resolve(w) for w in stream.dict['W']]
+        self.entry_size = sum(self.widths)
+        index = stream.dict.get('Index') or [0, stream.dict['Size']]
+        self.subsections = []
+        position = 0
+        for first, count in zip(index[0::2], index[1::2]):
+            self.subsections.append((first, count, position))
+            position += count * self.entry_size
+        self.data = stream.data()
+
+    def _field(self, entry, i):
+        start = sum(self.widths[:i])
+        width = self.widths[i]
+        if not width:
+            return 1 if i == 0 else 0  # default type is 1, other fields default to 0
+        return int.from_bytes(entry[start:start + width], 'big')
+
+    def lookup(self, num):
+        for first, count, start in self.subsections:
+            if first <= num < first + count:
+                offset = start + (num - first) * self.entry_size
+                entry = self.data[offset:offset + self.entry_size]
+                if len(entry) < self.entry_size:
+                    return None
+                kind = self._field(entry, 0)
+                if kind == 1:
+                    return ('offset', self._field(entry, 1), self._field(entry, 2))
+                if kind == 2:
+                    return ('compressed', self._field(entry, 1), self._field(entry, 2))
+                return ('free',)
+        return None
+
+    def object_numbers(self):
+        for first, count, _ in self.subsections:
+            yield from range(first, first + count)
+
+    def entries(self):
+        for num in self.object_numbers():
+            entry = self.lookup(num)
+            if entry is not None:
+                yield num, entry
+
+
+class ScannedXref:
+    """
+    Object locations found by scanning the whole file, for files whose xref is unusable
+    Top-level objects come from `N G obj` headers (the last definition wins, as
+    in an incremental update) and compressed ones from the object streams found
+    among them, once the document can look objects up through the scan (see
+    index()). At most `max_objects` objects are indexed.
+    """
+
+    def __init__(self, buf, max_objects=MAX_SCAN_OBJECTS):
+        self.max_objects = max_objects
+        self.truncated = False
+        self.offsets = {}  # number -> (offset, generation)
+        for match in OBJ_KEYWORD_RE.finditer(buf):
+            if len(self.offsets) >= max_objects:
+                self.truncated = True
+                break
+            header = OBJ_HEADER_TAIL_RE.search(buf, max(0, match.start() - 40), match.start())
+            if header:
+                self.offsets[int(header.group(1))] = (header.start(1), int(header.group(2)))
+        self._starts = sorted((offset, num) for num, (offset, _) in self.offsets.items())
+        self.compressed = {}  # number -> (object stream number, index)
+        self.trailer = None
+
+    def index(self, document):
+        """Add the objects in object streams and find the trailer"""
+        for num in self._containing(document.buf, rb'/Type\s*/ObjStm'):
+            try:
+                _, _, offsets = document._object_stream(num)
+            except (PdfError, KeyError, TypeError, ValueError):
+                continue
+            for index, member in enumerate(offsets):
+                if len(self.offsets) + len(self.compressed) >= self.max_objects:
+                    self.truncated = True
+                    break
+                if member not in self.offsets:
+                    self.compressed[member] = (num, index)
+
+        self.trailer = self._find_trailer(document)
+
+    def _containing(self, buf, pattern):
+        """Numbers of the top-level objects in which `pattern` occurs, in file order"""
+        found = []
+        for match in re.finditer(pattern, buf):
+            i = bisect.bisect_right(self._starts, (match.start(), float('inf'))) - 1
+            if i >= 0 and self._starts[i][1] not in found:
+                found.append(self._starts[i][1])
+        return found
+
+    def _find_trailer(self, document):
+        buf = document.buf
+        pos = buf.rfind(b'trailer')
+        if pos >= 0:
+            try:
+                trailer, _ = parse_object(buf, pos + 7)
+                if isinstance(trailer, dict) and trailer.get('Root') is not None:
+                    return trailer
+            except PdfError:
+                pass
+        # An xref stream's dictionary doubles as the trailer, even if its data is broken
+        for num in reversed(self._containing(buf, rb'/Type\s*/XRef\b')):
+            try:
+                value = document.get(num)
+            except PdfError:
+                continue
+            if isinstance(value, Stream) and value.dict.get('Root') is not None:
+                return value.dict
+        for num in reversed(self._containing(buf, rb'/Type\s*/Catalog\b')):
+            return {'Root': Ref(num, self.offsets[num][1])}
+        raise PdfError("No document catalog found")
+
+    def lookup(self, num):
+        if num in self.offsets:
+            offset, gen = self.offsets[num]
+            return ('offset', offset, gen)
+        if num in self.compressed:
+            return ('compressed', *self.compressed[num])
+        return None
+
+    def object_numbers(self):
+        return sorted([*self.offsets, *self.compressed])
+
+    def entries(self):
+        for num in self.object_numbers():
+            yield num, self.lookup(num)
+
+
+class PdfDocument:
+    """
+    A PDF file opened through a read-only memory mapping
+    Use as a context manager, or call close(). With `repair`, a file whose
+    xref can't be read is indexed by a ScannedXref instead, and `repaired` is set.
+    """
+
+    def __init__(self, path, repair=False):
+        self._file = open(path, 'rb')
+        try:
+            self.buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise PdfError("Empty file")
+        self._cache = {}
+        self._object_streams = {}
+        self.startxref = None
+        self.repaired = False
+        self._repair = repair
+        self._scanned = None
+        try:
+            try:
+                self.sections = self._read_xref_chain()
+            except PdfError:
+                if not repair:
+                    raise
+                scan = self._scan()
+                self.sections = [scan]
+                scan.index(self)
+                self.repaired = True
+        except Exception:
+            self.close()
+            raise
+        self.trailer = self.sections[0].trailer
+
+    def close(self):
+        self.buf.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read_xref_chain(self):
+        tail_start = max(0, len(self.buf) - STARTXREF_WINDOW)
+        pos = self.buf.rfind(b'startxref', tail_start)
+        if pos < 0:
+            raise PdfError("startxref not found")
+        offset, _ = parse_object(self.buf, pos + 9)
+        self.startxref = offset
+        sections = []
+        seen = set()
+        while offset is not None and len(sections) < MAX_XREF_SECTIONS:
+            if not isinstance(offset, int) or offset in seen or not 0 <= offset < len(self.buf):
+                raise PdfError(f"Bad xref offset {offset}")
+            seen.add(offset)
+            section = self._read_xref_section(offset)
+            sections.append(section)
+            # Hybrid files keep the compressed objects' entries in a separate xref stream
+            xref_stm = section.trailer.get('XRefStm') if isinstance(section, XrefTable) else None
+            if isinstance(xref_stm, int) and xref_stm not in seen:
+                seen.add(xref_stm)
+                sections.append(self._read_xref_section(xref_stm))
+            offset = section.trailer.get('Prev')
+        return sections
+
+    def _read_xref_section(self, offset):
+        pos = _skip_whitespace(self.buf, offset)
+        if self.buf[pos:pos + 4] == b'xref':
+            return XrefTable(self.buf, pos)
+        stream = self._parse_indirect_at(pos, None)
+        if not isinstance(stream, Stream) or stream.dict.get('Type') != 'XRef':
+            raise PdfError(f"No xref section at offset {offset}")
+        return XrefStream(self, stream)
+
+    def _scan(self):
+        if self._scanned is None:
+            self._scanned = ScannedXref(self.buf)
+        return self._scanned
+
+    def _lookup(self, num):
+        for section in self.sections:
+            entry = section.lookup(num)
+            if entry is not None:
+                return entry
+        return None
+
+    def entries(self):
+        """The current entry of every object number in the xref chain"""
+        current = {}
+        # Oldest section first, so newer revisions overwrite older ones
+        for section in reversed(self.sections):
+            current.update(section.entries())
+        return current
+
+    def _parse_indirect_at(self, pos, expected_num):
+        match = OBJ_HEADER_RE.match(self.buf, _skip_whitespace(self.buf, pos))
+        if not match:
+            raise PdfError(f"No object header at offset {pos}")
+        if expected_num is not None and int(match.group(1)) != expected_num:
+            raise PdfError(f"Expected object {expected_num} at offset {pos}")
+        value, pos = parse_object(self.buf, match.end())
+        if isinstance(value, dict):
+            after = _skip_whitespace(self.buf, pos)
+            if self.buf[after:after + 6] == b'stream':
+                start = after + 6
+                if self.buf[start:start + 2] == b'\r\n':
+                    start += 2
+                elif self.buf[start:start + 1] in (b'\n', b'\r'):
+                    start += 1
+                return Stream(self, value, start, self._stream_length(value, start))
+        return value
+
+    def _stream_length(self, dictionary, start):
+        length = dictionary.get('Length')
+        if isinstance(length, Ref):
+            try:
+                length = self.get(length.num)
+            except PdfError:
+                length = None
+        if isinstance(length, int) and 0 <= length and \
+                self.buf[start + length:start + length + 32].lstrip(WHITESPACE).startswith(b'endstream'):
+            return length
+        # Missing or wrong /Length: fall back to the endstream keyword
+        end = self.buf.find(b'endstream', start)
+        if end < 0:
+            raise PdfError(f"Unterminated stream at offset {start}")
+        while end > start and self.buf[end - 1] in b'\r\n':
+            end -= 1
+        return end - start
+
+    def _object_stream(self, num):
+        if num not in self._object_streams:
+            stream = self.get(num)
+            if not isinstance(stream, Stream):
+                raise PdfError(f"Object {num} is not an object stream")
+            data = stream.data()
+            count = self.resolve(stream.dict['N'])
+            first = self.resolve(stream.dict['First'])
+            header = data[:first].split()
+            offsets = {int(header[i]): int(header[i + 1]) for i in range(0, min(len(header), 2 * count) - 1, 2)}
+            self._object_streams[num] = (data, first, offsets)
+            if len(self._object_streams) > 16:
+                self._object_streams.pop(next(iter(self._object_streams)))
+        return self._object_streams[num]
+
+    def get(self, num):
+        """The object with number `num` (None if it doesn't exist)"""
+        if num in self._cache:
+            return self._cache[num]
+        entry = self._lookup(num)
+        if entry is None or entry[0] == 'free':
+            value = None
+        elif entry[0] == 'offset':
+            try:
+                if not 0 <= entry[1] < len(self.buf):
+                    raise PdfError(f"Object {num} points outside the file")
+                value = self._parse_indirect_at(entry[1], num)
+            except PdfError:
+                # An xref entry pointing at the wrong place: trust the object headers instead
+                scanned = self._scan().lookup(num) if self._repair else None
+                if scanned is None or scanned[0] != 'offset':
+                    raise
+                value = self._parse_indirect_at(scanned[1], num)
+        else:
+            data, first, offsets = self._object_stream(entry[1])
+            if num not in offsets:
+                raise PdfError(f"Object {num} missing from object stream {entry[1]}")
+            value, _ = parse_object(data, first + offsets[num])
+        self._cache[num] = value
+        return value
+
+    def resolve(self, value):
+        """Follow an indirect reference; other values are returned as they are"""
+        seen = 0
+        while isinstance(value, Ref):
+            seen += 1
+            if seen > 32:
+                raise PdfError("Reference loop")
+            value = self.get(value.num)
+        return value
+
+    @property
+    def encrypted(self):
+        return self.trailer.get('Encrypt') is not None
+
+    @property
+    def catalog(self):
+        catalog = self.resolve(self.trailer.get('Root'))
+        if not isinstance(catalog, dict):
+            raise PdfError("Document catalog not found")
+        return catalog
+
+    def xmp(self, max_size=4 * 1024 * 1024):
+        """The document's XMP metadata packet, or None"""
+        metadata = self.resolve(self.catalog.get('Metadata'))
+        if not isinstance(metadata, Stream):
+            return None
+        return metadata.data(max_size)
+
+
+def xmp_values(xmp):
+    """pdfuaid:part, pdfaid:part and whether dc:title is set, from an XMP packet"""
+    values = {'pdfua_part': None, 'pdfa_part': None, 'title': False}
+    try:
+        root = ET.fromstring(xmp.strip(b'\x00 \t\r\n'))
+    except ET.ParseError:
+        return values
+    keys = {
+        f'{{{XMP_NAMESPACES["pdfuaid"]}}}part': 'pdfua_part',
+        f'{{{XMP_NAMESPACES["pdfaid"]}}}part': 'pdfa_part',
+    }
+    for element in root.iter():
+        # The identification may be written as an attribute or as an element
+        for name, value in [*element.attrib.items(), (element.tag, element.text)]:
+            if name in keys and value and value.strip().isdigit():
+                values[keys[name]] = int(value.strip())
+        if element.tag == f'{{{XMP_NAMESPACES["dc"]}}}title':
+            values['title'] = any((child.text or '').strip() for child in element.iter())
+    return values
+
+
+def read_identification(path):
+    """
+    PDF/UA-relevant identification of a document, read from its catalog and XMP only
+    Returns a dict; raises PdfError if the file can't be read this way.
+    """
+    with PdfDocument(path) as doc:
+        catalog = doc.catalog
+        mark_info = doc.resolve(catalog.get('MarkInfo')) or {}
+        viewer_preferences = doc.resolve(catalog.get('ViewerPreferences')) or {}
+        lang = doc.resolve(catalog.get('Lang'))
+        identification = {
+            'encrypted': doc.encrypted,
+            'marked': isinstance(mark_info, dict) and doc.resolve(mark_info.get('Marked')) is True,
+            'struct_tree': catalog.get('StructTreeRoot') is not None,
+            'lang': bool(lang) and isinstance(lang, bytes),
+            'display_doc_title': isinstance(viewer_preferences, dict)
+            and doc.resolve(viewer_preferences.get('DisplayDocTitle')) is True,
+            'pdfua_part': None,
+            'pdfa_part': None,
+            'title': False,
+        }
+        # Encrypted metadata can't be read without decrypting it
+        if not doc.encrypted:
+            xmp = doc.xmp()
+            if xmp:
+                identification.update(xmp_values(xmp))
+        return identification
+
+
+def preflight(path, max_objects=MAX_PREFLIGHT_OBJECTS):
+    """
+    Compact summary of a document for routing, preset and cost decisions
+    Only object dictionaries are parsed: the file is scanned for the keys that
+    matter (image, font and transparency markers) and just the objects they
+    occur in are read, so image and content streams are never decoded. Inline
+    images aren't counted. 'complete' is False when more than `max_objects`
+    objects would have had to be parsed.
+    Returns a dict; raises PdfError if the file isn't a PDF or has no usable catalog.
+    """
+    with PdfDocument(path, repair=True) as doc:
+        header = HEADER_RE.search(doc.buf, 0, 1024)
+        if not header:
+            raise PdfError("Not a PDF file")
+        entries = doc.entries()
+        summary = {
+            'bytes': len(doc.buf),
+            'version': header.group(1).decode(),
+            'xref': 'scan' if doc.repaired else
+            'stream' if isinstance(doc.sections[0], XrefStream) else 'table',
+            'encrypted': doc.encrypted,
+            'objects': sum(1 for entry in entries.values() if entry[0] != 'free'),
+            'object_streams': len({entry[1] for entry in entries.values() if entry[0] == 'compressed'}),
+            'pages': None,
+            'tagged': False,
+            'images': 0,
+            'image_pixels': 0,
+            'fonts': 0,
+            'transparency': False,
+            'complete': True,
+        }
+        catalog = doc.catalog
+        pages = doc.resolve(catalog.get('Pages'))
+        if isinstance(pages, dict) and isinstance(doc.resolve(pages.get('Count')), int):
+            summary['pages'] = doc.resolve(pages['Count'])
+        mark_info = doc.resolve(catalog.get('MarkInfo'))
+        summary['tagged'] = isinstance(mark_info, dict) and doc.resolve(mark_info.get('Marked')) is True \
+            and catalog.get('StructTreeRoot') is not None
+
+        budget = [max_objects]
+        starts = sorted((entry[1], num) for num, entry in entries.items() if entry[0] == 'offset')
+        _preflight_objects(doc, doc.buf, starts, budget, summary)
+        # Object streams are encrypted along with everything else
+        if not doc.encrypted:
+            for objstm in sorted({entry[1] for entry in entries.values() if entry[0] == 'compressed'}):
+                try:
+                    data, first, offsets = doc._object_stream(objstm)
+                except (PdfError, KeyError, TypeError, ValueError):
+                    continue
+                members = sorted((first + offset, num) for num, offset in offsets.items()
+                                 if entries.get(num, ('',))[0] == 'compressed')
+                _preflight_objects(doc, data, members, budget, summary)
+        return summary
+
+
+def _preflight_objects(doc, buf, starts, budget, summary):
+    """Count what the objects starting at `starts` ((offset, number) pairs) contain"""
+    candidates = []
+    for match in PREFLIGHT_MARKER_RE.finditer(buf):
+        i = bisect.bisect_right(starts, (match.start(), float('inf'))) - 1
+        if i >= 0 and (not candidates or candidates[-1] != starts[i][1]):
+            candidates.append(starts[i][1])
+    for num in dict.fromkeys(candidates):
+        if budget[0] <= 0:
+            summary['complete'] = False
+            return
+        budget[0] -= 1
+        try:
+            value = doc.get(num)
+        except PdfError:
+            continue
+        stream = isinstance(value, Stream)
+        dictionary = value.dict if stream else value
+        if not isinstance(dictionary, dict):
+            continue
+        subtype = dictionary.get('Subtype')
+        if stream and subtype == 'Image':
+            summary['images'] += 1
+            width, height = doc.resolve(dictionary.get('Width')), doc.resolve(dictionary.get('Height'))
+            if isinstance(width, int) and isinstance(height, int):
+                summary['image_pixels'] += width * height
+        elif dictionary.get('Type') == 'Font' and subtype not in ('CIDFontType0', 'CIDFontType2'):
+            # Descendant fonts belong to a Type0 font that has been counted already
+            summary['fonts'] += 1
+        group = doc.resolve(dictionary.get('Group'))
+        if dictionary.get('S') == 'Transparency' \
+                or (isinstance(group, dict) and group.get('S') == 'Transparency') \
+                or dictionary.get('SMask') not in (None, 'None') \
+                or any(isinstance(doc.resolve(dictionary.get(key)), (int, float))
+                       and doc.resolve(dictionary.get(key)) < 1 for key in ('ca', 'CA')):
+            summary['transparency'] = True
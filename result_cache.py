@@ -0,0 +1,118 @@
+"""
+Content-addressed cache of conversion results
+
+Entries are keyed by the SHA-256 of the input bytes together with a digest of
+the Ghostscript flags and version, so a flag change or a Ghostscript upgrade
+never serves stale output. Results live in a size-bounded directory; an
+entry's mtime records its last use and the least recently used entries are
+evicted first. Inserts go through a temp file and an atomic rename, so
+concurrent readers (including other server processes) never see partial
+files.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    """SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ghostscript_version(gs_binary='gs'):
+    """Version string reported by `gs --version`, or 'unknown'"""
+    try:
+        result = subprocess.run([gs_binary, '--version'], capture_output=True, text=True, timeout=10)
+        return result.stdout.strip() or 'unknown'
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+
+
+def flags_digest(flags, gs_version):
+    """Digest of everything besides the input that determines the output"""
+    digest = hashlib.sha256(gs_version.encode('utf-8'))
+    for flag in flags:
+        digest.update(b'\0' + flag.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Size-bounded on-disk store of converted PDFs with LRU eviction"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(input_sha256, flags_sha256):
+        return hashlib.sha256(f'{input_sha256}:{flags_sha256}'.encode('ascii')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.pdf')
+
+    def open(self, key):
+        """Open a cached result for reading, or return None on a miss"""
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        # The open handle stays valid even if the entry is evicted while we serve it
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return f
+
+    def put(self, key, source_path):
+        """Copy a finished output into the cache atomically"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp, open(source_path, 'rb') as source:
+                shutil.copyfileobj(source, temp, CHUNK_SIZE)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the store fits in max_bytes"""
+        with self._lock:
+            entries = []
+            total = 0
+            for shard in os.scandir(self.directory):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if not entry.name.endswith('.pdf'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
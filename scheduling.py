@@ -0,0 +1,71 @@
+"""
+Order in which waiting conversions are started
+
+'fifo' starts them in arrival order. 'sejf' (shortest expected job first)
+starts the one with the smallest estimated cost, so a queue of small
+documents isn't held up behind one long scan. To keep long jobs from
+starving, a waiting job's cost is reduced by `aging_rate` seconds for every
+second it has waited: a job estimated at E seconds runs at the latest once
+it has waited E / aging_rate seconds longer than anything that overtakes it.
+
+Aging alone can take longer than a bounded waiter may wait, so a waiter with
+a `max_wait` stops being overtaken once it has used URGENT_FRACTION of it.
+From then on it keeps its place in arrival order ahead of everything that
+can still wait, which leaves it the rest of its wait to get a free slot.
+"""
+
+import itertools
+import time
+
+SCHEDULERS = ('fifo', 'sejf')
+URGENT_FRACTION = 0.5  # of a waiter's max_wait, after which nothing overtakes it
+
+
+class Waiting:
+    """
+    A conversion waiting to start; `cost` is its estimated wall time in seconds, or None
+    `max_wait` is how long it may wait before giving up, if that is bounded.
+    """
+
+    _seq = itertools.count()
+
+    def __init__(self, cost=None, item=None, max_wait=None):
+        self.cost = cost
+        self.item = item
+        self.since = time.monotonic()
+        self.seq = next(self._seq)
+        self.urgent_at = self.since + max_wait * URGENT_FRACTION if max_wait else None
+
+
+class SchedulingPolicy:
+    """Chooses among waiting conversions; see the module docstring"""
+
+    def __init__(self, mode='sejf', aging_rate=0.1):
+        if mode not in SCHEDULERS:
+            raise ValueError(f"Unknown scheduler: {mode}")
+        self.mode = mode
+        self.aging_rate = aging_rate
+
+    def order(self, waiting, now=None):
+        """`waiting` (Waiting instances) in the order they should start"""
+        if self.mode == 'fifo':
+            return sorted(waiting, key=lambda w: w.seq)
+        now = time.monotonic() if now is None else now
+        known = [w.cost for w in waiting if w.cost is not None]
+        # Jobs that couldn't be estimated are treated as average ones
+        default = sum(known) / len(known) if known else 0.0
+
+        def score(w):
+            if w.urgent_at is not None and now >= w.urgent_at:
+                return (0, 0.0, w.seq)
+            cost = default if w.cost is None else w.cost
+            return (1, cost - self.aging_rate * (now - w.since), w.seq)
+        return sorted(waiting, key=score)
+
+    def first(self, waiting, now=None):
+        """The waiting conversion that should start next, or None"""
+        if not waiting:
+            return None
+        if self.mode == 'fifo':
+            return min(waiting, key=lambda w: w.seq)
+        return self.order(waiting, now)[0]
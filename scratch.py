@@ -0,0 +1,259 @@
+"""
+Managed scratch storage for conversions
+
+Every upload gets its own directory under one root, and the spooled input,
+the converted output and any intermediate files of that conversion live in
+it, so removing the directory once the response has been sent or the job
+has expired cleans up everything at once.
+
+Each server process holds an flock on an owner file in every root it uses
+for as long as it runs, and names its directories after it. A directory whose owner lock
+can be taken belongs to a process that has exited (or crashed) and is
+reaped, on startup and then periodically as new directories are created.
+Directories of live processes older than `max_age` are reaped as well, in
+case something forgot to clean up.
+
+The bytes under the root are counted against `quota_bytes`, so admission can
+refuse new work before the disk fills up. Entries whose names start with an
+underscore are shared directories that clean up after themselves, such as
+the single-flight spool; they count against the quota but are never reaped.
+
+Small uploads can get their directory under a second, memory-backed root (a
+tmpfs such as /dev/shm) instead, which spares them the disk writes and page
+cache churn of a round trip through the file system. That happens when the
+request is at most `memory_max_input` bytes and both the tmpfs and the
+machine's available memory have room for MEMORY_EXPANSION times that plus
+`memory_reserve`; everything else goes to disk. Ordinary paths work for every
+engine, including long-lived pool interpreters that couldn't open another
+process's /proc/self/fd/N.
+"""
+
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+OWNER_SUFFIX = '.owner'
+# Room a memory-backed directory needs per input byte: the input, the output and some slack
+MEMORY_EXPANSION = 4
+REAP_INTERVAL = 60.0  # seconds between reaper runs
+USAGE_INTERVAL = 1.0  # seconds a measured disk usage is reused for
+
+
+class WorkDir:
+    """A conversion's scratch directory; `backend` is 'disk' or 'memory'"""
+
+    def __init__(self, path, backend='disk'):
+        self.path = path
+        self.backend = backend
+
+    def file(self, name):
+        """Path of a file in this directory"""
+        return os.path.join(self.path, name)
+
+    def cleanup(self):
+        """Delete the directory and everything in it; safe to call more than once"""
+        try:
+            shutil.rmtree(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Cleanup error: %s", e)
+
+
+class ScratchArea:
+    """Root of the per-conversion scratch directories; see the module docstring"""
+
+    def __init__(self, root, quota_bytes=0, high_water=0.9, max_age=86400.0,
+                 memory_root=None, memory_max_input=2 * 1024 * 1024, memory_reserve=512 * 1024 * 1024):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.high_water = high_water
+        self.max_age = max_age
+        self.memory_root = memory_root
+        self.memory_max_input = memory_max_input
+        self.memory_reserve = memory_reserve
+        self.reaped = 0
+        self._lock = threading.Lock()
+        self._last_reap = 0.0
+        self._usage = None
+        self._usage_at = 0.0
+        os.makedirs(root, exist_ok=True)
+        if memory_root:
+            try:
+                os.makedirs(memory_root, exist_ok=True)
+            except OSError as e:
+                logger.warning("Memory-backed scratch unavailable: %s", e)
+                self.memory_root = None
+
+        self.owner = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._owner_fds = [self._claim(directory) for directory in self._roots()]
+        self.reap(force=True)
+
+    def _roots(self):
+        return [self.root, self.memory_root] if self.memory_root else [self.root]
+
+    def _claim(self, directory):
+        """Create and lock this process's owner file in `directory`"""
+        # Lock the owner file before it gets its name, so no reaper ever sees it unlocked
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(temp_path, os.path.join(directory, self.owner + OWNER_SUFFIX))
+        return fd
+
+    def create(self, size_hint=None):
+        """
+        A new, empty WorkDir
+        `size_hint` is the expected input size in bytes; without one the directory is on disk.
+        """
+        self.reap()
+        if size_hint is not None and self._memory_has_room(size_hint):
+            try:
+                return WorkDir(tempfile.mkdtemp(prefix=f'{self.owner}.', dir=self.memory_root), 'memory')
+            except OSError as e:
+                logger.warning("Memory-backed scratch error: %s", e)
+        return WorkDir(tempfile.mkdtemp(prefix=f'{self.owner}.', dir=self.root))
+
+    def _memory_has_room(self, size_hint):
+        if not self.memory_root or size_hint > self.memory_max_input:
+            return False
+        needed = size_hint * MEMORY_EXPANSION
+        try:
+            fs = os.statvfs(self.memory_root)
+        except OSError:
+            return False
+        available = _memory_available()
+        return fs.f_bavail * fs.f_frsize >= needed and \
+            (available is None or available >= needed + self.memory_reserve)
+
+    def usage(self):
+        """Bytes currently allocated under the root, by every process sharing it"""
+        with self._lock:
+            now = time.monotonic()
+            if self._usage is None or now - self._usage_at >= USAGE_INTERVAL:
+                self._usage = _disk_usage(self.root)
+                self._usage_at = now
+            return self._usage
+
+    def has_room(self):
+        """Whether new work fits: usage is below `high_water` of the quota (always, without one)"""
+        if self.quota_bytes <= 0:
+            return True
+        return self.usage() < self.quota_bytes * self.high_water
+
+    def reap(self, force=False):
+        """Delete directories of exited processes and stale ones, at most once per REAP_INTERVAL unless forced"""
+        with self._lock:
+            now = time.time()
+            if not force and now - self._last_reap < REAP_INTERVAL:
+                return
+            self._last_reap = now
+        for directory in self._roots():
+            self._reap(directory, now)
+
+    def _reap(self, directory, now):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logger.warning("Scratch reaper error: %s", e)
+            return
+        owners = {entry.name[:-len(OWNER_SUFFIX)]: entry.path for entry in entries
+                  if entry.name.endswith(OWNER_SUFFIX)}
+        dead = {owner for owner in owners if owner != self.owner and _unowned(owners[owner])}
+        for entry in entries:
+            if entry.name.endswith(OWNER_SUFFIX) or entry.name.startswith('_'):
+                continue
+            owner = entry.name.split('.', 1)[0]
+            try:
+                stale = self.max_age and now - entry.stat(follow_symlinks=False).st_mtime > self.max_age
+            except FileNotFoundError:
+                continue
+            if not stale:
+                if not owner or owner == self.owner:
+                    continue  # ours, or an owner file still being set up
+                # The listing isn't atomic, so a process that started during it may be missing from `owners`
+                if owner not in dead and (owner in owners or
+                                          os.path.exists(os.path.join(directory, owner + OWNER_SUFFIX))):
+                    continue
+            if entry.is_dir(follow_symlinks=False):
+                WorkDir(entry.path).cleanup()
+            else:
+                _unlink(entry.path)
+            self.reaped += 1
+        for owner in dead:
+            _unlink(owners[owner])
+
+    def stats(self):
+        stats = {
+            'usage_bytes': self.usage(),
+            'quota_bytes': self.quota_bytes,
+            'high_water': self.high_water,
+            'reaped_total': self.reaped,
+        }
+        if self.memory_root:
+            stats['memory_usage_bytes'] = _disk_usage(self.memory_root)
+        return stats
+
+    def close(self):
+        for fd in self._owner_fds:
+            os.close(fd)
+        self._owner_fds = []
+
+
+def _unowned(path):
+    """Whether nobody holds the owner lock at `path`"""
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+    finally:
+        os.close(fd)  # also drops the lock if we got it
+
+
+def _memory_available():
+    """MemAvailable from /proc/meminfo in bytes, or None where there is no such file"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _disk_usage(path):
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += _disk_usage(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_blocks * 512
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Cleanup error: %s", e)
@@ -0,0 +1,199 @@
+"""
+Single-flight deduplication of identical conversions
+
+Requests that convert the same bytes with the same settings at the same time
+share one Ghostscript run. Each key has a lock file in a shared directory;
+whoever holds its flock is the leader and converts, everyone else waits for
+the lock. Before releasing it, the leader publishes the outcome (and the
+output, on success) next to the lock, and a waiter that then gets the lock
+takes that outcome instead of converting again. flock works between
+processes as well as between threads with their own descriptors, so this
+holds across all server processes sharing the directory.
+
+Only outcomes published while a waiter was waiting are reused; later
+requests are the result cache's business. Waiters hold a shared flock on a
+second file per key, so a leader that can lock it exclusively knows nobody
+is waiting and publishes nothing. A published output is a hard link to the
+leader's file where the file system allows it. A leader that dies releases
+its lock without publishing anything, and the next waiter becomes the leader.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05  # seconds between attempts to take a busy lock
+SWEEP_INTERVAL = 60.0  # seconds between sweeps for old files
+
+
+class Flight:
+    """A claim on a key; `outcome` is set when another request's result can be reused"""
+
+    def __init__(self, group, key, fd, outcome=None):
+        self.group = group
+        self.key = key
+        self.fd = fd
+        self.outcome = outcome
+
+    @property
+    def leader(self):
+        return self.outcome is None and self.fd is not None
+
+    def publish(self, success, message, error_code, output_path=None):
+        """Share this conversion's outcome with the requests waiting for it"""
+        if self.fd is None:
+            return
+        self.group._publish(self.key, success, message, error_code, output_path)
+
+    def copy_output(self, output_path):
+        """Copy the shared output to `output_path`"""
+        _link_or_copy(self.group._path(self.key, '.pdf'), output_path)
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)  # closing the descriptor drops the flock
+            self.fd = None
+
+
+class SingleFlight:
+    """Lock directory coordinating identical conversions; see the module docstring"""
+
+    def __init__(self, directory, max_wait=600.0, retention=600.0):
+        self.directory = directory
+        self.max_wait = max_wait
+        self.retention = retention
+        self._last_sweep = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def claim(self, key):
+        """
+        Become the leader for `key`, or wait until its current leader has finished
+        Returns a Flight: reuse `outcome` when it's set, otherwise convert and
+        publish(). A Flight without a lock (after waiting `max_wait` seconds in
+        vain) converts on its own. Always release() it.
+        """
+        self._sweep()
+        fd = os.open(self._path(key, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        waited_since = time.time()
+        wait_fd = None
+        deadline = time.monotonic() + self.max_wait
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        os.close(fd)
+                        return Flight(self, key, None)
+                    if wait_fd is None:
+                        wait_fd = self._start_waiting(key)
+                    time.sleep(POLL_INTERVAL)
+        except BaseException:
+            os.close(fd)
+            raise
+        finally:
+            if wait_fd is not None:
+                os.close(wait_fd)
+        waited = wait_fd is not None
+        os.utime(self._path(key, '.lock'))
+        outcome = self._read_outcome(key, waited_since) if waited else None
+        return Flight(self, key, fd, outcome)
+
+    def _start_waiting(self, key):
+        """Let the leader of `key` know it has a waiter, until the returned descriptor is closed"""
+        path = self._path(key, '.wait')
+        wait_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(wait_fd, fcntl.LOCK_SH)
+        os.utime(path)  # keep the sweep away from it while it is in use
+        return wait_fd
+
+    def _has_waiters(self, key):
+        try:
+            wait_fd = os.open(self._path(key, '.wait'), os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(wait_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(wait_fd)
+
+    def _read_outcome(self, key, since):
+        try:
+            with open(self._path(key, '.json')) as f:
+                outcome = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if outcome.get('finished_at', 0) < since:
+            return None
+        if outcome['success'] and not os.path.exists(self._path(key, '.pdf')):
+            return None
+        return outcome
+
+    def _publish(self, key, success, message, error_code, output_path):
+        if not self._has_waiters(key):
+            return
+        if success:
+            self._replace(self._path(key, '.pdf'), lambda temp: _link_or_copy(output_path, temp))
+        outcome = {'success': success, 'message': message, 'error_code': error_code,
+                   'finished_at': time.time()}
+
+        def write(temp):
+            with open(temp, 'w') as f:
+                json.dump(outcome, f)
+        self._replace(self._path(key, '.json'), write)
+
+    def _replace(self, path, write):
+        """Write a file through a temp file and an atomic rename"""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        try:
+            write(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _sweep(self):
+        """Delete the files of keys nobody has claimed for `retention` seconds"""
+        now = time.time()
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError as e:
+            logger.warning("Single-flight sweep error: %s", e)
+            return
+        for entry in entries:
+            try:
+                if now - entry.stat().st_mtime > self.retention:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Single-flight sweep error: %s", e)
+
+
+def _link_or_copy(source, destination):
+    """Hard-link `source` to `destination`, replacing it, or copy it across file systems"""
+    try:
+        os.unlink(destination)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
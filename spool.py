@@ -0,0 +1,99 @@
+"""
+Hash-while-upload spooling of file uploads
+
+Werkzeug asks the request for a file stream for every multipart file part and
+writes the part into it chunk by chunk as the body is parsed. SpoolingRequest
+hands out a HashingSpool, which writes those chunks straight to scratch
+storage while computing the SHA-256, counting bytes and checking the `%PDF-`
+header. Once parsing finishes the upload is on disk with its digest known, so
+nothing has to read it a second time. Subclasses can give each upload its own
+scratch directory by overriding spool_workdir().
+"""
+
+import hashlib
+import os
+import tempfile
+
+from flask import Request
+
+PDF_MAGIC = b'%PDF-'
+# Readers accept a header that is preceded by a little junk
+MAGIC_WINDOW = 1024
+
+
+class HashingSpool:
+    """
+    Writable temp file that hashes and sizes everything written to it
+    With a `workdir` (see scratch.WorkDir) the file is created there, and the
+    whole directory belongs to whoever detaches the spool.
+    """
+
+    def __init__(self, workdir=None):
+        self.workdir = workdir
+        self._file = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False,
+                                                 dir=workdir.path if workdir else None)
+        self.path = self._file.name
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._head = b''
+        self._detached = False
+
+    def write(self, data):
+        if len(self._head) < MAGIC_WINDOW:
+            self._head += data[:MAGIC_WINDOW - len(self._head)]
+        self._digest.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        return self._file.flush()
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    @property
+    def looks_like_pdf(self):
+        return PDF_MAGIC in self._head
+
+    def detach(self):
+        """Close the spool and hand ownership of the file at `path` to the caller"""
+        self._file.close()
+        self._detached = True
+        return self.path
+
+    def close(self):
+        # Werkzeug closes uploads when the request ends; drop files nobody claimed
+        self._file.close()
+        if not self._detached:
+            self._detached = True
+            if self.workdir:
+                self.workdir.cleanup()
+                return
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class SpoolingRequest(Request):
+    """Request class that spools file uploads through HashingSpool"""
+
+    def spool_workdir(self, size_hint=None):
+        """
+        Scratch directory for the next upload, or None for a plain temp file
+        `size_hint` is the most the upload can be: the part's or else the request's length, if known.
+        """
+        return None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpool(self.spool_workdir(content_length or total_content_length))
@@ -0,0 +1,11 @@
+import pytest
+
+
+@pytest.fixture
+def write_pdf(tmp_path):
+    """Write bytes to a file in the test's temporary directory and return its path"""
+    def write(data, name='doc.pdf'):
+        path = tmp_path / name
+        path.write_bytes(data)
+        return str(path)
+    return write
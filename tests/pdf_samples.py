@@ -0,0 +1,68 @@
+"""
+Small synthetic PDFs for the tests
+
+Every document is built here byte by byte, so the offsets in its xref are
+exactly what a writer would produce and can be broken on purpose.
+"""
+
+import zlib
+
+CATALOG = b'<< /Type /Catalog /Pages 2 0 R /MarkInfo << /Marked true >> /StructTreeRoot 4 0 R >>'
+OBJECTS = [
+    CATALOG,
+    b'<< /Type /Pages /Count 1 /Kids [3 0 R] >>',
+    b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>',
+    b'<< /Type /StructTreeRoot >>',
+    b'<< /Title (Synthetic) >>',
+]
+INFO = 5
+
+XMP = '''<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+{description}
+</rdf:RDF></x:xmpmeta>
+<?xpacket end="w"?>'''
+PDFUA_ATTRIBUTE = '<rdf:Description rdf:about="" xmlns:pdfuaid="http://www.aiim.org/pdfua/ns/id/" pdfuaid:part="1"/>'
+PDFUA_ELEMENT = ('<rdf:Description rdf:about="" xmlns:pdfuaid="http://www.aiim.org/pdfua/ns/id/">'
+                 '<pdfuaid:part>1</pdfuaid:part></rdf:Description>')
+
+
+def with_metadata(description, compress=False):
+    """OBJECTS plus an XMP packet holding `description`, referenced from the catalog"""
+    data = XMP.format(description=description).encode('utf-8')
+    dictionary = b'/Type /Metadata /Subtype /XML'
+    if compress:
+        data = zlib.compress(data)
+        dictionary += b' /Filter /FlateDecode'
+    metadata = b'<< %s /Length %d >>\nstream\n' % (dictionary, len(data)) + data + b'\nendstream'
+    catalog = CATALOG[:-2] + b'/Metadata %d 0 R >>' % (len(OBJECTS) + 1)
+    return [catalog, *OBJECTS[1:], metadata]
+
+
+def build_pdf(objects=OBJECTS, xref='table'):
+    """
+    A PDF with `objects` numbered from 1 and a classic xref table or an xref stream
+    Returns (bytes, offset of the xref section)
+    """
+    out = bytearray(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref_offset = len(out)
+    if xref == 'table':
+        out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        out += b'trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R >>\n' % (len(objects) + 1, INFO)
+    else:
+        # The stream is the next object and lists itself
+        own = len(objects) + 1
+        offsets.append(xref_offset)
+        data = b'\x00\x00\x00\x00\xff\xff' + b''.join(b'\x01' + offset.to_bytes(4, 'big') + b'\x00'
+                                                      for offset in offsets)
+        data = zlib.compress(data)
+        out += (b'%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 1] /Root 1 0 R /Info %d 0 R '
+                b'/Filter /FlateDecode /Length %d >>\nstream\n' % (own, own + 1, INFO, len(data))
+                + data + b'\nendstream\nendobj\n')
+    out += b'startxref\n%d\n%%%%EOF\n' % xref_offset
+    return bytes(out), xref_offset
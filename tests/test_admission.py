@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, Rejected
+
+
+def start_waiting(admission, started, name, **kwargs):
+    """Call acquire() on a thread and note `name` in `started` once it returns"""
+    def run():
+        try:
+            admission.acquire(**kwargs)
+            started.append(name)
+        except Rejected:
+            started.append(f'{name} rejected')
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    time.sleep(0.05)
+    return thread
+
+
+def test_slots_are_charged_and_handed_back():
+    admission = AdmissionController(4, 10)
+    assert admission.acquire(slots=9) == 4  # never more than all of them
+    admission.release(4)
+    assert admission.acquire(slots=3) == 3
+    assert admission.acquire() == 1
+    assert admission.active == 4
+    admission.release(3)
+    admission.release(1)
+    assert admission.stats()['active'] == 0
+    assert admission.stats()['admitted_total'] == 3
+
+
+def test_multi_slot_waiter_is_not_overtaken():
+    admission = AdmissionController(2, 10)
+    admission.acquire()
+    started = []
+    wide = start_waiting(admission, started, 'wide', bounded=False, slots=2)
+    narrow = start_waiting(admission, started, 'narrow', bounded=False)
+    # One slot is free, but the first waiter needs both
+    assert started == []
+    assert admission.stats()['queue_depth'] == 2
+    admission.release()
+    wide.join(1)
+    assert started == ['wide']
+    admission.release(2)
+    narrow.join(1)
+    assert started == ['wide', 'narrow']
+
+
+def test_full_queue_is_rejected_straight_away():
+    admission = AdmissionController(1, 1, max_wait=5)
+    admission.acquire()
+    started = []
+    waiter = start_waiting(admission, started, 'queued')
+    with pytest.raises(Rejected) as excinfo:
+        admission.check()
+    assert excinfo.value.reason == 'busy'
+    with pytest.raises(Rejected):
+        admission.acquire()
+    # Callers that are already queued elsewhere still wait
+    unbounded = start_waiting(admission, started, 'unbounded', bounded=False)
+    assert admission.stats()['rejected_total'] == 2
+    admission.release()
+    waiter.join(1)
+    admission.release()
+    unbounded.join(1)
+    assert started == ['queued', 'unbounded']
+
+
+def test_bounded_wait_times_out():
+    admission = AdmissionController(1, 10, max_wait=0.2)
+    admission.acquire()
+    started = time.monotonic()
+    with pytest.raises(Rejected) as excinfo:
+        admission.acquire()
+    assert 0.2 <= time.monotonic() - started < 1
+    assert excinfo.value.retry_after >= 1
+    stats = admission.stats()
+    assert stats['timed_out_total'] == 1
+    assert stats['queue_depth'] == 0
+    assert stats['active'] == 1
@@ -0,0 +1,73 @@
+import json
+
+from cost_model import POOLED, CostHistory, CostModel, fit, refit
+
+
+def make_record(pages, preset='standard', fonts=2):
+    """A history record whose cost is an exact linear function of its features"""
+    features = {'pages': pages, 'image_pixels': 0, 'fonts': fonts, 'transparency': False,
+                'bytes': pages * 20000, 'images': 0, 'objects': pages * 10}
+    return {'time': 0, 'preset': preset, 'engine': 'subprocess', 'features': features,
+            'wall_seconds': 0.5 + 0.1 * pages + 0.2 * fonts,
+            'peak_rss_bytes': 50e6 + 1e6 * pages}
+
+
+def test_fit_recovers_linear_costs():
+    records = [make_record(pages, fonts=pages % 7) for pages in range(1, 41)]
+    model = fit(records, min_records=20)
+
+    assert set(model.coefficients) == {POOLED, 'standard'}
+    estimate = model.predict(make_record(100, fonts=3)['features'], 'standard')
+    assert estimate['model'] == 'standard'
+    assert abs(estimate['wall_seconds'] - (0.5 + 10 + 0.6)) < 0.05
+    assert abs(estimate['peak_rss_bytes'] - 150e6) / 150e6 < 0.01
+
+
+def test_fit_pools_presets_with_too_little_history():
+    records = [make_record(pages, fonts=pages % 7) for pages in range(1, 31)]
+    records += [make_record(pages, preset='smallest') for pages in range(1, 6)]
+    model = fit(records, min_records=20)
+
+    assert 'smallest' not in model.coefficients
+    assert model.predict(records[0]['features'], 'smallest')['model'] == POOLED
+    assert CostModel().predict(records[0]['features'], 'standard')['model'] == 'prior'
+
+
+def test_refit_saves_model_and_trims_history(tmp_path):
+    history = CostHistory(str(tmp_path / 'history.jsonl'))
+    for pages in range(1, 51):
+        history.append(make_record(pages, fonts=pages % 7))
+    model_path = str(tmp_path / 'model.json')
+
+    report = refit(history, model_path, max_records=40)
+
+    assert report['records'] == 40
+    assert report['holdout_records'] == 8
+    assert report['holdout_error']['wall_seconds']['median_percent_error'] < 1
+    assert [record['features']['pages'] for record in history.read()] == list(range(11, 51))
+    with open(model_path) as f:
+        assert json.load(f)['report'] == report
+    assert POOLED in CostModel.load(model_path).coefficients
+
+
+def test_refit_keeps_records_appended_while_fitting(tmp_path):
+    class BusyHistory(CostHistory):
+        """Another conversion finishes right after refit has read the history"""
+        appended = False
+
+        def read(self):
+            records = super().read()
+            if not self.appended:
+                self.appended = True
+                self.append(make_record(999))
+            return records
+
+    history = BusyHistory(str(tmp_path / 'history.jsonl'))
+    for pages in range(1, 31):
+        history.append(make_record(pages, fonts=pages % 7))
+
+    refit(history, str(tmp_path / 'model.json'), max_records=25)
+
+    pages = [record['features']['pages'] for record in history.read()]
+    assert len(pages) == 25
+    assert pages[-1] == 999
@@ -0,0 +1,62 @@
+import pytest
+
+from metadata_engine import MetadataEngine, add_ua_identification
+from pdf_parser import PdfDocument, PdfError, Stream, XrefStream, XrefTable, read_identification
+from tests.pdf_samples import CATALOG, OBJECTS, PDFUA_ATTRIBUTE, build_pdf, with_metadata
+
+
+@pytest.mark.parametrize('xref', ['table', 'stream'])
+def test_incremental_update_round_trip(write_pdf, xref):
+    data, xref_offset = build_pdf(OBJECTS, xref)
+    source = write_pdf(data)
+    output = write_pdf(b'', 'out.pdf')
+    assert read_identification(source)['pdfua_part'] is None
+
+    changes = add_ua_identification(source, output, default_lang='de-DE')
+
+    assert set(changes) == {'DisplayDocTitle', 'Lang', 'XMP'}
+    with open(output, 'rb') as f:
+        updated = f.read()
+    assert updated.startswith(data)  # the original bytes are kept as they were
+    identification = read_identification(output)
+    assert identification['pdfua_part'] == 1
+    assert identification['title']  # taken from the Info dictionary
+    assert identification['marked'] and identification['display_doc_title'] and identification['lang']
+    with PdfDocument(output) as doc:
+        assert doc.trailer['Prev'] == xref_offset
+        assert len(doc.sections) == 2
+        # The update's xref section is of the kind the file already used
+        assert isinstance(doc.sections[0], XrefStream if xref == 'stream' else XrefTable)
+        assert doc.catalog['Lang'] == b'de-DE'
+        assert isinstance(doc.resolve(doc.catalog['Metadata']), Stream)
+        assert doc.resolve(doc.catalog['StructTreeRoot']) == {'Type': 'StructTreeRoot'}
+
+    # Updating again finds nothing left to change
+    again = write_pdf(b'', 'again.pdf')
+    assert add_ua_identification(output, again) == []
+    with open(again, 'rb') as f:
+        assert f.read() == updated
+
+
+def test_existing_xmp_is_extended(write_pdf):
+    data, _ = build_pdf(with_metadata(PDFUA_ATTRIBUTE))
+    output = write_pdf(b'', 'out.pdf')
+    changes = add_ua_identification(write_pdf(data), output)
+    # pdfuaid:part is there already, but dc:title is added from the Info dictionary
+    assert 'XMP' in changes
+    with PdfDocument(output) as doc:
+        xmp = doc.xmp()
+    assert b'pdfuaid:part="1"' in xmp and b'<dc:title>' in xmp
+
+
+def test_untagged_document_is_not_updated(write_pdf):
+    data, _ = build_pdf([CATALOG.replace(b' /StructTreeRoot 4 0 R', b''), *OBJECTS[1:]])
+    with pytest.raises(PdfError):
+        add_ua_identification(write_pdf(data), write_pdf(b'', 'out.pdf'))
+
+
+def test_engine_reports_failures_as_a_run(write_pdf):
+    data, _ = build_pdf([CATALOG.replace(b' /StructTreeRoot 4 0 R', b''), *OBJECTS[1:]])
+    result = MetadataEngine().run(write_pdf(data), write_pdf(b'', 'out.pdf'))
+    assert result.returncode == 1
+    assert 'metadata update failed' in result.stderr
@@ -0,0 +1,108 @@
+import pytest
+
+from pdf_parser import PdfDocument, PdfError, preflight, read_identification
+from tests.pdf_samples import OBJECTS, PDFUA_ATTRIBUTE, PDFUA_ELEMENT, build_pdf, with_metadata
+
+
+@pytest.mark.parametrize('xref', ['table', 'stream'])
+def test_reads_objects_through_the_xref(write_pdf, xref):
+    data, xref_offset = build_pdf(OBJECTS, xref)
+    with PdfDocument(write_pdf(data)) as doc:
+        assert doc.startxref == xref_offset
+        assert not doc.repaired
+        assert doc.catalog['Type'] == 'Catalog'
+        pages = doc.resolve(doc.catalog['Pages'])
+        assert pages['Count'] == 1
+        assert doc.resolve(pages['Kids'][0])['MediaBox'] == [0, 0, 612, 792]
+        assert doc.resolve(doc.trailer['Info'])['Title'] == b'Synthetic'
+        assert doc.get(len(OBJECTS) + 10) is None
+
+
+def test_missing_startxref_is_an_error(write_pdf):
+    data, _ = build_pdf()
+    with pytest.raises(PdfError):
+        PdfDocument(write_pdf(data.replace(b'startxref', b'startxrex')))
+
+
+@pytest.mark.parametrize('description, compress', [
+    (PDFUA_ATTRIBUTE, False),
+    (PDFUA_ELEMENT, True),
+])
+def test_identification_reads_pdfua_part(write_pdf, description, compress):
+    data, _ = build_pdf(with_metadata(description, compress), 'stream')
+    identification = read_identification(write_pdf(data))
+    assert identification['pdfua_part'] == 1
+    assert identification['marked'] and identification['struct_tree']
+    assert not identification['lang'] and not identification['display_doc_title']
+
+
+def test_identification_without_metadata(write_pdf):
+    data, _ = build_pdf()
+    identification = read_identification(write_pdf(data))
+    assert identification['pdfua_part'] is None
+    assert not identification['title']
+
+
+def test_broken_startxref_needs_repair(write_pdf):
+    data, xref_offset = build_pdf()
+    path = write_pdf(data.replace(b'startxref\n%d' % xref_offset, b'startxref\n%d' % (xref_offset + 7)))
+    with pytest.raises(PdfError):
+        PdfDocument(path)
+    with PdfDocument(path, repair=True) as doc:
+        assert doc.repaired
+        assert doc.catalog['StructTreeRoot'] is not None
+        assert doc.resolve(doc.catalog['Pages'])['Count'] == 1
+
+
+def test_stale_xref_offsets_are_repaired_from_object_headers(write_pdf):
+    data, xref_offset = build_pdf()
+    # Shift every object but leave the xref table's entries pointing at the old offsets
+    padding = b'99 0 obj\nnull\nendobj\n'
+    data = data.replace(b'%\xe2\xe3\xcf\xd3\n', b'%\xe2\xe3\xcf\xd3\n' + padding, 1)
+    data = data.replace(b'startxref\n%d' % xref_offset, b'startxref\n%d' % (xref_offset + len(padding)))
+    with pytest.raises(PdfError):
+        with PdfDocument(write_pdf(data, 'strict.pdf')) as doc:
+            doc.catalog
+    with PdfDocument(write_pdf(data), repair=True) as doc:
+        assert not doc.repaired
+        assert doc.resolve(doc.catalog['Pages'])['Count'] == 1
+
+
+FEATURES = [
+    OBJECTS[0],
+    OBJECTS[1],
+    b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F0 6 0 R >> '
+    b'/XObject << /Im0 7 0 R >> /ExtGState << /G0 8 0 R >> >> >>',
+    OBJECTS[3],
+    OBJECTS[4],
+    b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    b'<< /Type /XObject /Subtype /Image /Width 40 /Height 30 /ColorSpace /DeviceGray '
+    b'/BitsPerComponent 8 /Length 3 >>\nstream\nabc\nendstream',
+    b'<< /Type /ExtGState /ca 0.5 >>',
+]
+
+
+@pytest.mark.parametrize('xref', ['table', 'stream'])
+def test_preflight_summary(write_pdf, xref):
+    data, _ = build_pdf(FEATURES, xref)
+    summary = preflight(write_pdf(data))
+    assert summary['xref'] == xref
+    assert summary['pages'] == 1
+    assert summary['tagged']
+    assert summary['objects'] == len(FEATURES) + (xref == 'stream')
+    assert (summary['images'], summary['image_pixels'], summary['fonts']) == (1, 1200, 1)
+    assert summary['transparency']
+    assert summary['complete']
+
+
+def test_preflight_of_a_repaired_file(write_pdf):
+    data, xref_offset = build_pdf(FEATURES)
+    summary = preflight(write_pdf(data.replace(b'startxref\n%d' % xref_offset, b'startxref\n1')))
+    assert summary['xref'] == 'scan'
+    assert summary['pages'] == 1
+    assert summary['images'] == 1
+
+
+def test_preflight_budget(write_pdf):
+    data, _ = build_pdf(FEATURES)
+    assert not preflight(write_pdf(data), max_objects=1)['complete']
@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController
+from scheduling import SchedulingPolicy, Waiting
+
+
+def waiting(cost, since, max_wait=None):
+    """A waiter that arrived at monotonic time `since`"""
+    w = Waiting(cost, item=cost, max_wait=max_wait)
+    w.since = since
+    if max_wait:
+        w.urgent_at = since + max_wait / 2
+    return w
+
+
+def test_fifo_keeps_arrival_order():
+    waiters = [waiting(30.0, 0.0), waiting(1.0, 1.0), waiting(5.0, 2.0)]
+    assert [w.item for w in SchedulingPolicy('fifo').order(waiters, now=3.0)] == [30.0, 1.0, 5.0]
+
+
+def test_sejf_starts_cheapest_first():
+    waiters = [waiting(30.0, 0.0), waiting(1.0, 1.0), waiting(5.0, 2.0)]
+    assert [w.item for w in SchedulingPolicy('sejf', aging_rate=0.1).order(waiters, now=3.0)] == [1.0, 5.0, 30.0]
+
+
+def test_unestimated_jobs_count_as_average():
+    waiters = [waiting(2.0, 0.0), waiting(None, 0.0), waiting(10.0, 0.0)]
+    assert [w.item for w in SchedulingPolicy('sejf', aging_rate=0.0).order(waiters, now=0.0)] == [2.0, None, 10.0]
+
+
+def test_aging_lets_long_jobs_through():
+    policy = SchedulingPolicy('sejf', aging_rate=0.5)
+    long_job = waiting(30.0, 0.0)
+    # 30 s of estimate is worth 60 s of waiting; a 1 s job arriving just now overtakes it before that
+    assert policy.first([long_job, waiting(1.0, 50.0)], now=50.0) is not long_job
+    assert policy.first([long_job, waiting(1.0, 62.0)], now=62.0) is long_job
+
+
+def test_urgent_waiters_are_not_overtaken():
+    policy = SchedulingPolicy('sejf', aging_rate=0.0)
+    earlier = waiting(30.0, -1.0, max_wait=10.0)
+    bounded = waiting(30.0, 0.0, max_wait=10.0)
+    small = waiting(1.0, 4.0)
+    assert policy.first([bounded, small], now=4.9) is small
+    assert policy.first([bounded, small], now=5.0) is bounded
+    # Urgent waiters keep arrival order among themselves
+    assert policy.order([bounded, small, earlier], now=5.0) == [earlier, bounded, small]
+
+
+def test_unknown_scheduler():
+    with pytest.raises(ValueError):
+        SchedulingPolicy('lifo')
+
+
+def test_admission_starts_urgent_waiter_without_another_event():
+    admission = AdmissionController(2, 10, max_wait=0.6, policy=SchedulingPolicy('sejf', aging_rate=0.0))
+    admission.acquire()
+    started = []
+
+    def wait_for_slot(name, cost, bounded, slots):
+        admission.acquire(bounded=bounded, cost=cost, slots=slots)
+        started.append(name)
+
+    # The cheap job needs both slots, so the one free slot stays free while it is first
+    small = threading.Thread(target=wait_for_slot, args=('small', 1.0, False, 2), daemon=True)
+    small.start()
+    time.sleep(0.05)
+    bounded = threading.Thread(target=wait_for_slot, args=('bounded', 30.0, True, 1), daemon=True)
+    bounded.start()
+    # Nothing is released; turning urgent after 0.3 s must be enough to start it
+    bounded.join(0.5)
+    assert started == ['bounded']
+    admission.release()
+    admission.release()
+    small.join(1)
+    assert started == ['bounded', 'small']